@@ -6,19 +6,22 @@ import os
 from routes.auth import auth_bp
 from routes.api import api_bp
 from routes.web import web_bp
+from routes.metrics import metrics_bp
 
-from flask_limiter import Limiter
-from flask_limiter.util import get_remote_address
+from services.extensions import limiter
+from services.Instrumentation import OptInProfilerMiddleware, configure_logging
+
+configure_logging()
 
 app = Flask(__name__)
 
-# Configuración de Rate Limiting (Seguridad anti-DDoS básica)
-limiter = Limiter(
-    get_remote_address,
-    app=app,
-    default_limits=["200 per day", "50 per hour"],
-    storage_uri="memory://"
-)
+# Perfilado opcional: con PROFILE_DIR definido, las peticiones con `X-Profile: 1`
+# guardan un perfil de cProfile en ese directorio
+if os.environ.get('PROFILE_DIR'):
+    app.wsgi_app = OptInProfilerMiddleware(app.wsgi_app, os.environ['PROFILE_DIR'])
+
+# Configuración de Rate Limiting (límites por defecto en services/extensions.py)
+limiter.init_app(app)
 
 # Configuración CORS (Global)
 # Restringir orígenes al frontend configurado y al nuevo puerto del dashboard
@@ -36,6 +39,10 @@ CORS(app, resources={
 app.register_blueprint(web_bp)  # Rutas raíz (Frontend)
 app.register_blueprint(auth_bp) # Rutas /auth/...
 app.register_blueprint(api_bp)  # Rutas /api/...
+app.register_blueprint(metrics_bp)  # /metrics (Prometheus)
+
+# Prometheus consulta /metrics cada pocos segundos: sin límite de peticiones
+limiter.exempt(metrics_bp)
 
 # Middleware para cabeceras de seguridad
 @app.after_request
@@ -45,7 +52,10 @@ def add_security_headers(response):
     response.headers['X-XSS-Protection'] = '1; mode=block'
     return response
 
-from services.container import db_service
+from services.container import db_service, job_queue
+
+# Pool de sincronizaciones en segundo plano (retoma trabajos interrumpidos)
+job_queue.start()
 
 if __name__ == '__main__':
     # Inicializar tablas de BD
@@ -0,0 +1,79 @@
+"""Compara dos resultados de benchmarks.suite e indica las regresiones.
+
+Las métricas `*_per_second` son mejores cuanto más altas; las de tiempo
+(`seconds`, `*_ms`), cuanto más bajas. El resto se muestra sin evaluar.
+Sale con código 1 si alguna métrica empeora más que `--threshold` (%).
+
+Uso: python -m benchmarks.compare base.json nuevo.json [--threshold 10]
+"""
+import argparse
+import json
+import sys
+
+
+def _flatten(data, prefix=''):
+    """{'a': {'b': 1}} -> {'a.b': 1}, solo con valores numéricos"""
+    flat = {}
+    for key, value in data.items():
+        path = f'{prefix}{key}'
+        if isinstance(value, dict):
+            flat.update(_flatten(value, path + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[path] = value
+    return flat
+
+
+def _direction(path):
+    """1 si más alto es mejor, -1 si más bajo es mejor, 0 si no se evalúa"""
+    name = path.rsplit('.', 1)[-1]
+    if name.endswith('per_second'):
+        return 1
+    if name.endswith('seconds') or name.endswith('_ms'):
+        return -1
+    return 0
+
+
+def compare(base, new, threshold=10.0):
+    """Devuelve filas (métrica, base, nuevo, % cambio, estado) de las métricas comunes"""
+    base, new = _flatten(base.get('results', {})), _flatten(new.get('results', {}))
+    rows = []
+    for path in sorted(base.keys() & new.keys()):
+        before, after = base[path], new[path]
+        change = (after - before) / before * 100 if before else 0.0
+        direction = _direction(path)
+        status = ''
+        if direction and abs(change) >= threshold:
+            status = 'mejora' if change * direction > 0 else 'REGRESIÓN'
+        rows.append((path, before, after, change, status))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('base')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=10.0, help='% de cambio a partir del cual se marca')
+    args = parser.parse_args()
+
+    with open(args.base, encoding='utf-8') as f:
+        base = json.load(f)
+    with open(args.new, encoding='utf-8') as f:
+        new = json.load(f)
+
+    print(f"base: {base.get('git_commit')} ({base.get('timestamp')})  nuevo: {new.get('git_commit')} ({new.get('timestamp')})")
+    if base.get('params') != new.get('params'):
+        print("Aviso: los parámetros de ambas ejecuciones no coinciden")
+
+    rows = compare(base, new, args.threshold)
+    width = max((len(row[0]) for row in rows), default=10)
+    for path, before, after, change, status in rows:
+        print(f"{path:<{width}}  {before:>12g}  {after:>12g}  {change:>+8.1f}%  {status}")
+
+    regressions = [row for row in rows if row[4] == 'REGRESIÓN']
+    if regressions:
+        print(f"\n{len(regressions)} regresión(es) por encima del {args.threshold:g}%")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
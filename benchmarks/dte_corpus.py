@@ -0,0 +1,86 @@
+import codecs
+import json
+import random
+import uuid
+from datetime import date, timedelta
+
+EMISORES = [
+    'DISTRIBUIDORA ZABLAH, S.A. DE C.V.', 'SUPER SELECTOS, S.A. DE C.V.', 'FARMACIAS SAN NICOLÁS',
+    'CLARO EL SALVADOR', 'TIGO EL SALVADOR', 'CAESS, S.A. DE C.V.', 'ANDA',
+    'PRICESMART EL SALVADOR', 'FREUND, S.A. DE C.V.', 'TEXACO LAS CASCADAS',
+]
+TIPOS_DTE = ['01', '01', '01', '03', '03', '05', '14']
+
+
+def make_dte(rng, items=None):
+    """Genera un DTE con la forma de los que emite Hacienda (El Salvador)"""
+    items = items if items is not None else rng.randint(1, 25)
+    emisor = rng.choice(EMISORES)
+    fecha = date(2023, 1, 1) + timedelta(days=rng.randint(0, 900))
+    cuerpo = []
+    gravada = 0.0
+    for n in range(1, items + 1):
+        cantidad = rng.randint(1, 5)
+        precio = round(rng.uniform(0.5, 150), 2)
+        venta = round(cantidad * precio, 2)
+        gravada += venta
+        cuerpo.append({
+            'numItem': n, 'tipoItem': 1, 'numeroDocumento': None, 'cantidad': cantidad,
+            'codigo': f'P{rng.randint(1000, 99999)}', 'codTributo': None, 'uniMedida': 59,
+            'descripcion': f'Producto de prueba número {n} con descripción larga', 'precioUni': precio,
+            'montoDescu': 0.0, 'ventaNoSuj': 0.0, 'ventaExenta': 0.0, 'ventaGravada': venta,
+            'tributos': ['20'], 'psv': 0.0, 'noGravado': 0.0, 'ivaItem': round(venta * 0.13 / 1.13, 2),
+        })
+    gravada = round(gravada, 2)
+    return {
+        'identificacion': {
+            'version': 3, 'ambiente': '01', 'tipoDte': rng.choice(TIPOS_DTE),
+            'numeroControl': f'DTE-01-M001P001-{rng.randint(1, 10**15):015d}',
+            'codigoGeneracion': str(uuid.UUID(int=rng.getrandbits(128))).upper(),
+            'tipoModelo': 1, 'tipoOperacion': 1, 'tipoContingencia': None, 'motivoContin': None,
+            'fecEmi': fecha.isoformat(), 'horEmi': '10:15:30', 'tipoMoneda': 'USD',
+        },
+        'documentoRelacionado': None,
+        'emisor': {
+            'nit': f'0614{rng.randint(10**9, 10**10 - 1)}', 'nrc': str(rng.randint(10000, 999999)),
+            'nombre': emisor, 'codActividad': '47111', 'descActividad': 'Venta al por menor',
+            'nombreComercial': emisor.split(',')[0], 'tipoEstablecimiento': '01',
+            'direccion': {'departamento': '06', 'municipio': '14', 'complemento': 'Colonia Escalón, San Salvador'},
+            'telefono': '22223333', 'correo': 'facturacion@example.com',
+        },
+        'receptor': {
+            'tipoDocumento': '13', 'numDocumento': '01234567-8', 'nrc': None, 'nombre': 'CLIENTE DE PRUEBA',
+            'codActividad': None, 'descActividad': None,
+            'direccion': {'departamento': '06', 'municipio': '14', 'complemento': 'San Salvador'},
+            'telefono': None, 'correo': 'cliente@example.com',
+        },
+        'otrosDocumentos': None, 'ventaTercero': None,
+        'cuerpoDocumento': cuerpo,
+        'resumen': {
+            'totalNoSuj': 0.0, 'totalExenta': 0.0, 'totalGravada': gravada, 'subTotalVentas': gravada,
+            'descuNoSuj': 0.0, 'descuExenta': 0.0, 'descuGravada': 0.0, 'porcentajeDescuento': 0.0,
+            'totalDescu': 0.0, 'tributos': None, 'subTotal': gravada, 'ivaRete1': 0.0, 'reteRenta': 0.0,
+            'montoTotalOperacion': gravada, 'totalNoGravado': 0.0, 'totalPagar': gravada,
+            'totalLetras': 'CIEN 00/100 USD', 'totalIva': round(gravada * 0.13 / 1.13, 2),
+            'saldoFavor': 0.0, 'condicionOperacion': 1, 'pagos': None, 'numPagoElectronico': None,
+        },
+        'extension': None, 'apendice': None,
+        'firmaElectronica': 'eyJhbGciOiJSUzUxMiJ9.' + 'A' * rng.randint(2000, 4000),
+    }
+
+
+def encode_dte(rng, dte):
+    """Serializa como llegan en los correos: la mayoría UTF-8, algunos con BOM o en latin-1"""
+    roll = rng.random()
+    text = json.dumps(dte, ensure_ascii=False, indent=2 if roll < 0.3 else None)
+    if roll < 0.85:
+        return text.encode('utf-8')
+    if roll < 0.95:
+        return codecs.BOM_UTF8 + text.encode('utf-8')
+    return text.encode('latin-1', errors='replace')
+
+
+def make_corpus(size, seed=42):
+    """Lista de `size` adjuntos DTE en bytes, reproducible con `seed`"""
+    rng = random.Random(seed)
+    return [encode_dte(rng, make_dte(rng)) for _ in range(size)]
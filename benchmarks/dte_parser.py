@@ -0,0 +1,69 @@
+"""Micro-benchmark del parser de DTE: ruta original (json + cadena de decodificaciones) vs DteParser.
+
+Uso: python -m benchmarks.dte_parser [--files 2000] [--repeat 5]
+"""
+import argparse
+import json
+import time
+
+from benchmarks.dte_corpus import make_corpus
+from services import DteParser
+from services.DteParser import parse_dte
+
+
+def legacy_parse(raw):
+    """Copia de la ruta anterior: get_json_from_message + _extract_invoice_data"""
+    try:
+        data = json.loads(raw.decode('utf-8'))
+    except UnicodeDecodeError:
+        try:
+            data = json.loads(raw.decode('utf-8-sig'))
+        except:
+            data = json.loads(raw.decode('latin-1'))
+    ident = data.get('identificacion', {})
+    return {
+        'codigo_generacion': ident.get('codigoGeneracion'),
+        'fecha_emision': ident.get('fecEmi'),
+        'nombre_emisor': data.get('emisor', {}).get('nombre'),
+        'total_pagar': data.get('resumen', {}).get('totalPagar'),
+        'tipo_dte': ident.get('tipoDte'),
+    }
+
+
+def run(parse, corpus, repeat):
+    best = float('inf')
+    errors = 0
+    for _ in range(repeat):
+        errors = 0
+        start = time.perf_counter()
+        for raw in corpus:
+            try:
+                parse(raw)
+            except ValueError:
+                errors += 1
+        best = min(best, time.perf_counter() - start)
+    return {'seconds': round(best, 4), 'files_per_second': round(len(corpus) / best), 'errors': errors}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.files)
+    legacy = run(legacy_parse, corpus, args.repeat)
+    fast = run(parse_dte, corpus, args.repeat)
+    print(json.dumps({
+        'benchmark': 'dte_parser',
+        'files': len(corpus),
+        'bytes': sum(len(raw) for raw in corpus),
+        'backend': 'orjson' if DteParser.orjson else 'json',
+        'legacy': legacy,
+        'dte_parser': fast,
+        'speedup': round(legacy['seconds'] / fast['seconds'], 2),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+"""Servidor local que imita la API de Gmail para benchmarks y pruebas.
+
+Implementa profile, messages.list, messages.get, attachments.get, history.list
+y el endpoint /batch (multipart/mixed) que usa googleapiclient, con latencia
+configurable e inyección de errores 429.
+
+Uso: python -m benchmarks.fake_gmail [--port 8765] [--messages 1000] [--latency-ms 20] [--rate-limit 0.05]
+Después: GMAIL_ROOT_URL=http://127.0.0.1:8765/ en la app o el planificador.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import random
+import threading
+from email.parser import BytesParser
+from urllib.parse import parse_qs, urlsplit
+
+from aiohttp import web
+
+from benchmarks.dte_corpus import make_corpus
+
+API_PREFIX = '/gmail/v1/users/me'
+PDF_BYTES = b'%PDF-1.4\n' + b'0' * 20000
+
+
+class FakeGmailServer:
+    """Buzón sintético: el mensaje `i` trae un PDF y el DTE `i` del corpus como adjuntos.
+
+    `latency_ms` se aplica a cada petición HTTP (un batch cuenta como una) y
+    `rate_limit` es la probabilidad de responder 429 a cada llamada de la API
+    (dentro de un batch, a cada parte por separado).
+    """
+
+    def __init__(self, messages=1000, latency_ms=0, rate_limit=0.0, seed=42, history_id=1000):
+        self.corpus = make_corpus(messages, seed)
+        self.latency = latency_ms / 1000
+        self.rate_limit = rate_limit
+        self.history_id = history_id
+        self._rng = random.Random(seed)
+        self.stats = {'requests': 0, 'calls': 0, 'rate_limited': 0}
+        self._loop = None
+        self._runner = None
+        self.port = None
+
+    # --- Respuestas de la API (status, cuerpo JSON) ---
+
+    def _throttled(self):
+        self.stats['calls'] += 1
+        if self.rate_limit and self._rng.random() < self.rate_limit:
+            self.stats['rate_limited'] += 1
+            return True
+        return False
+
+    def _message(self, index):
+        msg_id = f'm{index:08d}'
+        headers = [
+            {'name': 'Subject', 'value': f'Factura electrónica {index}'},
+            {'name': 'From', 'value': 'Facturación <facturacion@example.com>'},
+            {'name': 'Date', 'value': 'Mon, 1 Jan 2024 10:00:00 -0600'},
+        ]
+        return {
+            'id': msg_id, 'threadId': msg_id, 'snippet': 'Adjuntamos su DTE',
+            'payload': {
+                'partId': '', 'mimeType': 'multipart/mixed', 'headers': headers,
+                'parts': [
+                    {'partId': '0', 'mimeType': 'text/plain', 'filename': '', 'body': {'size': 42}},
+                    {'partId': '1', 'mimeType': 'application/pdf', 'filename': f'DTE-{index}.pdf',
+                     'body': {'attachmentId': f'pdf-{index}', 'size': len(PDF_BYTES)}},
+                    {'partId': '2', 'mimeType': 'application/json', 'filename': f'DTE-{index}.json',
+                     'body': {'attachmentId': f'json-{index}', 'size': len(self.corpus[index])}},
+                ],
+            },
+        }
+
+    def api(self, path, query):
+        """Resuelve una llamada GET de la API: devuelve (status, dict)"""
+        if self._throttled():
+            return 429, {'error': {'code': 429, 'message': 'Rate Limit Exceeded', 'status': 'RESOURCE_EXHAUSTED'}}
+        if not path.startswith(API_PREFIX):
+            return 404, {'error': {'code': 404, 'message': 'Not Found'}}
+        parts = path[len(API_PREFIX):].strip('/').split('/')
+
+        if parts == ['profile']:
+            return 200, {'emailAddress': 'benchmark@example.com', 'historyId': str(self.history_id),
+                         'messagesTotal': len(self.corpus)}
+        if parts == ['history']:
+            return 200, {'history': [], 'historyId': str(self.history_id)}
+        if parts == ['messages']:
+            start = int(query.get('pageToken', ['0'])[0])
+            size = min(int(query.get('maxResults', ['100'])[0]), 500)
+            end = min(start + size, len(self.corpus))
+            body = {'messages': [{'id': f'm{i:08d}', 'threadId': f'm{i:08d}'} for i in range(start, end)],
+                    'resultSizeEstimate': len(self.corpus)}
+            if end < len(self.corpus):
+                body['nextPageToken'] = str(end)
+            return 200, body
+        if len(parts) >= 2 and parts[0] == 'messages':
+            try:
+                index = int(parts[1][1:])
+                self.corpus[index]
+            except (ValueError, IndexError):
+                return 404, {'error': {'code': 404, 'message': 'Requested entity was not found.'}}
+            if len(parts) == 2:
+                return 200, self._message(index)
+            if len(parts) == 4 and parts[2] == 'attachments':
+                data = self.corpus[index] if parts[3].startswith('json-') else PDF_BYTES
+                return 200, {'size': len(data), 'data': base64.urlsafe_b64encode(data).decode()}
+        return 404, {'error': {'code': 404, 'message': 'Not Found'}}
+
+    # --- HTTP ---
+
+    async def _handle_get(self, request):
+        self.stats['requests'] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        status, body = self.api(request.path, parse_qs(request.query_string))
+        return web.json_response(body, status=status)
+
+    async def _handle_batch(self, request):
+        """Endpoint batch de Google: partes application/http en multipart/mixed"""
+        self.stats['requests'] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        raw = await request.read()
+        envelope = BytesParser().parsebytes(
+            f'Content-Type: {request.headers["Content-Type"]}\r\n\r\n'.encode() + raw
+        )
+        boundary = 'batch_facturaflow'
+        out = []
+        for part in envelope.get_payload():
+            content_id = part['Content-ID'].strip('<>')
+            request_line = part.get_payload().lstrip().split('\n', 1)[0]
+            _, target, _ = request_line.split(' ', 2)
+            url = urlsplit(target)
+            status, body = self.api(url.path, parse_qs(url.query))
+            out.append(
+                f'--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n'
+                f'HTTP/1.1 {status} {"OK" if status == 200 else "Error"}\r\n'
+                f'Content-Type: application/json; charset=UTF-8\r\n\r\n{json.dumps(body)}\r\n'
+            )
+        out.append(f'--{boundary}--\r\n')
+        return web.Response(
+            body=''.join(out).encode(), headers={'Content-Type': f'multipart/mixed; boundary={boundary}'}
+        )
+
+    def _app(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        # El documento de descubrimiento actual usa /batch; versiones antiguas, /batch/gmail/v1
+        app.router.add_post('/batch', self._handle_batch)
+        app.router.add_post('/batch/gmail/v1', self._handle_batch)
+        app.router.add_get('/{tail:.*}', self._handle_get)
+        return app
+
+    def start(self, host='127.0.0.1', port=0):
+        """Arranca el servidor en un hilo propio y devuelve su URL raíz"""
+        ready = threading.Event()
+
+        def serve():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._runner = web.AppRunner(self._app(), access_log=None)
+            self._loop.run_until_complete(self._runner.setup())
+            site = web.TCPSite(self._runner, host, port)
+            self._loop.run_until_complete(site.start())
+            self.port = site._server.sockets[0].getsockname()[1]
+            ready.set()
+            self._loop.run_forever()
+
+        threading.Thread(target=serve, name='fake-gmail', daemon=True).start()
+        ready.wait()
+        return f'http://{host}:{self.port}/'
+
+    def stop(self):
+        if self._loop:
+            asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--rate-limit', type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = FakeGmailServer(args.messages, args.latency_ms, args.rate_limit)
+    print(f"Gmail falso en {server.start(port=args.port)} ({args.messages} mensajes)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""Llena `facturas` con filas sintéticas para medir el dashboard con volúmenes reales (10k a 10M).
+
+Usa la conexión de config.env (DB_*): apuntar DB_NAME a una base de pruebas.
+Uso: python -m benchmarks.seed --rows 100000 [--batch 5000] [--seed 42]
+"""
+import argparse
+import json
+import random
+import time
+import uuid
+from datetime import date, timedelta
+
+from benchmarks.dte_corpus import EMISORES, TIPOS_DTE
+
+
+def _emisores(rng, rows):
+    """Emisores con una cardinalidad parecida a la real (uno cada ~500 facturas)"""
+    total = min(5000, max(len(EMISORES), rows // 500))
+    emisores = [(name, f'0614{rng.randint(10**9, 10**10 - 1)}', str(rng.randint(10000, 999999))) for name in EMISORES]
+    for n in range(len(EMISORES), total):
+        emisores.append((f'EMISOR DE PRUEBA {n}, S.A. DE C.V.', f'0614{rng.randint(10**9, 10**10 - 1)}',
+                         str(rng.randint(10000, 999999))))
+    return emisores
+
+
+def seed_facturas(db, rows, batch=5000, seed=42):
+    """Inserta `rows` facturas (solo la tabla principal) y recalcula las tablas resumen.
+
+    Reproducible con `seed`; devuelve los segundos de inserción y de recálculo.
+    """
+    rng = random.Random(seed)
+    emisores = _emisores(rng, rows)
+    # Cada emisor se registra una vez en la dimensión `emisores`
+    resolved = db.resolve_emisor_ids([{'nombre_emisor': nombre, 'emisor_nit': nit} for nombre, nit, _ in emisores])
+    emisores = [(nombre, nit, nrc, inv['emisor_id']) for (nombre, nit, nrc), inv in zip(emisores, resolved)]
+    # Los emisores frecuentes concentran la mayoría de facturas, como en un buzón real
+    weights = [1 / (i + 1) for i in range(len(emisores))]
+    start_date = date(2022, 1, 1)
+
+    started = time.perf_counter()
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            for offset in range(0, rows, batch):
+                size = min(batch, rows - offset)
+                chosen = rng.choices(emisores, weights, k=size)
+                cursor.executemany("""
+                    INSERT IGNORE INTO facturas
+                    (codigo_generacion, fecha_emision, nombre_emisor, total_pagar, tipo_dte, emisor_nit, emisor_nrc, emisor_id)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                """, [
+                    (str(uuid.UUID(int=rng.getrandbits(128))).upper(),
+                     start_date + timedelta(days=rng.randint(0, 1400)),
+                     nombre, round(rng.lognormvariate(3.5, 1.2), 2), rng.choice(TIPOS_DTE), nit, nrc, emisor_id)
+                    for nombre, nit, nrc, emisor_id in chosen
+                ])
+                conn.commit()
+        finally:
+            cursor.close()
+    inserted = time.perf_counter() - started
+
+    started = time.perf_counter()
+    db.rebuild_stats()
+    return {'rows': rows, 'insert_seconds': round(inserted, 2), 'rebuild_stats_seconds': round(time.perf_counter() - started, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--batch', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    from services.container import db_service
+    db_service.create_tables()
+    print(json.dumps(seed_facturas(db_service, args.rows, args.batch, args.seed), indent=2))
+
+
+if __name__ == '__main__':
+    main()
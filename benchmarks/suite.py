@@ -0,0 +1,270 @@
+"""Suite de benchmarks reproducible: sincronización, búsqueda y dashboard.
+
+Levanta un Gmail falso local (benchmarks.fake_gmail) con latencia e inyección de
+429 configurables, y emite los resultados en JSON para comparar entre ejecuciones
+(ver benchmarks.compare).
+
+Escenarios:
+  sync       Throughput de InvoiceProcessor (hilos y/o asyncio) contra el Gmail falso.
+             Con --db memory la BD es un doble en memoria (solo mide Gmail + parseo);
+             con --db mariadb usa la base de config.env.
+  search     Latencia de /api/search en frío (consulta nueva) y en caliente (caché).
+  dashboard  Latencia de get_dashboard_stats con `facturas` sembrada (--rows, MariaDB).
+
+Uso: python -m benchmarks.suite [--scenarios sync,search,dashboard] [--messages 1000]
+       [--latency-ms 20] [--rate-limit 0.02] [--sync-modes threads,async] [--db memory]
+       [--rows 10000] [--repeat 20] [--output resultados.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import time
+from datetime import datetime, timezone
+
+from prometheus_client import REGISTRY
+
+from benchmarks.fake_gmail import FakeGmailServer
+
+
+class MemoryDatabase:
+    """Doble en memoria de DatabaseService con lo que usa InvoiceProcessor"""
+
+    def __init__(self):
+        self.codes = set()
+        self.checkpoints = {}
+        self.failed_messages = {}
+
+    def get_sync_checkpoint(self, account):
+        return self.checkpoints.get(account)
+
+    def save_sync_checkpoint(self, account, history_id):
+        self.checkpoints[account] = history_id
+
+    def get_failed_messages(self, account, max_attempts):
+        return [message_id for (acc, message_id), (attempts, _) in self.failed_messages.items()
+                if acc == account and attempts < max_attempts]
+
+    def record_failed_messages(self, account, failed):
+        for message_id, error in failed.items():
+            attempts = self.failed_messages.get((account, message_id), (0, None))[0]
+            self.failed_messages[(account, message_id)] = (attempts + 1, error)
+        return {message_id: self.failed_messages[(account, message_id)][0] for message_id in failed}
+
+    def clear_failed_messages(self, account, message_ids):
+        for message_id in message_ids:
+            self.failed_messages.pop((account, message_id), None)
+
+    def resolve_emisor_ids(self, invoices):
+        for inv in invoices:
+            inv['emisor_id'] = None
+        return invoices
+
+    def save_invoices_batch(self, invoices):
+        insertados, duplicados = [], []
+        for inv in invoices:
+            codigo = inv['codigo_generacion']
+            (duplicados if codigo in self.codes else insertados).append(codigo)
+            self.codes.add(codigo)
+        return insertados, duplicados
+
+
+def _metric_samples():
+    """{(nombre, etiquetas): valor} de las métricas de la app, para calcular diferencias"""
+    samples = {}
+    for family in REGISTRY.collect():
+        if not family.name.startswith('facturaflow_'):
+            continue
+        for sample in family.samples:
+            samples[(sample.name, tuple(sorted(sample.labels.items())))] = sample.value
+    return samples
+
+
+def _metric_delta(before, after):
+    """Resume la diferencia de métricas: llamadas, reintentos y tiempo por etapa"""
+    delta = {key: value - before.get(key, 0) for key, value in after.items()}
+    result = {'gmail_calls': {}, 'gmail_retries': {}, 'stages': {}}
+    for (name, labels), value in delta.items():
+        labels = dict(labels)
+        if name == 'facturaflow_gmail_calls_total' and value:
+            result['gmail_calls'][labels['method']] = int(value)
+        elif name == 'facturaflow_gmail_retries_total' and value:
+            result['gmail_retries'][labels['reason']] = int(value)
+        elif name in ('facturaflow_sync_stage_seconds_sum', 'facturaflow_sync_stage_seconds_count') and value:
+            stage = result['stages'].setdefault(labels['stage'], {})
+            stage['seconds' if name.endswith('_sum') else 'observations'] = round(value, 4)
+    return result
+
+
+def _latency_summary(samples):
+    samples = sorted(samples)
+    return {
+        'requests': len(samples),
+        'mean_ms': round(statistics.fmean(samples) * 1000, 2),
+        'p50_ms': round(samples[len(samples) // 2] * 1000, 2),
+        'p95_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000, 2),
+        'max_ms': round(samples[-1] * 1000, 2),
+    }
+
+
+def _database(kind):
+    if kind == 'memory':
+        return MemoryDatabase()
+    from services.container import db_service
+    db_service.create_tables()
+    return db_service
+
+
+def bench_sync(root_url, server, args, mode):
+    """Sincronización completa de todos los mensajes del Gmail falso"""
+    from services.InvoiceProcessor import InvoiceProcessor
+
+    db = _database(args.db)
+    before, requests_before = _metric_samples(), server.stats['requests']
+    started = time.perf_counter()
+    if mode == 'async':
+        from services.AsyncGmailService import AsyncGmailService, AsyncGmailTransport
+
+        async def run():
+            transport = AsyncGmailTransport(root_url=root_url, max_concurrency=args.concurrency)
+            try:
+                processor = InvoiceProcessor(AsyncGmailService(transport, 'benchmark'), db)
+                return await processor.process_invoices_async(query='has:attachment', incremental=False)
+            finally:
+                await transport.close()
+        results = asyncio.run(run())
+    else:
+        from services.GmailService import GmailService
+        gmail = GmailService(None, None, None, root_url=root_url)
+        gmail.build_service('benchmark')
+        results = InvoiceProcessor(gmail, db).process_invoices(query='has:attachment', incremental=False)
+    seconds = time.perf_counter() - started
+
+    return {
+        'mode': mode,
+        'database': args.db,
+        'messages': args.messages,
+        'seconds': round(seconds, 3),
+        'messages_per_second': round(args.messages / seconds, 1),
+        'nuevas': results['nuevas'],
+        'duplicadas': results['duplicadas'],
+        'errores': results['errores'],
+        'http_requests': server.stats['requests'] - requests_before,
+        **_metric_delta(before, _metric_samples()),
+    }
+
+
+def bench_search(args):
+    """Latencia de /api/search con el cliente de pruebas de Flask"""
+    from flask import Flask
+    from routes.api import api_bp
+
+    app = Flask(__name__)
+    app.register_blueprint(api_bp)
+    client = app.test_client()
+    client.set_cookie('gmail_token', 'benchmark')
+
+    def timed(search):
+        started = time.perf_counter()
+        response = client.post('/api/search', json={'search': search})
+        elapsed = time.perf_counter() - started
+        if response.status_code != 200:
+            raise RuntimeError(f"/api/search respondió {response.status_code}: {response.get_data(as_text=True)}")
+        return elapsed
+
+    # Consultas distintas: sin caché de búsqueda (los correos sí se reutilizan desde la 2ª)
+    cold = [timed(f'factura {n}') for n in range(args.repeat)]
+    warm = [timed('factura 0') for _ in range(args.repeat)]
+    return {'cold': _latency_summary(cold), 'warm': _latency_summary(warm)}
+
+
+def bench_dashboard(args):
+    """Latencia de get_dashboard_stats con `facturas` sembrada"""
+    from benchmarks.seed import seed_facturas
+    from services.container import db_service
+
+    db_service.create_tables()
+    result = {}
+    if args.rows:
+        result['seed'] = seed_facturas(db_service, args.rows)
+    latencies = []
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        db_service.get_dashboard_stats()
+        latencies.append(time.perf_counter() - started)
+    with db_service.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM facturas")
+        result['facturas'] = cursor.fetchone()[0]
+        cursor.close()
+    result['get_dashboard_stats'] = _latency_summary(latencies)
+    return result
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', default='sync,search,dashboard')
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--rate-limit', type=float, default=0.02)
+    parser.add_argument('--sync-modes', default='threads,async')
+    parser.add_argument('--concurrency', type=int, default=32, help='peticiones simultáneas en modo async')
+    parser.add_argument('--db', choices=['memory', 'mariadb'], default='memory')
+    parser.add_argument('--rows', type=int, default=10000, help='facturas a sembrar (0 = usar las existentes)')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--output', help='archivo JSON de salida (por defecto, stdout)')
+    args = parser.parse_args()
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+
+    server = FakeGmailServer(args.messages, args.latency_ms, args.rate_limit)
+    root_url = server.start()
+    # La app lee esta configuración al importar services.container
+    os.environ.update({'GMAIL_ROOT_URL': root_url, 'SHARED_STATE_URI': 'memory://', 'ATTACHMENT_CACHE_DIR': ''})
+
+    report = {
+        'benchmark': 'suite',
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'git_commit': _git_commit(),
+        'python': platform.python_version(),
+        'params': {key: value for key, value in vars(args).items() if key != 'output'},
+        'results': {},
+    }
+    try:
+        for scenario in scenarios:
+            try:
+                if scenario == 'sync':
+                    report['results']['sync'] = {
+                        mode: bench_sync(root_url, server, args, mode)
+                        for mode in args.sync_modes.split(',')
+                    }
+                elif scenario == 'search':
+                    report['results']['search'] = bench_search(args)
+                elif scenario == 'dashboard':
+                    report['results']['dashboard'] = bench_dashboard(args)
+                else:
+                    report['results'][scenario] = {'skipped': 'escenario desconocido'}
+            except Exception as e:
+                # P. ej. sin MariaDB disponible: se registra y se sigue con el resto
+                report['results'][scenario] = {'skipped': f'{type(e).__name__}: {e}'}
+    finally:
+        server.stop()
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
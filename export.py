@@ -0,0 +1,57 @@
+"""Exporta las facturas guardadas a CSV, XLSX o Parquet (sin pasar por la web).
+
+Uso: python export.py --format parquet --output facturas.parquet [--desde 2023-01-01] [--hasta 2023-12-31]
+       [--emisor NOMBRE] [--nit NIT] [--tipo 01,03] [--min-total 0] [--max-total 1000]
+Sin --output, escribe en la salida estándar.
+"""
+import argparse
+import sys
+import time
+from datetime import date
+from decimal import Decimal
+
+from services.container import db_service
+from services.InvoiceExport import EXPORT_CHUNK_SIZE, available_formats, export_invoices
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--format', choices=available_formats(), default='csv')
+    parser.add_argument('--output', help='archivo de salida (por defecto, stdout)')
+    parser.add_argument('--desde', type=date.fromisoformat)
+    parser.add_argument('--hasta', type=date.fromisoformat)
+    parser.add_argument('--emisor', help='prefijo del nombre del emisor')
+    parser.add_argument('--nit')
+    parser.add_argument('--tipo', default='', help='tipos de DTE separados por comas')
+    parser.add_argument('--min-total', type=Decimal)
+    parser.add_argument('--max-total', type=Decimal)
+    parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    filters = {
+        'desde': args.desde, 'hasta': args.hasta, 'emisor': args.emisor, 'nit': args.nit,
+        'tipos': [t.strip() for t in args.tipo.split(',') if t.strip()],
+        'min_total': args.min_total, 'max_total': args.max_total,
+    }
+
+    rows = 0
+
+    def counted(chunks):
+        nonlocal rows
+        for chunk in chunks:
+            rows += len(chunk)
+            yield chunk
+
+    started = time.perf_counter()
+    out = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    try:
+        for data in export_invoices(counted(db_service.iter_invoices(filters, chunk_size=args.chunk_size)), args.format):
+            out.write(data)
+    finally:
+        if args.output:
+            out.close()
+    print(f"✅ {rows} facturas exportadas en {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -92,6 +92,37 @@ class GmailDownloader {
         document.getElementById('main-screen').classList.remove('hidden');
     }
 
+    // Consulta el progreso del trabajo hasta que termine, espaciando las consultas
+    // (1 s, 1.5 s, 2.25 s... hasta 10 s) para no agotar el límite de peticiones
+    async waitForJob(jobId, statusDiv) {
+        let delay = 1000;
+        while (true) {
+            await new Promise(resolve => setTimeout(resolve, delay));
+            delay = Math.min(delay * 1.5, 10000);
+
+            const response = await fetch(`/api/jobs/${jobId}`);
+            if (response.status === 429) {
+                // Límite alcanzado: esperar lo que indique el servidor y seguir consultando
+                const retryAfter = parseInt(response.headers.get('Retry-After'), 10);
+                delay = Math.max(delay, (retryAfter || 10) * 1000);
+                continue;
+            }
+            const data = await response.json();
+
+            if (!data.success) {
+                throw new Error(data.error || 'Error desconocido');
+            }
+            if (data.status === 'completado') {
+                return data;
+            }
+            if (data.status === 'error') {
+                return { success: false, error: data.error };
+            }
+
+            statusDiv.innerHTML = `⏳ Sincronizando... 📥 ${data.nuevas} nuevas · 🔄 ${data.duplicadas} duplicadas · ⚠️ ${data.errores} errores`;
+        }
+    }
+
     // --- NUEVA LÓGICA PARA EL BOTÓN DE SINCRONIZAR ---
     async processInvoices() {
         const btn = document.getElementById('btn-sync');
@@ -114,9 +145,14 @@ class GmailDownloader {
         statusDiv.innerHTML = "📡 Conectando con el servidor...";
 
         try {
-            // 2. Llamada al Backend
+            // 2. Llamada al Backend (encola la sincronización en segundo plano)
             const response = await fetch('/api/process-invoices', { method: 'POST' });
-            const data = await response.json();
+            const job = await response.json();
+            if (!job.success) {
+                throw new Error(job.error || 'Error desconocido');
+            }
+
+            const data = await this.waitForJob(job.job_id, statusDiv);
 
             // 3. Manejo de Respuesta
             if (data.success) {
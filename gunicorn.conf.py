@@ -0,0 +1,18 @@
+"""Configuración de gunicorn (se carga automáticamente desde el directorio de trabajo)"""
+import os
+import shutil
+
+
+def on_starting(server):
+    # Métricas de Prometheus compartidas entre workers: empezar con el directorio limpio
+    directory = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+
+
+def child_exit(server, worker):
+    # Quitar los archivos de métricas de los workers que terminan
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
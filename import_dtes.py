@@ -0,0 +1,49 @@
+"""Importa DTE en JSON desde disco (directorios o ZIP, sin extraerlos) sin pasar por Gmail.
+
+Uso: python import_dtes.py RUTA [RUTA ...] [--workers 8] [--batch-size 2000] [--batch-mb 8] [--files-per-task 200]
+Las facturas que ya existen se cuentan como duplicadas; se puede repetir sin riesgo.
+"""
+import argparse
+import sys
+import time
+
+from services.BulkImport import BulkImporter
+from services.container import db_service
+from services.Instrumentation import configure_logging
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', help='directorios, archivos .zip o archivos .json')
+    parser.add_argument('--workers', type=int, help='procesos de parseo (por defecto, uno por CPU)')
+    parser.add_argument('--batch-size', type=int, default=2000, help='facturas por transacción')
+    parser.add_argument('--batch-mb', type=int, default=8, help='MB de JSON por transacción (bajo max_allowed_packet)')
+    parser.add_argument('--files-per-task', type=int, default=200, help='archivos por tarea del pool')
+    args = parser.parse_args()
+
+    configure_logging()
+    print("Verificando base de datos...")
+    if not db_service.create_tables():
+        sys.exit(1)
+
+    last_report = time.monotonic()
+
+    def on_progress(results):
+        nonlocal last_report
+        if time.monotonic() - last_report >= 5:
+            last_report = time.monotonic()
+            print(f"  {results['archivos']} archivos ({results['archivos_por_segundo']}/s), "
+                  f"{results['nuevas']} nuevas", file=sys.stderr)
+
+    importer = BulkImporter(db_service, args.workers, args.batch_size, args.files_per_task, args.batch_mb * 1024 * 1024)
+    results = importer.run(args.paths, on_progress)
+
+    for detail in results['detalles']:
+        print(f"  ⚠️ {detail}")
+    print(f"✅ {results['archivos']} archivos en {results['segundos']}s "
+          f"({results['archivos_por_segundo']} archivos/s): {results['nuevas']} nuevas, "
+          f"{results['duplicadas']} duplicadas, {results['no_validos']} no válidos, {results['errores']} errores")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,86 @@
-from flask import Blueprint, jsonify, request, send_file
+from flask import Blueprint, jsonify, request, Response, stream_with_context
+import base64
+import hashlib
 import io
+import itertools
+import json
 import os
 import zipfile
-from services.container import gmail_service, db_service, invoice_processor
+from datetime import date
+from decimal import Decimal
+from services.InvoiceExport import EXPORT_CHUNK_SIZE, EXPORT_FORMATS, available_formats, export_invoices
+from services.extensions import limiter
+from services.container import (
+    gmail_service, db_service, job_queue, gmail_for_token, request_gmail_for_token,
+    search_cache, SEARCH_CACHE_TTL, MESSAGE_CACHE_TTL
+)
 
 api_bp = Blueprint('api', __name__)
 
+# Tamaño de los trozos que se escriben en el ZIP y se envían al cliente
+ZIP_CHUNK_SIZE = 64 * 1024
+
+
+# Nombres legibles de los tipos de DTE
+TIPOS_DTE = {
+    '01': 'Factura',
+    '03': 'Comprobante de Crédito Fiscal',
+    '04': 'Nota de Remisión',
+    '05': 'Nota de Crédito',
+    '06': 'Nota de Débito',
+    '07': 'Comprobante de Retención',
+    '08': 'Comprobante de Liquidación',
+    '09': 'Documento Contable de Liquidación',
+    '11': 'Factura de Exportación',
+    '14': 'Factura de Sujeto Excluido',
+    '15': 'Comprobante de Donación'
+}
+
+# Tamaño de página del listado de facturas (por defecto y máximo)
+INVOICES_PAGE_SIZE = 100
+INVOICES_MAX_PAGE_SIZE = 5000
+
+
+class _ZipStream(io.RawIOBase):
+    """Destino no buscable para zipfile: acumula lo escrito hasta que se vacía con pop()"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def _cache_user(token):
+    """Identificador de usuario para las claves de caché (sin guardar el token)"""
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()[:32]
+
+def _format_email(msg_id, msg_data):
+    """Correo en el formato que espera el frontend"""
+    headers = msg_data.get('payload', {}).get('headers', [])
+
+    def get_header(name):
+        return next((h['value'] for h in headers if h['name'] == name), 'Desconocido')
+
+    # Buscar adjuntos
+    parts = msg_data.get('payload', {}).get('parts', [])
+    return {
+        'id': msg_id,
+        'subject': get_header('Subject'),
+        'from': get_header('From'),
+        'date': get_header('Date'),
+        'snippet': msg_data.get('snippet', ''),
+        'attachments': gmail_service.find_attachments_recursive(msg_id, parts)
+    }
+
 @api_bp.route('/api/search', methods=['POST'])
 def search_emails():
     try:
@@ -14,42 +89,47 @@ def search_emails():
         if not token:
             return jsonify({'error': 'No autorizado'}), 401
         
-        gmail_service.build_service(token)
-        
         query = "has:attachment " + data.get('search', '')
+        user = _cache_user(token)
+
+        # 0. Misma búsqueda hace poco: respuesta directa desde caché
+        search_key = f"search:{user}:{query}"
+        cached = search_cache.get(search_key)
+        if cached is not None:
+            return jsonify({'success': True, 'emails': cached, 'total': len(cached)})
+
+        # Cliente propio de esta petición (no se modifica el gmail_service compartido)
+        gmail = request_gmail_for_token(token)
         
         # 1. Buscar IDs
-        messages = gmail_service.search_emails(query, max_results=20)
+        messages = gmail.search_emails(query, max_results=20)
         
         if not messages:
              return jsonify({'success': True, 'emails': [], 'total': 0})
 
-        # 2. Obtener detalles en lote
+        # 2. Reutilizar correos ya formateados por búsquedas anteriores
         message_ids = [msg['id'] for msg in messages]
-        messages_details = gmail_service.get_messages_batch(message_ids)
-        
-        # 3. Formatear para el frontend
-        formatted_emails = []
-        for msg_id, msg_data in messages_details.items():
-            if not msg_data: continue
-            
-            payload = msg_data.get('payload', {})
-            headers = payload.get('headers', [])
-            
-            def get_header(name):
-                return next((h['value'] for h in headers if h['name'] == name), 'Desconocido')
-                
-            # Buscar adjuntos
-            attachments = gmail_service.find_attachments_recursive(msg_id, payload.get('parts', []))
+        msg_keys = {msg_id: f"msg:{user}:{msg_id}" for msg_id in message_ids}
+        cached_msgs = search_cache.get_many(msg_keys.values())
+        formatted = {msg_id: cached_msgs[key] for msg_id, key in msg_keys.items() if key in cached_msgs}
+        missing_ids = [msg_id for msg_id in message_ids if msg_id not in formatted]
+
+        if missing_ids:
+            # 3. Obtener en lote la estructura de partes: ya trae cabeceras y snippet,
+            #    así cada correo se pide una sola vez (la búsqueda exige has:attachment)
+            messages_details = gmail.get_messages_batch(missing_ids)
             
-            formatted_emails.append({
-                'id': msg_id,
-                'subject': get_header('Subject'),
-                'from': get_header('From'),
-                'date': get_header('Date'),
-                'snippet': msg_data.get('snippet', ''),
-                'attachments': attachments
-            })
+            # 4. Formatear para el frontend
+            fetched = {}
+            for msg_id, msg_data in messages_details.items():
+                if not msg_data: continue
+                fetched[msg_id] = _format_email(msg_id, msg_data)
+            search_cache.set_many({msg_keys[msg_id]: email for msg_id, email in fetched.items()}, MESSAGE_CACHE_TTL)
+            formatted.update(fetched)
+
+        # Mantener el orden de la búsqueda de Gmail
+        formatted_emails = [formatted[msg_id] for msg_id in message_ids if msg_id in formatted]
+        search_cache.set(search_key, formatted_emails, SEARCH_CACHE_TTL)
             
         return jsonify({'success': True, 'emails': formatted_emails, 'total': len(formatted_emails)})
 
@@ -59,32 +139,48 @@ def search_emails():
 
 @api_bp.route('/api/process-invoices', methods=['POST'])
 def process_invoices():
+    """Encola una sincronización en segundo plano y devuelve el ID del trabajo"""
     try:
         token = request.cookies.get('gmail_token')
         if not token:
             return jsonify({'error': 'No autorizado'}), 401
         
-        gmail_service.build_service(token)
-        
-        # Importante: Usamos el connection context manager si es posible, o try/finally
-        if not db_service.connect():
-            return jsonify({'error': 'Error de base de datos'}), 500
-        
-        try:
-            results = invoice_processor.process_invoices()
-            return jsonify({
-                'success': True, 
-                'nuevas': results['nuevas'],
-                'duplicadas': results['duplicadas'],
-                'errores': results['errores'],
-                'detalles': results['detalles']
-            })
-        finally:
-            db_service.disconnect()
+        job_id = job_queue.submit(token)
+        return jsonify({'success': True, 'job_id': job_id}), 202
             
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@api_bp.route('/api/jobs/<job_id>', methods=['GET'])
+# El dashboard consulta el progreso en bucle: límite propio en lugar del
+# cupo general (50 por hora) de cada IP
+@limiter.limit("120 per minute", override_defaults=True)
+def job_status(job_id):
+    """Progreso de un trabajo de sincronización"""
+    try:
+        token = request.cookies.get('gmail_token')
+        if not token:
+            return jsonify({'error': 'No autorizado'}), 401
+
+        # Un trabajo de otro usuario se responde igual que uno inexistente
+        job = job_queue.get(job_id, token)
+        if not job:
+            return jsonify({'error': 'Trabajo no encontrado'}), 404
+
+        return jsonify({
+            'success': True,
+            'job_id': job['id'],
+            'status': job['status'],
+            'nuevas': job['nuevas'],
+            'duplicadas': job['duplicadas'],
+            'errores': job['errores'],
+            'detalles': job['resultado'],
+            'error': job['error']
+        })
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @api_bp.route('/api/dashboard-stats', methods=['GET'])
 def dashboard_stats():
     """Obtiene estadísticas para el dashboard"""
@@ -93,65 +189,237 @@ def dashboard_stats():
         if not token:
             return jsonify({'error': 'No autorizado'}), 401
         
-        # Conectar a la base de datos
-        if not db_service.connect():
-            return jsonify({'error': 'Error de base de datos'}), 500
+        stats = db_service.get_dashboard_stats()
+        if not stats:
+            return jsonify({'error': 'Error obteniendo estadísticas'}), 500
         
-        try:
-            stats = db_service.get_dashboard_stats()
-            if not stats:
-                return jsonify({'error': 'Error obteniendo estadísticas'}), 500
-            
-            # Mapear tipos de DTE a nombres legibles
-            tipo_dte_map = {
-                '01': 'Factura',
-                '03': 'Comprobante de Crédito Fiscal',
-                '04': 'Nota de Remisión',
-                '05': 'Nota de Crédito',
-                '06': 'Nota de Débito',
-                '07': 'Comprobante de Retención',
-                '08': 'Comprobante de Liquidación',
-                '09': 'Documento Contable de Liquidación',
-                '11': 'Factura de Exportación',
-                '14': 'Factura de Sujeto Excluido',
-                '15': 'Comprobante de Donación'
-            }
-            
-            # Formatear distribución por tipo
-            formatted_by_type = []
-            for item in stats['by_type']:
-                tipo_code = item['tipo_dte']
-                formatted_by_type.append({
-                    'tipo': tipo_dte_map.get(tipo_code, f'Tipo {tipo_code}'),
-                    'count': item['count']
-                })
-            
-            # Formatear actividad reciente
-            formatted_activity = []
-            for item in stats['recent_activity']:
-                tipo_code = item['tipo_dte']
-                formatted_activity.append({
-                    'codigo_generacion': item['codigo_generacion'],
-                    'fecha_emision': item['fecha_emision'],
-                    'nombre_emisor': item['nombre_emisor'],
-                    'total_pagar': float(item['total_pagar']),
-                    'tipo': tipo_dte_map.get(tipo_code, f'Tipo {tipo_code}')
-                })
-            
-            return jsonify({
-                'success': True,
-                'total_docs': stats['total_docs'],
-                'total_amount': stats['total_amount'],
-                'current_month_amount': stats['current_month_amount'],
-                'recurring_count': stats['recurring_count'],
-                'by_type': formatted_by_type,
-                'trends': stats['trends'],
-                'recent_activity': formatted_activity
+        # Mapear tipos de DTE a nombres legibles
+        tipo_dte_map = TIPOS_DTE
+        
+        # Formatear distribución por tipo
+        formatted_by_type = []
+        for item in stats['by_type']:
+            tipo_code = item['tipo_dte']
+            formatted_by_type.append({
+                'tipo': tipo_dte_map.get(tipo_code, f'Tipo {tipo_code}'),
+                'count': item['count']
             })
-            
-        finally:
-            db_service.disconnect()
+        
+        # Formatear actividad reciente
+        formatted_activity = []
+        for item in stats['recent_activity']:
+            tipo_code = item['tipo_dte']
+            formatted_activity.append({
+                'codigo_generacion': item['codigo_generacion'],
+                'fecha_emision': item['fecha_emision'],
+                'nombre_emisor': item['nombre_emisor'],
+                'total_pagar': float(item['total_pagar']),
+                'tipo': tipo_dte_map.get(tipo_code, f'Tipo {tipo_code}')
+            })
+        
+        return jsonify({
+            'success': True,
+            'total_docs': stats['total_docs'],
+            'total_amount': stats['total_amount'],
+            'current_month_amount': stats['current_month_amount'],
+            'recurring_count': stats['recurring_count'],
+            'by_type': formatted_by_type,
+            'trends': stats['trends'],
+            'recent_activity': formatted_activity
+        })
             
     except Exception as e:
         print(f"Error en dashboard-stats: {e}")
-        return jsonify({'error': str(e)}), 500
\ No newline at end of file
+        return jsonify({'error': str(e)}), 500
+
+def _invoice_filters_from_args(args):
+    """Filtros del listado/exportación a partir de la query string (ValueError si no son válidos)"""
+    tipos = [t.strip() for value in args.getlist('tipo') for t in value.split(',') if t.strip()]
+    filters = {
+        'desde': date.fromisoformat(args['desde']) if args.get('desde') else None,
+        'hasta': date.fromisoformat(args['hasta']) if args.get('hasta') else None,
+        'emisor': args.get('emisor', '').strip() or None,
+        'nit': args.get('nit', '').strip() or None,
+        'tipos': tipos,
+        'min_total': Decimal(args['min_total']) if args.get('min_total') else None,
+        'max_total': Decimal(args['max_total']) if args.get('max_total') else None,
+    }
+    for key in ('min_total', 'max_total'):
+        if filters[key] is not None and not filters[key].is_finite():
+            raise ValueError(f"{key} no es un número válido")
+    return filters
+
+def _encode_invoice_cursor(row):
+    """Cursor opaco con la clave (fecha_emision, id) de la última factura de la página"""
+    fecha = row['fecha_emision'].isoformat() if row['fecha_emision'] else None
+    return base64.urlsafe_b64encode(json.dumps([fecha, row['id']]).encode()).decode().rstrip('=')
+
+def _decode_invoice_cursor(cursor):
+    fecha, last_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    return (date.fromisoformat(fecha) if fecha else None), int(last_id)
+
+def _invoice_json(row):
+    return {
+        'codigo_generacion': row['codigo_generacion'],
+        'fecha_emision': row['fecha_emision'].isoformat() if row['fecha_emision'] else None,
+        'nombre_emisor': row['nombre_emisor'],
+        'emisor_nit': row['emisor_nit'],
+        'tipo_dte': row['tipo_dte'],
+        'tipo': TIPOS_DTE.get(row['tipo_dte'], f"Tipo {row['tipo_dte']}"),
+        'total_pagar': float(row['total_pagar']) if row['total_pagar'] is not None else None
+    }
+
+@api_bp.route('/api/invoices', methods=['GET'])
+def list_invoices():
+    """Lista las facturas guardadas con filtros y paginación por cursor.
+
+    Filtros: desde/hasta (AAAA-MM-DD), emisor (prefijo del nombre), nit, tipo
+    (repetible o separado por comas), min_total/max_total. `limit` filas por página
+    y `cursor` = `next_cursor` de la página anterior. La respuesta se envía en streaming.
+    """
+    try:
+        token = request.cookies.get('gmail_token')
+        if not token:
+            return jsonify({'error': 'No autorizado'}), 401
+
+        try:
+            filters = _invoice_filters_from_args(request.args)
+            limit = int(request.args.get('limit', INVOICES_PAGE_SIZE))
+            if not 1 <= limit <= INVOICES_MAX_PAGE_SIZE:
+                raise ValueError(f"limit debe estar entre 1 y {INVOICES_MAX_PAGE_SIZE}")
+            after = _decode_invoice_cursor(request.args['cursor']) if request.args.get('cursor') else None
+        except (ValueError, ArithmeticError, TypeError) as e:
+            return jsonify({'error': f'Parámetros no válidos: {e}'}), 400
+
+        # Una fila de más para saber si hay otra página
+        chunks = db_service.iter_invoices(filters, after=after, limit=limit + 1)
+        # Leer el primer lote antes de responder: los errores de BD aún pueden devolver 500
+        first = next(chunks, [])
+
+        def generate():
+            sent, last, has_more = 0, None, False
+            try:
+                yield '{"success": true, "invoices": ['
+                for rows in itertools.chain([first], chunks):
+                    has_more = has_more or sent + len(rows) > limit
+                    rows = rows[:limit - sent]
+                    if rows:
+                        yield (',' if sent else '') + ','.join(
+                            json.dumps(_invoice_json(row), ensure_ascii=False) for row in rows
+                        )
+                        sent += len(rows)
+                        last = rows[-1]
+            finally:
+                chunks.close()
+            next_cursor = _encode_invoice_cursor(last) if has_more else None
+            yield f'], "count": {sent}, "next_cursor": {json.dumps(next_cursor)}}}'
+
+        return Response(stream_with_context(generate()), mimetype='application/json')
+
+    except Exception as e:
+        print(f"Error en invoices: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@api_bp.route('/api/export', methods=['GET'])
+def export_invoices_file():
+    """Exporta las facturas (mismos filtros que /api/invoices) en CSV, XLSX o Parquet.
+
+    Las filas se leen de la BD por lotes y se codifican según llegan: la memoria
+    del worker no crece con el número de facturas.
+    """
+    try:
+        token = request.cookies.get('gmail_token')
+        if not token:
+            return jsonify({'error': 'No autorizado'}), 401
+
+        fmt = request.args.get('format', 'csv').lower()
+        if fmt not in available_formats():
+            return jsonify({'error': f"Formato no disponible. Opciones: {', '.join(available_formats())}"}), 400
+        try:
+            filters = _invoice_filters_from_args(request.args)
+        except (ValueError, ArithmeticError) as e:
+            return jsonify({'error': f'Parámetros no válidos: {e}'}), 400
+
+        chunks = db_service.iter_invoices(filters, chunk_size=EXPORT_CHUNK_SIZE)
+        # Leer el primer lote antes de responder: los errores de BD aún pueden devolver 500
+        first = next(chunks, [])
+
+        def generate():
+            try:
+                yield from export_invoices(itertools.chain([first] if first else [], chunks), fmt)
+            finally:
+                chunks.close()
+
+        mimetype, ext = EXPORT_FORMATS[fmt]
+        return Response(
+            stream_with_context(generate()),
+            mimetype=mimetype,
+            headers={'Content-Disposition': f'attachment; filename=facturas_{date.today():%Y%m%d}.{ext}'}
+        )
+
+    except Exception as e:
+        print(f"Error en export: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@api_bp.route('/api/download-batch', methods=['POST'])
+def download_batch():
+    """Genera un ZIP con los adjuntos seleccionados y lo envía en streaming"""
+    try:
+        token = request.cookies.get('gmail_token')
+        if not token:
+            return jsonify({'error': 'No autorizado'}), 401
+
+        data = request.json or {}
+        # Formato del dashboard: [{id, attachments: [{filename, attachmentId, partId}]}]
+        files = {}
+        targets = []
+        for email in data.get('emails', []):
+            for att in email.get('attachments', []):
+                if email.get('id') and att.get('attachmentId'):
+                    files[(email['id'], att['attachmentId'])] = att.get('filename') or 'adjunto'
+                    targets.append((email['id'], att['attachmentId'], att.get('partId')))
+
+        if not files:
+            return jsonify({'error': 'No hay adjuntos seleccionados'}), 400
+
+        # Servicio propio: el ZIP se sigue generando después de que termine la vista
+        gmail = gmail_for_token(token)
+
+        def generate():
+            stream = _ZipStream()
+            used_names = set()
+            errors = []
+            with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+                for msg_id, att_id, content, error in gmail.download_attachments(targets):
+                    filename = files[(msg_id, att_id)]
+                    if error:
+                        errors.append(f"{filename} ({msg_id}): {error}")
+                        continue
+
+                    # Evitar nombres repetidos dentro del ZIP
+                    name, ext = os.path.splitext(filename)
+                    unique, n = filename, 1
+                    while unique in used_names:
+                        unique = f"{name}_{n}{ext}"
+                        n += 1
+                    used_names.add(unique)
+
+                    with archive.open(unique, 'w') as dest:
+                        for i in range(0, len(content), ZIP_CHUNK_SIZE):
+                            dest.write(content[i:i + ZIP_CHUNK_SIZE])
+                            yield stream.pop()
+                    yield stream.pop()
+
+                if errors:
+                    archive.writestr('ERRORES.txt', '\n'.join(errors))
+            yield stream.pop()
+
+        return Response(
+            stream_with_context(generate()),
+            mimetype='application/zip',
+            headers={'Content-Disposition': 'attachment; filename=facturas_descargadas.zip'}
+        )
+
+    except Exception as e:
+        print(f"Error en download-batch: {e}")
+        return jsonify({'error': str(e)}), 500
@@ -1,5 +1,5 @@
 from flask import Blueprint, jsonify, request, make_response, redirect
-from services.container import gmail_service # Importamos del container
+from services.container import gmail_service, gmail_for_token, db_service # Importamos del container
 
 # Creamos el Blueprint
 auth_bp = Blueprint('auth', __name__)
@@ -17,7 +17,15 @@ def google_auth():
 def google_callback():
     try:
         code = request.args.get('code')
-        token = gmail_service.get_token(code)
+        token, refresh_token = gmail_service.get_tokens(code)
+
+        # Registrar la cuenta para la sincronización programada (scheduler.py)
+        if refresh_token:
+            try:
+                account = gmail_for_token(token).get_profile().get('emailAddress')
+                db_service.save_sync_account(account, refresh_token)
+            except Exception as e:
+                print(f"No se pudo registrar la cuenta para sincronización: {e}")
         
         resp = make_response(redirect(f"{FRONTEND_URL}/#auth_success"))
         resp.set_cookie('gmail_token', token, httponly=True, secure=True, samesite='Lax')
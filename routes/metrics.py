@@ -0,0 +1,16 @@
+import os
+from flask import Blueprint, Response, request
+from services.Instrumentation import metrics_payload
+
+metrics_bp = Blueprint('metrics', __name__)
+
+# Si se define, Prometheus debe enviar `Authorization: Bearer <METRICS_TOKEN>`
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+@metrics_bp.route('/metrics', methods=['GET'])
+def metrics():
+    """Métricas de la app en formato Prometheus"""
+    if METRICS_TOKEN and request.headers.get('Authorization') != f"Bearer {METRICS_TOKEN}":
+        return Response('No autorizado\n', status=401)
+    body, content_type = metrics_payload()
+    return Response(body, content_type=content_type)
@@ -0,0 +1,31 @@
+"""Sincronización programada de las cuentas registradas (proceso aparte de la web).
+
+Las cuentas se registran al iniciar sesión con Google (se guarda su refresh token).
+Uso: python scheduler.py
+"""
+import os
+import signal
+
+from services.container import db_service, gmail_service, processor_for_token, gmail_runner, GMAIL_ASYNC
+from services.Instrumentation import configure_logging
+from services.SyncScheduler import SyncScheduler
+
+scheduler = SyncScheduler(
+    db_service,
+    processor_for_token,
+    gmail_service.refresh_access_token,
+    interval=int(os.getenv('SYNC_INTERVAL', '900')),
+    max_workers=int(os.getenv('SCHEDULER_WORKERS', '4')),
+    jitter=float(os.getenv('SYNC_JITTER', '0.2')),
+    runner=gmail_runner if GMAIL_ASYNC else None
+)
+
+if __name__ == '__main__':
+    configure_logging()
+    print("Verificando base de datos...")
+    db_service.create_tables()
+
+    # Terminar ordenadamente con docker stop / Ctrl+C
+    signal.signal(signal.SIGTERM, lambda *_: scheduler.stop())
+    signal.signal(signal.SIGINT, lambda *_: scheduler.stop())
+    scheduler.run_forever()
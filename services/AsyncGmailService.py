@@ -0,0 +1,313 @@
+import asyncio
+import base64
+import json
+import logging
+import os
+import random
+import threading
+import aiohttp
+import httplib2
+from googleapiclient.errors import HttpError
+from .GmailService import (
+    GmailService, STRUCTURE_FIELDS, _is_retryable, _retry_reason
+)
+from .Instrumentation import GMAIL_CALLS, GMAIL_RETRIES
+
+logger = logging.getLogger(__name__)
+
+# Raíz de la API de Gmail (se cambia para probar contra un servidor falso)
+GMAIL_ROOT_URL = 'https://gmail.googleapis.com/'
+
+
+def _params(**kwargs):
+    """Parámetros de consulta sin los None; las listas se repiten (metadataHeaders=..)"""
+    params = []
+    for key, value in kwargs.items():
+        if value is None:
+            continue
+        for item in value if isinstance(value, (list, tuple)) else [value]:
+            params.append((key, str(item)))
+    return params
+
+
+class AsyncGmailTransport:
+    """Sesión HTTP asíncrona compartida por todas las cuentas de un proceso.
+
+    Reutiliza conexiones (keep-alive) entre peticiones y cuentas, y un semáforo
+    limita las peticiones en curso. Reintenta con backoff exponencial los
+    errores transitorios (cuota, 5xx, red); los errores HTTP se lanzan como
+    HttpError para que el código existente los trate igual que en la vía síncrona.
+    La sesión pertenece al loop en que se creó: usar siempre el mismo loop.
+    """
+
+    def __init__(self, root_url=GMAIL_ROOT_URL, max_concurrency=32, max_retries=5, timeout=60):
+        self.base_url = root_url.rstrip('/') + '/gmail/v1/users/me'
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self._session = None
+        self._semaphore = None
+        self._loop = None
+
+    def _ensure_session(self):
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency, ttl_dns_cache=300),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return self._session
+
+    async def request(self, token, path, params=None):
+        """GET autenticado a `base_url + path`; devuelve el JSON de la respuesta"""
+        session = self._ensure_session()
+        delay = 0.5
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self._semaphore:
+                    async with session.get(
+                        self.base_url + path, params=params,
+                        headers={'Authorization': f'Bearer {token}'}
+                    ) as resp:
+                        body = await resp.read()
+                        if resp.status < 300:
+                            return json.loads(body)
+                        error = HttpError(
+                            httplib2.Response({'status': resp.status, 'reason': resp.reason}), body, uri=str(resp.url)
+                        )
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+
+            if attempt == self.max_retries or not _is_retryable(error):
+                raise error
+            GMAIL_RETRIES.labels(_retry_reason(error)).inc()
+            # Jitter para que las corrutinas no reintenten todas a la vez
+            await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+            delay = min(delay * 2, 32)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+class AsyncGmailService:
+    """Cliente asyncio de Gmail para una cuenta, con la misma interfaz que GmailService.
+
+    Los métodos que hablan con Gmail son corrutinas (los iteradores de páginas y
+    de descargas son generadores asíncronos); los que solo recorren la estructura
+    de un mensaje son los mismos de GmailService.
+    """
+
+    def __init__(self, transport, token, cache=None):
+        self.transport = transport
+        self.token = token
+        # AttachmentCache opcional compartido con la vía síncrona
+        self.cache = cache
+
+    find_attachments_recursive = GmailService.find_attachments_recursive
+    find_json_part = GmailService.find_json_part
+    find_json_attachment_id = GmailService.find_json_attachment_id
+    parse_json_attachment = GmailService.parse_json_attachment
+
+    async def _get(self, method, path, **params):
+        GMAIL_CALLS.labels(method).inc()
+        return await self.transport.request(self.token, path, _params(**params))
+
+    async def search_emails(self, query, max_results=20):
+        """Busca emails con query específica"""
+        results = await self._get('messages.list', '/messages', q=query, maxResults=max_results)
+        return results.get('messages', [])
+
+    async def get_profile(self):
+        """Obtiene el perfil de la cuenta (emailAddress, historyId actual)"""
+        return await self._get('getProfile', '/profile')
+
+    async def iter_message_ids(self, query, page_size=500, max_results=None, page_token=None):
+        """Genera páginas `(ids, next_page_token)`, igual que GmailService.iter_message_ids"""
+        total = 0
+        while True:
+            if max_results is not None:
+                page_size = min(page_size, max_results - total)
+                if page_size <= 0:
+                    return
+
+            results = await self._get('messages.list', '/messages', q=query, maxResults=page_size, pageToken=page_token)
+
+            ids = [msg['id'] for msg in results.get('messages', [])]
+            page_token = results.get('nextPageToken')
+            if ids:
+                total += len(ids)
+                yield ids, page_token
+
+            if not page_token:
+                return
+
+    async def iter_history_message_ids(self, start_history_id, page_size=500, max_results=None, page_token=None):
+        """Genera páginas `(ids, next_page_token)` de mensajes añadidos desde `start_history_id`.
+
+        Lanza HttpError 404 si el historyId ya expiró en Gmail.
+        """
+        seen = set()
+        total = 0
+        while True:
+            results = await self._get(
+                'history.list', '/history', startHistoryId=start_history_id, historyTypes='messageAdded',
+                maxResults=page_size, pageToken=page_token
+            )
+
+            ids = []
+            for record in results.get('history', []):
+                for added in record.get('messagesAdded', []):
+                    msg = added.get('message', {})
+                    # Los borradores y enviados no son facturas recibidas
+                    if set(msg.get('labelIds', [])) & {'DRAFT', 'SENT'}:
+                        continue
+                    if msg.get('id') and msg['id'] not in seen:
+                        seen.add(msg['id'])
+                        ids.append(msg['id'])
+
+            if max_results is not None:
+                ids = ids[:max_results - total]
+            page_token = results.get('nextPageToken')
+            if ids:
+                total += len(ids)
+                yield ids, page_token
+            if max_results is not None and total >= max_results:
+                return
+
+            if not page_token:
+                return
+
+    async def get_message_details(self, message_id):
+        """Obtiene cabeceras y estructura de partes de un mensaje"""
+        return await self._get('messages.get', f'/messages/{message_id}', format='full', fields=STRUCTURE_FIELDS)
+
+    async def get_messages_batch(self, message_ids, failed=None, **_):
+        """Obtiene varios mensajes en paralelo; devuelve {id: mensaje} sin los que fallaron.
+
+        En lugar del endpoint batch se lanzan peticiones individuales sobre
+        conexiones reutilizadas; el semáforo del transporte acota la concurrencia
+        y los reintentos por cuota se hacen por mensaje. Como en GmailService,
+        los fallidos (salvo 404) se añaden a `failed` si se pasa.
+        """
+        async def fetch(msg_id):
+            try:
+                return msg_id, await self.get_message_details(msg_id)
+            except HttpError as e:
+                if e.resp.status == 404:
+                    logger.info("Mensaje %s ya no existe", msg_id)
+                    return msg_id, None
+                error = e
+            except Exception as e:
+                error = e
+            logger.error("Error en batch para %s: %s", msg_id, error)
+            if failed is not None:
+                failed[msg_id] = str(error)
+            return msg_id, None
+
+        results = await asyncio.gather(*(fetch(msg_id) for msg_id in message_ids))
+        return {msg_id: data for msg_id, data in results if data is not None}
+
+    async def get_attachment(self, message_id, attachment_id, part_id=None):
+        """Descarga un archivo adjunto (o lo lee de la caché local), como GmailService.get_attachment"""
+        key = f"{message_id}/{part_id if part_id is not None else attachment_id}"
+        if self.cache:
+            cached = await asyncio.to_thread(self.cache.get, key)
+            if cached is not None:
+                return cached
+
+        data = await self._get('attachments.get', f'/messages/{message_id}/attachments/{attachment_id}')
+        content = base64.urlsafe_b64decode(data['data'].encode('UTF-8'))
+
+        if self.cache:
+            try:
+                await asyncio.to_thread(self.cache.put, key, content)
+            except OSError as e:
+                logger.warning("No se pudo guardar el adjunto en caché: %s", e)
+        return content
+
+    async def download_attachments(self, attachments, max_workers=8):
+        """Descarga adjuntos con como mucho `max_workers` en curso.
+
+        Recibe tuplas `(message_id, attachment_id[, part_id])` y genera
+        `(message_id, attachment_id, datos, error)` según va terminando cada descarga.
+        """
+        attachments = iter(attachments)
+        in_flight = {}
+
+        def submit_next():
+            for item in attachments:
+                message_id, attachment_id = item[0], item[1]
+                part_id = item[2] if len(item) > 2 else None
+                task = asyncio.ensure_future(self.get_attachment(message_id, attachment_id, part_id))
+                in_flight[task] = (message_id, attachment_id)
+                return
+
+        for _ in range(max_workers):
+            submit_next()
+
+        try:
+            while in_flight:
+                done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    message_id, attachment_id = in_flight.pop(task)
+                    submit_next()
+                    if task.exception() is not None:
+                        yield message_id, attachment_id, None, task.exception()
+                    else:
+                        yield message_id, attachment_id, task.result(), None
+        finally:
+            for task in in_flight:
+                task.cancel()
+
+
+class AsyncLoopRunner:
+    """Loop de asyncio en un hilo propio, para usar la vía asíncrona desde código síncrono.
+
+    Todas las cuentas comparten el loop (y con él el transporte y sus conexiones).
+    Se comprueba el PID porque gunicorn puede hacer fork después de importar la app.
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def loop(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name='gmail-async', daemon=True).start()
+            return self._loop
+
+    def submit(self, coro):
+        """Programa la corrutina en el loop; devuelve un concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop())
+
+    def run(self, coro, timeout=None):
+        """Ejecuta la corrutina en el loop y espera su resultado"""
+        return self.submit(coro).result(timeout)
+
+
+class BlockingGmail:
+    """Vista síncrona de un AsyncGmailService: cada corrutina se ejecuta en el runner.
+
+    Sirve para rutas de Flask que esperan la interfaz de GmailService
+    (no cubre los generadores asíncronos).
+    """
+
+    def __init__(self, service, runner):
+        self.service = service
+        self.runner = runner
+
+    def __getattr__(self, name):
+        attr = getattr(self.service, name)
+        if not asyncio.iscoroutinefunction(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            return self.runner.run(attr(*args, **kwargs))
+        return call
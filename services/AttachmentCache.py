@@ -0,0 +1,143 @@
+import hashlib
+import mmap
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+
+class AttachmentCache:
+    """Caché en disco de adjuntos de Gmail, direccionada por contenido.
+
+    Los datos se guardan una sola vez por hash SHA-256 (`blobs/ab/abcd...`) y un
+    índice SQLite relaciona cada clave (mensaje + parte/adjunto) con su hash.
+    Al superar `max_bytes` se expulsan las entradas usadas hace más tiempo (LRU);
+    los bytes guardados se llevan en un contador del índice para no sumar la
+    tabla en cada escritura.
+    El índice en SQLite permite compartir la caché entre workers de gunicorn.
+    Los adjuntos grandes se leen con mmap para no copiarlos en memoria.
+    """
+
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024, mmap_threshold=1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.mmap_threshold = mmap_threshold
+        self._local = threading.local()
+        os.makedirs(os.path.join(directory, 'blobs'), exist_ok=True)
+        with self._db() as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    digest TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            """)
+            db.execute("CREATE INDEX IF NOT EXISTS idx_entries_access ON entries (last_access)")
+            db.execute("CREATE INDEX IF NOT EXISTS idx_entries_digest ON entries (digest)")
+            # Bytes de los blobs guardados (cada hash una vez); se calcula solo al crearlo
+            db.execute("CREATE TABLE IF NOT EXISTS usage (id INTEGER PRIMARY KEY CHECK (id = 1), bytes INTEGER NOT NULL)")
+            db.execute("""
+                INSERT OR IGNORE INTO usage (id, bytes)
+                SELECT 1, COALESCE(SUM(size), 0) FROM (SELECT MAX(size) AS size FROM entries GROUP BY digest)
+            """)
+
+    def _db(self):
+        # Una conexión por hilo (y por proceso tras un fork)
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.pid = os.getpid()
+            local.db = sqlite3.connect(os.path.join(self.directory, 'index.sqlite'), timeout=10)
+            local.db.execute("PRAGMA journal_mode=WAL")
+            local.db.execute("PRAGMA synchronous=NORMAL")
+        return local.db
+
+    def _blob_path(self, digest):
+        return os.path.join(self.directory, 'blobs', digest[:2], digest)
+
+    def get(self, key):
+        """Devuelve el contenido (bytes, o mmap si es grande) o None si no está"""
+        db = self._db()
+        row = db.execute("SELECT digest, size FROM entries WHERE key = ?", (key,)).fetchone()
+        if not row:
+            return None
+        digest, size = row
+        try:
+            with open(self._blob_path(digest), 'rb') as f:
+                if size >= self.mmap_threshold:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                else:
+                    data = f.read()
+        except FileNotFoundError:
+            # Otro proceso lo expulsó entre la consulta y la lectura
+            with db:
+                db.execute("BEGIN IMMEDIATE")
+                db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                if not self._digest_in_use(db, digest):
+                    db.execute("UPDATE usage SET bytes = MAX(bytes - ?, 0) WHERE id = 1", (size,))
+            return None
+        with db:
+            db.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+        return data
+
+    def put(self, key, data):
+        """Guarda el contenido bajo `key` y expulsa lo más antiguo si hace falta"""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Escritura atómica: nunca se lee un blob a medio escribir
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+        db = self._db()
+        removed = []
+        with db:
+            # Transacción de escritura desde el principio: el contador no puede
+            # contar dos veces el mismo blob nuevo desde dos procesos
+            db.execute("BEGIN IMMEDIATE")
+            previous = db.execute("SELECT digest, size FROM entries WHERE key = ?", (key,)).fetchone()
+            added = 0 if self._digest_in_use(db, digest) else len(data)
+            db.execute(
+                "INSERT OR REPLACE INTO entries (key, digest, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, digest, len(data), time.time())
+            )
+            if previous and previous[0] != digest and not self._digest_in_use(db, previous[0]):
+                # La clave apuntaba a otro contenido que ya nadie usa
+                added -= previous[1]
+                removed.append(previous[0])
+            db.execute("UPDATE usage SET bytes = MAX(bytes + ?, 0) WHERE id = 1", (added,))
+            total = db.execute("SELECT bytes FROM usage WHERE id = 1").fetchone()[0]
+            if total > self.max_bytes:
+                removed.extend(self._evict(db, total))
+        self._remove_blobs(removed)
+
+    def _digest_in_use(self, db, digest):
+        return db.execute("SELECT 1 FROM entries WHERE digest = ? LIMIT 1", (digest,)).fetchone() is not None
+
+    def _evict(self, db, total):
+        """Expulsa lo usado hace más tiempo hasta bajar de max_bytes (dentro de la transacción de put)"""
+        removed = []
+        freed = 0
+        for key, digest, size in db.execute(
+            "SELECT key, digest, size FROM entries ORDER BY last_access"
+        ).fetchall():
+            if total - freed <= self.max_bytes:
+                break
+            db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            # El blob solo se borra cuando ninguna otra clave apunta a él
+            if not self._digest_in_use(db, digest):
+                removed.append(digest)
+                freed += size
+        db.execute("UPDATE usage SET bytes = MAX(bytes - ?, 0) WHERE id = 1", (freed,))
+        return removed
+
+    def _remove_blobs(self, removed):
+        for digest in removed:
+            try:
+                os.remove(self._blob_path(digest))
+            except FileNotFoundError:
+                pass
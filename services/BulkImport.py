@@ -0,0 +1,225 @@
+import itertools
+import logging
+import os
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import mysql.connector
+
+from .DteParser import DteValidationError, decode_json, validate_dte
+from .InvoiceProcessor import InvoiceProcessor
+
+logger = logging.getLogger(__name__)
+
+# Errores que se guardan como ejemplo en el resultado (el resto solo se cuentan)
+MAX_ERROR_DETAILS = 100
+
+# Bytes de JSON por transacción: muy por debajo del max_allowed_packet por defecto (16 MB)
+BATCH_BYTES = 8 * 1024 * 1024
+
+# Sentencia mayor que max_allowed_packet: el servidor la rechaza (1153) o corta la conexión
+PACKET_ERRNOS = (1153, 2006, 2013, 2055)
+
+
+def _parse_files(task):
+    """Lee y parsea un grupo de archivos JSON (se ejecuta en un proceso del pool).
+
+    `task` es `(zip o None, nombres)`: los miembros de un ZIP se leen sin
+    extraerlo. Devuelve `(facturas, no_validos, errores)`, con las dos últimas
+    como listas de `(nombre, mensaje)`.
+    """
+    archive_path, names = task
+    extractor = InvoiceProcessor(None, None)
+    invoices, invalid, errors = [], [], []
+    archive = zipfile.ZipFile(archive_path) if archive_path else None
+    try:
+        for name in names:
+            label = f"{archive_path}:{name}" if archive_path else name
+            try:
+                if archive:
+                    raw = archive.read(name)
+                else:
+                    with open(name, 'rb') as f:
+                        raw = f.read()
+            except (OSError, zipfile.BadZipFile) as e:
+                errors.append((label, str(e)))
+                continue
+            try:
+                # Misma validación que la sincronización desde Gmail
+                data = decode_json(raw)
+                validate_dte(data)
+            except DteValidationError as e:
+                invalid.append((label, f"DTE NO VÁLIDO ({e})"))
+                continue
+            except ValueError:
+                invalid.append((label, "SIN JSON VÁLIDO"))
+                continue
+            except Exception as e:
+                errors.append((label, f"ERROR ({type(e).__name__}: {e})"))
+                continue
+            try:
+                invoice = extractor._extract_invoice_data(data)
+            except Exception as e:
+                # Un archivo raro no debe abortar la importación: se cuenta y se sigue
+                errors.append((label, f"ERROR ({type(e).__name__}: {e})"))
+                continue
+            invoice['raw'] = raw
+            invoice['archivo'] = label
+            invoices.append(invoice)
+    finally:
+        if archive:
+            archive.close()
+    return invoices, invalid, errors
+
+
+class BulkImporter:
+    """Carga masiva de DTE en JSON desde directorios y archivos ZIP.
+
+    Los archivos se parsean en un pool de procesos por grupos de
+    `files_per_task`, y las facturas se guardan con save_invoices_batch en
+    transacciones de hasta `batch_size` facturas y `batch_bytes` de JSON.
+    Mientras se guarda un lote, el pool sigue parseando los siguientes; como
+    mucho hay `2 * workers` grupos en vuelo, así la memoria no depende del
+    número de archivos (los repetidos entre lotes los descarta la BD).
+    """
+
+    def __init__(self, database_service, workers=None, batch_size=2000, files_per_task=200, batch_bytes=BATCH_BYTES):
+        self.db = database_service
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.files_per_task = files_per_task
+        self.results = None
+
+    def run(self, paths, on_progress=None):
+        """Importa los JSON de `paths` (directorios, ZIP o archivos sueltos) y devuelve el resumen"""
+        self.results = {
+            'archivos': 0, 'nuevas': 0, 'duplicadas': 0, 'no_validos': 0, 'errores': 0,
+            'segundos': 0.0, 'archivos_por_segundo': 0.0, 'detalles': []
+        }
+        started = time.perf_counter()
+        # Códigos del lote en curso: un lote no puede llevar el mismo DTE dos veces
+        seen = set()
+        pending = []
+        pending_bytes = 0
+        tasks = self._tasks(paths)
+
+        with ProcessPoolExecutor(self.workers) as pool:
+            in_flight = deque(pool.submit(_parse_files, task) for task in itertools.islice(tasks, 2 * self.workers))
+            while in_flight:
+                invoices, invalid, errors = in_flight.popleft().result()
+                for task in itertools.islice(tasks, 1):
+                    in_flight.append(pool.submit(_parse_files, task))
+
+                self.results['archivos'] += len(invoices) + len(invalid) + len(errors)
+                self.results['no_validos'] += len(invalid)
+                self.results['errores'] += len(errors)
+                self._add_details(invalid + errors)
+
+                for invoice in invoices:
+                    # El mismo DTE puede estar repetido en el lote de archivos
+                    if invoice['codigo_generacion'] in seen:
+                        self.results['duplicadas'] += 1
+                        continue
+                    seen.add(invoice['codigo_generacion'])
+                    pending.append(invoice)
+                    pending_bytes += len(invoice['raw'])
+                    if len(pending) >= self.batch_size or pending_bytes >= self.batch_bytes:
+                        self._persist(pending)
+                        pending, pending_bytes = [], 0
+                        seen.clear()
+
+                if on_progress:
+                    on_progress(self._finish(started))
+
+        self._persist(pending)
+        return self._finish(started)
+
+    def _finish(self, started):
+        elapsed = time.perf_counter() - started
+        self.results['segundos'] = round(elapsed, 2)
+        self.results['archivos_por_segundo'] = round(self.results['archivos'] / elapsed, 1) if elapsed else 0.0
+        return self.results
+
+    def _add_details(self, entries):
+        room = MAX_ERROR_DETAILS - len(self.results['detalles'])
+        self.results['detalles'].extend(f"{label} - {message}" for label, message in entries[:max(room, 0)])
+
+    def _tasks(self, paths):
+        """Genera los grupos `(zip o None, nombres)` de archivos JSON a parsear"""
+        for path in paths:
+            if os.path.isdir(path):
+                group = []
+                for root, dirs, files in os.walk(path):
+                    dirs.sort()
+                    for name in sorted(files):
+                        full_path = os.path.join(root, name)
+                        if name.lower().endswith('.zip'):
+                            yield from self._zip_tasks(full_path)
+                        elif name.lower().endswith('.json'):
+                            group.append(full_path)
+                            if len(group) >= self.files_per_task:
+                                yield None, group
+                                group = []
+                if group:
+                    yield None, group
+            elif path.lower().endswith('.zip'):
+                yield from self._zip_tasks(path)
+            else:
+                yield None, [path]
+
+    def _zip_tasks(self, path):
+        try:
+            with zipfile.ZipFile(path) as archive:
+                names = [info.filename for info in archive.infolist()
+                         if not info.is_dir() and info.filename.lower().endswith('.json')]
+        except (OSError, zipfile.BadZipFile) as e:
+            logger.warning("No se pudo leer el ZIP %s: %s", path, e)
+            self.results['errores'] += 1
+            self._add_details([(path, str(e))])
+            return
+        for i in range(0, len(names), self.files_per_task):
+            yield path, names[i:i + self.files_per_task]
+
+    def _persist(self, batch):
+        """Guarda un lote en una transacción (misma ruta que la sincronización).
+
+        Si el lote falla por una factura concreta, se guardan de una en una para
+        no perder las demás y anotar el archivo de cada fallo.
+        """
+        if not batch:
+            return
+        try:
+            self._save(batch)
+            return
+        except (mysql.connector.InterfaceError, mysql.connector.OperationalError) as err:
+            if err.errno in PACKET_ERRNOS and len(batch) > 1:
+                # Lote demasiado grande para un paquete: se guarda en dos mitades
+                logger.warning("Lote de %d facturas demasiado grande, se divide: %s", len(batch), err)
+                half = len(batch) // 2
+                self._persist(batch[:half])
+                self._persist(batch[half:])
+                return
+            # Conexión o servidor caídos: de una en una fallaría igual
+            logger.error("Error guardando %d facturas: %s", len(batch), err)
+            self.results['errores'] += len(batch)
+            self._add_details([(f"{len(batch)} facturas", f"ERROR BD: {err}")])
+            return
+        except mysql.connector.Error as err:
+            logger.warning("Error guardando %d facturas, se guardan de una en una: %s", len(batch), err)
+
+        for invoice in batch:
+            try:
+                self._save([invoice])
+            except mysql.connector.Error as err:
+                logger.error("Error guardando %s: %s", invoice.get('archivo'), err)
+                self.results['errores'] += 1
+                self._add_details([(invoice.get('archivo') or invoice['codigo_generacion'], f"ERROR BD: {err}")])
+
+    def _save(self, batch):
+        self.db.resolve_emisor_ids(batch)
+        insertados, duplicados = self.db.save_invoices_batch(batch)
+        self.results['nuevas'] += len(insertados)
+        self.results['duplicadas'] += len(duplicados)
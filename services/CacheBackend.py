@@ -0,0 +1,281 @@
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from limits.storage import Storage
+
+
+class MemoryCacheBackend:
+    """Caché clave-valor en memoria del proceso, con TTL por entrada y expulsión LRU.
+
+    Define la interfaz que usan las cachés de la app (get/set/get_many/set_many/delete);
+    cualquier backend compartido entre workers debe implementar los mismos métodos.
+    Los valores deben ser serializables a JSON para que los backends sean intercambiables.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._data = OrderedDict()  # clave -> (expira_en, valor)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def get_many(self, keys):
+        """Devuelve {clave: valor} solo con las claves presentes y vigentes"""
+        found = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    def set(self, key, value, ttl):
+        self.set_many({key: value}, ttl)
+
+    def set_many(self, items, ttl):
+        expires_at = time.monotonic() + ttl
+        with self._lock:
+            for key, value in items.items():
+                self._data[key] = (expires_at, value)
+                self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+class SqliteStateStore:
+    """Archivo SQLite compartido por los workers de gunicorn de una misma máquina.
+
+    Guarda contadores atómicos (para el rate limiting) y entradas de caché.
+    Cada operación es una sola sentencia, así que no hace falta bloqueo propio.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        db = self.db()
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS counters (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        """)
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        """)
+        db.execute("CREATE INDEX IF NOT EXISTS idx_cache_expires ON cache (expires_at)")
+
+    def db(self):
+        # Una conexión por hilo (y por proceso tras un fork), en autocommit
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.pid = os.getpid()
+            local.db = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            local.db.execute("PRAGMA journal_mode=WAL")
+            local.db.execute("PRAGMA synchronous=NORMAL")
+        return local.db
+
+    def incr(self, key, expiry, amount=1):
+        """Suma `amount` al contador; si expiró, lo reinicia con una ventana nueva"""
+        now = time.time()
+        row = self.db().execute("""
+            INSERT INTO counters (key, value, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET
+                value = CASE WHEN expires_at <= ? THEN excluded.value ELSE value + excluded.value END,
+                expires_at = CASE WHEN expires_at <= ? THEN excluded.expires_at ELSE expires_at END
+            RETURNING value
+        """, (key, amount, now + expiry, now, now)).fetchone()
+        return row[0]
+
+    def counter(self, key):
+        """(valor, expira_en) del contador, o (0, ahora) si no existe o expiró"""
+        now = time.time()
+        row = self.db().execute(
+            "SELECT value, expires_at FROM counters WHERE key = ? AND expires_at > ?", (key, now)
+        ).fetchone()
+        return row if row else (0, now)
+
+    def clear_counter(self, key=None):
+        if key is None:
+            return self.db().execute("DELETE FROM counters").rowcount
+        self.db().execute("DELETE FROM counters WHERE key = ?", (key,))
+
+
+class SqliteCacheBackend:
+    """Caché compartida entre workers sobre SqliteStateStore (misma interfaz que MemoryCacheBackend).
+
+    Al superar `max_entries` se expulsan primero las entradas expiradas y luego
+    las que vencen antes (las escritas hace más tiempo), sin escribir en cada lectura.
+    """
+
+    def __init__(self, store, max_entries=10000):
+        self.store = store
+        self.max_entries = max_entries
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        placeholders = ', '.join(['?'] * len(keys))
+        rows = self.store.db().execute(
+            f"SELECT key, value FROM cache WHERE key IN ({placeholders}) AND expires_at > ?",
+            keys + [time.time()]
+        ).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def set(self, key, value, ttl):
+        self.set_many({key: value}, ttl)
+
+    def set_many(self, items, ttl):
+        if not items:
+            return
+        db = self.store.db()
+        expires_at = time.time() + ttl
+        db.executemany(
+            "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+            [(key, json.dumps(value), expires_at) for key, value in items.items()]
+        )
+        # Poda ocasional para no contar filas en cada escritura
+        if random.random() < 0.05:
+            db.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+            db.execute("""
+                DELETE FROM cache WHERE key IN (
+                    SELECT key FROM cache ORDER BY expires_at
+                    LIMIT MAX(0, (SELECT COUNT(*) FROM cache) - ?)
+                )
+            """, (self.max_entries,))
+
+    def delete(self, key):
+        self.store.db().execute("DELETE FROM cache WHERE key = ?", (key,))
+
+
+class RedisCacheBackend:
+    """Caché compartida en un servidor compatible con Redis (misma interfaz que MemoryCacheBackend).
+
+    `client` permite inyectar un cliente ya creado (por ejemplo un sustituto local).
+    La expulsión LRU la hace el propio servidor (maxmemory-policy allkeys-lru).
+    """
+
+    def __init__(self, url=None, client=None, prefix='facturaflow:'):
+        if client is None:
+            import redis  # Dependencia opcional: solo se necesita con SHARED_STATE_URI=redis://
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        values = self.client.mget([self.prefix + key for key in keys])
+        return {key: json.loads(value) for key, value in zip(keys, values) if value is not None}
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, json.dumps(value), ex=ttl)
+
+    def set_many(self, items, ttl):
+        pipe = self.client.pipeline(transaction=False)
+        for key, value in items.items():
+            pipe.set(self.prefix + key, json.dumps(value), ex=ttl)
+        pipe.execute()
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+
+class SqliteLimiterStorage(Storage):
+    """Almacenamiento de flask-limiter sobre SqliteStateStore (`storage_uri='sqlite:///ruta'`).
+
+    Al definirse la clase queda registrada en `limits` para el esquema sqlite://,
+    así todos los workers comparten los mismos contadores.
+    """
+
+    STORAGE_SCHEME = ['sqlite']
+
+    def __init__(self, uri=None, wrap_exceptions=False, **options):
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+        self.store = shared_store(sqlite_path(uri))
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    def incr(self, key, expiry, amount=1):
+        return self.store.incr(key, expiry, amount)
+
+    def get(self, key):
+        return self.store.counter(key)[0]
+
+    def get_expiry(self, key):
+        return self.store.counter(key)[1]
+
+    def check(self):
+        try:
+            self.store.db().execute("SELECT 1")
+            return True
+        except sqlite3.Error:
+            return False
+
+    def reset(self):
+        return self.store.clear_counter()
+
+    def clear(self, key):
+        self.store.clear_counter(key)
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def sqlite_path(uri):
+    """'sqlite:///cache/estado.sqlite' -> 'cache/estado.sqlite'"""
+    return uri[len('sqlite:///'):]
+
+
+def shared_store(path):
+    """Un SqliteStateStore por archivo y proceso"""
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = SqliteStateStore(path)
+        return _stores[path]
+
+
+def create_cache_backend(uri, max_entries=10000):
+    """Crea el backend de caché según la URI: memory://, sqlite:///ruta o redis://..."""
+    if uri.startswith('sqlite:///'):
+        return SqliteCacheBackend(shared_store(sqlite_path(uri)), max_entries=max_entries)
+    if uri.startswith(('redis://', 'rediss://')):
+        return RedisCacheBackend(uri)
+    return MemoryCacheBackend(max_entries=max_entries)
@@ -1,188 +1,1377 @@
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+import zlib
+from collections import deque, defaultdict
+from decimal import Decimal
+from contextlib import contextmanager
+
 import mysql.connector
+from mysql.connector.errors import PoolError
+
+from .Instrumentation import STAGE_SECONDS
+
+
+class ConnectionPool:
+    """Pool acotado y thread-safe de conexiones MariaDB.
+
+    Las conexiones se reutilizan entre peticiones (checkout/return), se
+    verifican con ping si llevan tiempo inactivas y se reciclan al superar
+    su tiempo de vida máximo.
+    """
+
+    def __init__(self, factory, max_size=10, max_lifetime=1800, ping_interval=30, acquire_timeout=10):
+        self.factory = factory
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.ping_interval = ping_interval
+        self.acquire_timeout = acquire_timeout
+        self._cond = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        # Se llama al crear el pool y tras un fork (gunicorn), donde las
+        # conexiones heredadas del proceso padre no se pueden compartir
+        self._pid = os.getpid()
+        self._idle = deque()  # (conexion, creada_en, ultimo_uso)
+        self._created_at = {}
+        self._size = 0
+
+    def acquire(self):
+        """Toma una conexión del pool, creando una nueva si hay cupo"""
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            with self._cond:
+                if self._pid != os.getpid():
+                    self._reset()
+
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolError("Pool de conexiones agotado")
+                    self._cond.wait(remaining)
+
+                if self._idle:
+                    conn, created_at, last_used = self._idle.pop()
+                else:
+                    self._size += 1
+                    conn = None
+
+            if conn is None:
+                try:
+                    conn = self.factory()
+                except Exception:
+                    self._discard(None)
+                    raise
+                self._created_at[id(conn)] = time.monotonic()
+                return conn
+
+            now = time.monotonic()
+            if now - created_at > self.max_lifetime:
+                self._discard(conn)
+                continue
+            if now - last_used > self.ping_interval:
+                try:
+                    conn.ping(reconnect=False)
+                except mysql.connector.Error:
+                    self._discard(conn)
+                    continue
+            return conn
+
+    def release(self, conn):
+        """Devuelve una conexión al pool (o la descarta si está rota)"""
+        try:
+            # Limpiar cualquier transacción pendiente antes de reutilizarla
+            if conn.in_transaction:
+                conn.rollback()
+        except mysql.connector.Error:
+            self._discard(conn)
+            return
+
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+            created_at = self._created_at.get(id(conn), time.monotonic())
+            self._idle.append((conn, created_at, time.monotonic()))
+            self._cond.notify()
+
+    def _discard(self, conn):
+        if conn is not None:
+            self._created_at.pop(id(conn), None)
+            try:
+                conn.close()
+            except Exception:
+                pass
+        with self._cond:
+            self._size = max(0, self._size - 1)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        except mysql.connector.errors.OperationalError:
+            # Conexión probablemente caída: no devolverla al pool
+            self._discard(conn)
+            conn = None
+            raise
+        finally:
+            if conn is not None:
+                self.release(conn)
+
+    def close_all(self):
+        """Cierra todas las conexiones inactivas"""
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+        for conn, _, _ in idle:
+            self._discard(conn)
+
+
+# Consultas del dashboard. Todas filtran por rangos sargables (sin envolver
+# columnas indexadas en funciones) o leen tablas resumen acotadas.
+STATS_QUERIES = {
+    'by_type': """
+        SELECT tipo_dte, count, total_amount FROM stats_tipos WHERE count > 0
+    """,
+    'by_weekday': """
+        SELECT 
+            DAYOFWEEK(fecha) as day_num,
+            DAYNAME(fecha) as day_name,
+            SUM(count) as count,
+            COALESCE(SUM(total_amount), 0) as total_amount
+        FROM stats_diarias
+        GROUP BY day_num, day_name
+        ORDER BY day_num
+    """,
+    'top_emisores': """
+        SELECT e.nombre as nombre_emisor, s.count, s.total_amount
+        FROM stats_emisores s
+        JOIN emisores e ON e.id = s.emisor_id
+        ORDER BY s.total_amount DESC
+        LIMIT 5
+    """,
+    'current_month': """
+        SELECT COALESCE(SUM(total_amount), 0) as current_month_amount
+        FROM stats_mensuales
+        WHERE mes = DATE_FORMAT(CURDATE(), '%Y-%m')
+    """,
+    'recurring': """
+        SELECT COUNT(*) as recurring_count FROM stats_emisores WHERE count > 2
+    """,
+    'trends': """
+        SELECT 
+            DATE_FORMAT(fecha, '%Y-%m') as month,
+            NULLIF(tipo_dte, '') as tipo_dte,
+            SUM(count) as count
+        FROM stats_diarias
+        WHERE fecha >= DATE_SUB(CURDATE(), INTERVAL 6 MONTH)
+        GROUP BY month, tipo_dte
+        ORDER BY month ASC
+    """,
+    'recent_activity': """
+        SELECT codigo_generacion, fecha_emision, nombre_emisor, total_pagar, tipo_dte
+        FROM facturas
+        ORDER BY fecha_emision DESC
+        LIMIT 10
+    """,
+}
+
+# Formas societarias escritas sin puntos ni espacios -> forma canónica
+LEGAL_FORMS = {
+    'SA': 'S.A.',
+    'SADECV': 'S.A. DE C.V.',
+    'SASDECV': 'S.A.S. DE C.V.',
+    'SDERL': 'S. DE R.L.',
+    'SDERLDECV': 'S. DE R.L. DE C.V.',
+}
+# Palabras de la forma más larga: 'S DE R L DE C V'
+_LEGAL_FORM_MAX_WORDS = 7
+
+
+def _split_legal_form(nombre):
+    """Separa la forma societaria final: `(resto del nombre, forma canónica o None)`.
+
+    Solo cuenta si son palabras propias al final y queda nombre delante:
+    'CAFE NANDU S A' -> ('CAFE NANDU', 'S.A.'), pero 'A.S.A' no tiene forma.
+    Espera el nombre ya en mayúsculas.
+    """
+    words = list(re.finditer(r'[^\s,]+', nombre))
+    for size in range(min(len(words) - 1, _LEGAL_FORM_MAX_WORDS), 0, -1):
+        form = LEGAL_FORMS.get(''.join(w.group() for w in words[-size:]).replace('.', ''))
+        if form:
+            return nombre[:words[-size].start()].rstrip(' ,'), form
+    return nombre, None
+
+
+def normalize_emisor_name(nombre):
+    """Forma comparable del nombre de un emisor: sin tildes, mayúsculas, sin puntuación
+    y con la forma societaria siempre igual.
+
+    'Distribuidora Zablah, S.A. de C.V.' -> 'DISTRIBUIDORA ZABLAH S A DE C V'
+    'Cafe Nandu SA' y 'Cafe Nandu S. A.' -> 'CAFE NANDU S A'
+    """
+    nombre = unicodedata.normalize('NFKD', nombre)
+    nombre = ''.join(c for c in nombre if not unicodedata.combining(c)).upper()
+    base, form = _split_legal_form(nombre)
+    if form:
+        nombre = f'{base} {form}'
+    return ' '.join(re.sub(r'[^0-9A-Z]+', ' ', nombre).split())
+
+
+def display_emisor_name(nombre):
+    """Nombre visible canónico de un emisor: mayúsculas sin tildes (salvo la Ñ),
+    espacios y comas uniformes y la forma societaria escrita siempre igual.
+
+    'Distribuidora  Zablah, s.a de c.v' -> 'DISTRIBUIDORA ZABLAH S.A. DE C.V.'
+    """
+    nombre = unicodedata.normalize('NFD', nombre.upper())
+    # Se quitan las marcas diacríticas excepto la tilde de la Ñ
+    nombre = ''.join(
+        c for i, c in enumerate(nombre)
+        if not unicodedata.combining(c) or (c == '\u0303' and i and nombre[i - 1] == 'N')
+    )
+    nombre = ' '.join(unicodedata.normalize('NFC', nombre).split())
+    nombre = re.sub(r'\s*,\s*', ', ', nombre).strip(' ,')
+    base, form = _split_legal_form(nombre)
+    return f'{base} {form}' if form else nombre
+
+
+def emisor_key(nit, nombre):
+    """Clave del emisor en `emisores`: el NIT (solo dígitos) o, si falta, el nombre normalizado"""
+    nit = re.sub(r'\D', '', nit or '')
+    if nit:
+        return nit
+    nombre = normalize_emisor_name(nombre or '')
+    return f'N:{nombre}'[:255] if nombre else None
+
+
+def _emisor_row(key, nit, nombre):
+    """Fila (clave, nit, nombre) de `emisores`, con el nombre visible en su forma canónica"""
+    nombre = display_emisor_name(nombre or '')[:255] or nit
+    return key, re.sub(r'\D', '', nit or '') or None, nombre
+
+
+def _backfill_emisores(cursor):
+    """Crea los emisores de las facturas existentes y rellena `facturas.emisor_id`"""
+    # Por NIT queda como nombre visible la variante más frecuente (INSERT IGNORE conserva la primera)
+    cursor.execute("""
+        SELECT emisor_nit, nombre_emisor FROM facturas
+        WHERE emisor_id IS NULL
+        GROUP BY emisor_nit, nombre_emisor
+        ORDER BY COUNT(*) DESC
+    """)
+    aliases = [(nit, nombre, emisor_key(nit, nombre)) for nit, nombre in cursor.fetchall()]
+    aliases = [alias for alias in aliases if alias[2]]
+    if not aliases:
+        return
+    cursor.executemany(
+        "INSERT IGNORE INTO emisores (clave, nit, nombre) VALUES (%s, %s, %s)",
+        [_emisor_row(key, nit, nombre) for nit, nombre, key in aliases]
+    )
+    cursor.execute("""
+        CREATE TEMPORARY TABLE emisor_alias (
+            emisor_nit VARCHAR(20),
+            nombre_emisor VARCHAR(255),
+            clave VARCHAR(255) NOT NULL,
+            INDEX (emisor_nit, nombre_emisor)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+    """)
+    cursor.executemany("INSERT INTO emisor_alias VALUES (%s, %s, %s)", aliases)
+    cursor.execute("""
+        UPDATE facturas f
+        JOIN emisor_alias a ON a.emisor_nit <=> f.emisor_nit AND a.nombre_emisor <=> f.nombre_emisor
+        JOIN emisores e ON e.clave = a.clave
+        SET f.emisor_id = e.id
+        WHERE f.emisor_id IS NULL
+    """)
+    cursor.execute("DROP TEMPORARY TABLE emisor_alias")
+
+
+def _rekey_emisores(cursor):
+    """Recalcula las claves por nombre (N:...) y fusiona los emisores que pasan a coincidir.
+
+    Las variantes de la forma societaria ('SA', 'S.A.', 'S A') daban claves
+    distintas; las facturas y estadísticas pasan al emisor de menor id.
+    """
+    cursor.execute("SELECT id, clave FROM emisores WHERE clave LIKE 'N:%' ORDER BY id")
+    groups = defaultdict(list)
+    for emisor_id, clave in cursor.fetchall():
+        groups[emisor_key(None, clave[2:]) or clave].append((emisor_id, clave))
+
+    merged, rekeyed = [], []
+    for clave, rows in sorted(groups.items()):
+        survivor = rows[0][0]
+        others = [emisor_id for emisor_id, _ in rows[1:]]
+        if others:
+            merged.append((survivor, others))
+        if rows[0][1] != clave:
+            rekeyed.append((clave, survivor))
+
+    for survivor, others in merged:
+        placeholders = ', '.join(['%s'] * len(others))
+        cursor.execute(f"UPDATE facturas SET emisor_id = %s WHERE emisor_id IN ({placeholders})", (survivor, *others))
+        cursor.execute(f"DELETE FROM stats_emisores WHERE emisor_id IN (%s, {placeholders})", (survivor, *others))
+        cursor.execute("""
+            INSERT INTO stats_emisores (emisor_id, count, total_amount)
+            SELECT emisor_id, COUNT(*), COALESCE(SUM(total_pagar), 0)
+            FROM facturas WHERE emisor_id = %s GROUP BY emisor_id
+        """, (survivor,))
+        cursor.execute(f"DELETE FROM emisores WHERE id IN ({placeholders})", tuple(others))
+    # Después de borrar los fusionados: la clave nueva puede ser la antigua de uno de ellos
+    if rekeyed:
+        cursor.executemany("UPDATE emisores SET clave = %s WHERE id = %s", rekeyed)
+
+
+def _canonical_emisor_names(cursor):
+    """Pasa a la forma canónica (display_emisor_name) los nombres ya guardados en `emisores`"""
+    cursor.execute("SELECT id, nit, nombre FROM emisores ORDER BY id")
+    updates = []
+    for emisor_id, nit, nombre in cursor.fetchall():
+        canonical = display_emisor_name(nombre or '')[:255] or nit or nombre
+        if canonical != nombre:
+            updates.append((canonical, emisor_id))
+    if updates:
+        cursor.executemany("UPDATE emisores SET nombre = %s WHERE id = %s", updates)
+
+
+# Migraciones versionadas del esquema: (versión, descripción, sentencias).
+# Se aplican en orden una sola vez; la versión aplicada queda en `schema_migrations`.
+# Una sentencia puede ser una función que recibe el cursor (pasos de datos en Python).
+MIGRATIONS = [
+    (1, 'Índices de facturas para el dashboard', [
+        "CREATE INDEX IF NOT EXISTS idx_facturas_fecha_total ON facturas (fecha_emision, total_pagar)",
+        "CREATE INDEX IF NOT EXISTS idx_facturas_emisor_total ON facturas (nombre_emisor, total_pagar)",
+        "CREATE INDEX IF NOT EXISTS idx_facturas_tipo_fecha ON facturas (tipo_dte, fecha_emision)",
+    ]),
+    (2, 'Detalle completo del DTE en tablas hijas', [
+        "ALTER TABLE facturas ADD COLUMN IF NOT EXISTS emisor_nit VARCHAR(20) NULL",
+        "ALTER TABLE facturas ADD COLUMN IF NOT EXISTS emisor_nrc VARCHAR(20) NULL",
+        """
+        CREATE TABLE IF NOT EXISTS factura_items (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            factura_id INT NOT NULL,
+            num_item INT,
+            tipo_item TINYINT,
+            codigo VARCHAR(50),
+            descripcion TEXT,
+            cantidad DECIMAL(14, 4),
+            uni_medida SMALLINT,
+            precio_uni DECIMAL(14, 6),
+            monto_descu DECIMAL(14, 2),
+            venta_no_suj DECIMAL(14, 2),
+            venta_exenta DECIMAL(14, 2),
+            venta_gravada DECIMAL(14, 2),
+            iva_item DECIMAL(14, 2),
+            INDEX idx_factura_items_factura (factura_id),
+            FOREIGN KEY (factura_id) REFERENCES facturas (id) ON DELETE CASCADE
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS factura_resumen (
+            factura_id INT PRIMARY KEY,
+            total_no_suj DECIMAL(14, 2),
+            total_exenta DECIMAL(14, 2),
+            total_gravada DECIMAL(14, 2),
+            sub_total_ventas DECIMAL(14, 2),
+            total_descu DECIMAL(14, 2),
+            sub_total DECIMAL(14, 2),
+            iva_rete1 DECIMAL(14, 2),
+            rete_renta DECIMAL(14, 2),
+            monto_total_operacion DECIMAL(14, 2),
+            total_no_gravado DECIMAL(14, 2),
+            total_iva DECIMAL(14, 2),
+            condicion_operacion TINYINT,
+            FOREIGN KEY (factura_id) REFERENCES facturas (id) ON DELETE CASCADE
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS factura_tributos (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            factura_id INT NOT NULL,
+            codigo VARCHAR(5),
+            descripcion VARCHAR(150),
+            valor DECIMAL(14, 2),
+            INDEX idx_factura_tributos_factura (factura_id),
+            INDEX idx_factura_tributos_codigo (codigo),
+            FOREIGN KEY (factura_id) REFERENCES facturas (id) ON DELETE CASCADE
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS factura_receptores (
+            factura_id INT PRIMARY KEY,
+            tipo_documento VARCHAR(5),
+            num_documento VARCHAR(30),
+            nrc VARCHAR(20),
+            nombre VARCHAR(255),
+            cod_actividad VARCHAR(10),
+            correo VARCHAR(255),
+            telefono VARCHAR(30),
+            INDEX idx_factura_receptores_documento (num_documento),
+            FOREIGN KEY (factura_id) REFERENCES facturas (id) ON DELETE CASCADE
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+        """,
+        # JSON original comprimido con zlib, para re-extraer sin volver a Gmail
+        """
+        CREATE TABLE IF NOT EXISTS factura_json (
+            factura_id INT PRIMARY KEY,
+            dte_json MEDIUMBLOB NOT NULL,
+            FOREIGN KEY (factura_id) REFERENCES facturas (id) ON DELETE CASCADE
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+        """,
+    ]),
+    (3, 'Cuentas para la sincronización programada', [
+        """
+        CREATE TABLE IF NOT EXISTS sync_accounts (
+            account VARCHAR(255) PRIMARY KEY,
+            refresh_token TEXT NOT NULL,
+            enabled TINYINT(1) NOT NULL DEFAULT 1,
+            next_sync_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            last_sync_at TIMESTAMP NULL,
+            last_status VARCHAR(20),
+            last_error TEXT,
+            nuevas INT NOT NULL DEFAULT 0,
+            owner VARCHAR(100),
+            lease_until TIMESTAMP NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            INDEX idx_sync_accounts_due (enabled, next_sync_at)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+        """,
+    ]),
+    (4, 'Índices para el listado paginado de facturas', [
+        # Orden estable del listado (keyset): (fecha_emision, id)
+        "CREATE INDEX IF NOT EXISTS idx_facturas_fecha_id ON facturas (fecha_emision, id)",
+        "CREATE INDEX IF NOT EXISTS idx_facturas_nit_fecha ON facturas (emisor_nit, fecha_emision)",
+    ]),
+    (5, 'Dimensión de emisores por NIT', [
+        """
+        CREATE TABLE IF NOT EXISTS emisores (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            clave VARCHAR(255) NOT NULL UNIQUE,
+            nit VARCHAR(20) NULL,
+            nombre VARCHAR(255) NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+        """,
+        "ALTER TABLE facturas ADD COLUMN IF NOT EXISTS emisor_id INT NULL",
+        "CREATE INDEX IF NOT EXISTS idx_facturas_emisor_id ON facturas (emisor_id, total_pagar)",
+        """
+        ALTER TABLE facturas ADD CONSTRAINT fk_facturas_emisor
+        FOREIGN KEY IF NOT EXISTS (emisor_id) REFERENCES emisores (id)
+        """,
+        _backfill_emisores,
+        # stats_emisores pasa a agruparse por emisor_id en lugar del nombre
+        "DROP TABLE IF EXISTS stats_emisores",
+        """
+        CREATE TABLE stats_emisores (
+            emisor_id INT NOT NULL PRIMARY KEY,
+            count INT NOT NULL DEFAULT 0,
+            total_amount DECIMAL(14, 2) NOT NULL DEFAULT 0,
+            INDEX idx_stats_emisores_total (total_amount),
+            INDEX idx_stats_emisores_count (count)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+        """,
+        """
+        INSERT INTO stats_emisores (emisor_id, count, total_amount)
+        SELECT emisor_id, COUNT(*), COALESCE(SUM(total_pagar), 0)
+        FROM facturas WHERE emisor_id IS NOT NULL GROUP BY emisor_id
+        """,
+    ]),
+    (6, 'Correos pendientes de reintento por cuenta', [
+        """
+        CREATE TABLE IF NOT EXISTS sync_failed_messages (
+            account VARCHAR(255) NOT NULL,
+            message_id VARCHAR(64) NOT NULL,
+            error TEXT,
+            attempts INT NOT NULL DEFAULT 1,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            PRIMARY KEY (account, message_id)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+        """,
+    ]),
+    (7, 'Trabajos de sincronización ligados al token que los creó', [
+        # El token se borra al terminar el trabajo; el hash sigue identificando a su dueño
+        "ALTER TABLE sync_jobs ADD COLUMN IF NOT EXISTS token_hash CHAR(64) NULL",
+    ]),
+    (8, 'Nombre canónico de los emisores', [
+        _canonical_emisor_names,
+    ]),
+    (9, 'Claves por nombre con la forma societaria canónica', [
+        _rekey_emisores,
+        # Los fusionados conservan el nombre del superviviente: se vuelve a normalizar
+        _canonical_emisor_names,
+    ]),
+]
+
+# Emisores (clave -> id) recordados por proceso; los ids no cambian nunca
+EMISOR_CACHE_SIZE = 50000
+
+# Interbloqueo (1213) o espera de bloqueo agotada (1205): la transacción se repite entera
+LOCK_ERRNOS = (1213, 1205)
+LOCK_RETRIES = 3
+
+
+def _lock_retry(err, attempt):
+    """True si `err` es un conflicto de bloqueos y quedan intentos (espera antes de repetir)"""
+    if err.errno not in LOCK_ERRNOS or attempt + 1 >= LOCK_RETRIES:
+        return False
+    time.sleep(0.05 * 2 ** attempt)
+    return True
+
+# Columnas que devuelve el listado de facturas
+INVOICE_COLUMNS = ('id', 'codigo_generacion', 'fecha_emision', 'nombre_emisor', 'emisor_nit', 'tipo_dte', 'total_pagar')
+
+
+def _invoice_filters(filters):
+    """Condiciones WHERE (sargables) y parámetros para los filtros del listado de facturas"""
+    where, params = [], []
+    if filters.get('desde'):
+        where.append("fecha_emision >= %s")
+        params.append(filters['desde'])
+    if filters.get('hasta'):
+        where.append("fecha_emision <= %s")
+        params.append(filters['hasta'])
+    if filters.get('emisor'):
+        # Prefijo del nombre: puede usar idx_facturas_emisor_total
+        where.append("nombre_emisor LIKE %s")
+        params.append(filters['emisor'].replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+    if filters.get('nit'):
+        where.append("emisor_nit = %s")
+        params.append(filters['nit'])
+    if filters.get('tipos'):
+        where.append(f"tipo_dte IN ({', '.join(['%s'] * len(filters['tipos']))})")
+        params.extend(filters['tipos'])
+    if filters.get('min_total') is not None:
+        where.append("total_pagar >= %s")
+        params.append(filters['min_total'])
+    if filters.get('max_total') is not None:
+        where.append("total_pagar <= %s")
+        params.append(filters['max_total'])
+    return where, params
+
+
+# Columnas de las tablas hijas, en el orden de las claves de DteParser
+_RESUMEN_COLUMNS = (
+    'total_no_suj', 'total_exenta', 'total_gravada', 'sub_total_ventas', 'total_descu', 'sub_total',
+    'iva_rete1', 'rete_renta', 'monto_total_operacion', 'total_no_gravado', 'total_iva', 'condicion_operacion'
+)
+_RECEPTOR_COLUMNS = ('tipo_documento', 'num_documento', 'nrc', 'nombre', 'cod_actividad', 'correo', 'telefono')
+
 
 class DatabaseService:
-    def __init__(self, host, port, user, password, database):
+    def __init__(self, host, port, user, password, database, pool_size=10, pool_max_lifetime=1800):
         self.host = host
         self.port = port
         self.user = user
         self.password = password
         self.database = database
-        self.connection = None
-    
-    def connect(self):
-        """Establece conexión a la base de datos"""
-        try:
-            self.connection = mysql.connector.connect(
-                host=self.host,
-                port=self.port,
-                user=self.user,
-                password=self.password,
-                database=self.database
-            )
-            return self.connection
-        except mysql.connector.Error as e:
-            print(f"Error conectando a la base de datos: {e}")
-            return None
-    
-    def disconnect(self):
-        """Cierra la conexión"""
-        if self.connection:
-            self.connection.close()
+        self.pool = ConnectionPool(self._create_connection, max_size=pool_size, max_lifetime=pool_max_lifetime)
+        self._emisor_ids = {}
+
+    def _create_connection(self):
+        """Abre una conexión nueva (solo la usa el pool)"""
+        return mysql.connector.connect(
+            host=self.host,
+            port=self.port,
+            user=self.user,
+            password=self.password,
+            database=self.database
+        )
+
+    @contextmanager
+    def connection(self):
+        """Presta una conexión del pool durante el bloque `with`"""
+        with self.pool.connection() as conn:
+            yield conn
+
+    def close(self):
+        """Cierra las conexiones del pool"""
+        self.pool.close_all()
 
     def create_tables(self):
         """Crea las tablas necesarias si no existen"""
         try:
-            # Asegurar conexión
-            if not self.connection or not self.connection.is_connected():
-                if not self.connect():
-                    return False
-            
-            cursor = self.connection.cursor()
-            
-            # Tabla facturas
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS facturas (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    codigo_generacion VARCHAR(100) NOT NULL UNIQUE,
-                    fecha_emision DATE,
-                    nombre_emisor VARCHAR(255),
-                    total_pagar DECIMAL(10, 2),
-                    tipo_dte VARCHAR(10),
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
-            """)
-            
-            self.connection.commit()
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                
+                # Tabla facturas
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS facturas (
+                        id INT AUTO_INCREMENT PRIMARY KEY,
+                        codigo_generacion VARCHAR(100) NOT NULL UNIQUE,
+                        fecha_emision DATE,
+                        nombre_emisor VARCHAR(255),
+                        total_pagar DECIMAL(10, 2),
+                        tipo_dte VARCHAR(10),
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+                """)
+
+                # Checkpoints de sincronización incremental (historyId de Gmail por cuenta)
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS sync_checkpoints (
+                        account VARCHAR(255) PRIMARY KEY,
+                        history_id BIGINT UNSIGNED NOT NULL,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+                """)
+
+                # Tablas resumen del dashboard, actualizadas al insertar facturas
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS stats_diarias (
+                        fecha DATE NOT NULL,
+                        tipo_dte VARCHAR(10) NOT NULL DEFAULT '',
+                        count INT NOT NULL DEFAULT 0,
+                        total_amount DECIMAL(14, 2) NOT NULL DEFAULT 0,
+                        PRIMARY KEY (fecha, tipo_dte)
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+                """)
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS stats_mensuales (
+                        mes CHAR(7) NOT NULL,
+                        tipo_dte VARCHAR(10) NOT NULL DEFAULT '',
+                        count INT NOT NULL DEFAULT 0,
+                        total_amount DECIMAL(14, 2) NOT NULL DEFAULT 0,
+                        PRIMARY KEY (mes, tipo_dte)
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+                """)
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS stats_tipos (
+                        tipo_dte VARCHAR(10) NOT NULL DEFAULT '' PRIMARY KEY,
+                        count INT NOT NULL DEFAULT 0,
+                        total_amount DECIMAL(14, 2) NOT NULL DEFAULT 0
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+                """)
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS stats_emisores (
+                        emisor_id INT NOT NULL PRIMARY KEY,
+                        count INT NOT NULL DEFAULT 0,
+                        total_amount DECIMAL(14, 2) NOT NULL DEFAULT 0,
+                        INDEX idx_stats_emisores_total (total_amount),
+                        INDEX idx_stats_emisores_count (count)
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+                """)
+
+                # Trabajos de sincronización en segundo plano
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS sync_jobs (
+                        id CHAR(32) PRIMARY KEY,
+                        status VARCHAR(20) NOT NULL DEFAULT 'pendiente',
+                        params TEXT,
+                        token TEXT,
+                        cursor_data TEXT,
+                        nuevas INT NOT NULL DEFAULT 0,
+                        duplicadas INT NOT NULL DEFAULT 0,
+                        errores INT NOT NULL DEFAULT 0,
+                        resultado MEDIUMTEXT,
+                        error TEXT,
+                        owner VARCHAR(100),
+                        heartbeat TIMESTAMP NULL,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                        INDEX idx_sync_jobs_status (status, heartbeat)
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+                """)
+                
+                conn.commit()
+                cursor.close()
+
+            # Antes de calcular las tablas resumen: usan columnas añadidas por las migraciones
+            self.migrate()
+
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                # Primera vez con las tablas resumen: poblarlas con las facturas existentes
+                cursor.execute("SELECT (SELECT COUNT(*) FROM stats_tipos), EXISTS(SELECT 1 FROM facturas)")
+                stats_rows, has_invoices = cursor.fetchone()
+                cursor.close()
+            if not stats_rows and has_invoices:
+                print("📊 Calculando tablas resumen...")
+                self.rebuild_stats()
             print("✅ Tablas verificadas/creadas correctamente")
-            cursor.close()
+
+            full_scans = self.check_stats_query_plans()
+            if full_scans:
+                print(f"⚠️ Consultas del dashboard sin índice: {', '.join(full_scans)}")
             return True
         except mysql.connector.Error as e:
             print(f"❌ Error creando tablas: {e}")
             return False
     
+    def migrate(self):
+        """Aplica las migraciones de MIGRATIONS que aún no se han aplicado"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS schema_migrations (
+                        version INT PRIMARY KEY,
+                        description VARCHAR(255),
+                        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+                """)
+                cursor.execute("SELECT version FROM schema_migrations")
+                applied = {row[0] for row in cursor.fetchall()}
+
+                for version, description, statements in MIGRATIONS:
+                    if version in applied:
+                        continue
+                    print(f"🔧 Migración {version}: {description}")
+                    # El DDL hace commit implícito en MariaDB: cada sentencia debe ser idempotente
+                    for sql in statements:
+                        if callable(sql):
+                            sql(cursor)
+                        else:
+                            cursor.execute(sql)
+                    cursor.execute(
+                        "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                        (version, description)
+                    )
+                    conn.commit()
+            finally:
+                cursor.close()
+
     def invoice_exists(self, codigo_generacion):
         """Verifica si una factura ya existe"""
-        cursor = self.connection.cursor()
-        cursor.execute("SELECT id FROM facturas WHERE codigo_generacion = %s", (codigo_generacion,))
-        exists = cursor.fetchone() is not None
-        cursor.close()
-        return exists
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id FROM facturas WHERE codigo_generacion = %s", (codigo_generacion,))
+            exists = cursor.fetchone() is not None
+            cursor.close()
+            return exists
     
-    def save_invoice(self, codigo_generacion, fecha_emision, nombre_emisor, total_pagar, tipo_dte):
+    def save_invoice(self, codigo_generacion, fecha_emision, nombre_emisor, total_pagar, tipo_dte,
+                     emisor_nit=None, emisor_nrc=None, detalle=None, raw=None):
         """Guarda una nueva factura en la base de datos"""
-        cursor = self.connection.cursor()
+        invoice = {
+            'codigo_generacion': codigo_generacion,
+            'fecha_emision': fecha_emision,
+            'nombre_emisor': nombre_emisor,
+            'total_pagar': total_pagar,
+            'tipo_dte': tipo_dte,
+            'emisor_nit': emisor_nit,
+            'emisor_nrc': emisor_nrc,
+            'detalle': detalle,
+            'raw': raw
+        }
+        self.resolve_emisor_ids([invoice])
+        for attempt in range(LOCK_RETRIES):
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    sql = """
+                        INSERT INTO facturas 
+                        (codigo_generacion, fecha_emision, nombre_emisor, total_pagar, tipo_dte, emisor_nit, emisor_nrc, emisor_id) 
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                    """
+                    cursor.execute(sql, (codigo_generacion, fecha_emision, nombre_emisor, total_pagar, tipo_dte,
+                                         emisor_nit, emisor_nrc, invoice['emisor_id']))
+                    self._save_details(cursor, [invoice], {codigo_generacion: cursor.lastrowid})
+                    self._apply_stats(cursor, [invoice])
+                    conn.commit()
+                    return True
+                except mysql.connector.Error as err:
+                    conn.rollback()
+                    if _lock_retry(err, attempt):
+                        continue
+                    raise err
+                finally:
+                    cursor.close()
+
+    def get_existing_codes(self, codigos):
+        """Devuelve el subconjunto de códigos de generación que ya existen (una sola consulta)"""
+        if not codigos:
+            return set()
+        with self.connection() as conn:
+            return self._get_existing_codes(conn, codigos)
+
+    def _get_existing_codes(self, conn, codigos):
+        cursor = conn.cursor()
         try:
-            sql = """
-                INSERT INTO facturas 
-                (codigo_generacion, fecha_emision, nombre_emisor, total_pagar, tipo_dte) 
-                VALUES (%s, %s, %s, %s, %s)
-            """
-            cursor.execute(sql, (codigo_generacion, fecha_emision, nombre_emisor, total_pagar, tipo_dte))
-            self.connection.commit()
-            return True
-        except mysql.connector.Error as err:
-            self.connection.rollback()
-            raise err
+            placeholders = ', '.join(['%s'] * len(codigos))
+            cursor.execute(
+                f"SELECT codigo_generacion FROM facturas WHERE codigo_generacion IN ({placeholders})",
+                tuple(codigos)
+            )
+            return {row[0] for row in cursor.fetchall()}
         finally:
             cursor.close()
 
+    def save_invoices_batch(self, invoices):
+        """Guarda varias facturas en una sola transacción.
+
+        Recibe una lista de dicts con las mismas claves que `save_invoice` (más
+        `emisor_id`, ver resolve_emisor_ids) y devuelve `(insertados, duplicados)`
+        como listas de códigos de generación.
+        """
+        if not invoices:
+            return [], []
+
+        # Los reintentos cubren inserciones concurrentes e interbloqueos con otros lotes
+        for attempt in range(LOCK_RETRIES):
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    codigos = [inv['codigo_generacion'] for inv in invoices]
+                    with STAGE_SECONDS.labels('dedup').time():
+                        existing = self._get_existing_codes(conn, codigos)
+                    insert_started = time.perf_counter()
+
+                    # Siempre en el mismo orden de clave, así dos lotes no se bloquean en orden inverso
+                    nuevas = sorted(
+                        (inv for inv in invoices if inv['codigo_generacion'] not in existing),
+                        key=lambda inv: inv['codigo_generacion']
+                    )
+                    duplicados = [inv['codigo_generacion'] for inv in invoices if inv['codigo_generacion'] in existing]
+
+                    if nuevas:
+                        # executemany reescribe el INSERT como un único INSERT multi-fila
+                        sql = """
+                            INSERT IGNORE INTO facturas 
+                            (codigo_generacion, fecha_emision, nombre_emisor, total_pagar, tipo_dte, emisor_nit, emisor_nrc, emisor_id) 
+                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                        """
+                        cursor.executemany(sql, [
+                            (inv['codigo_generacion'], inv['fecha_emision'], inv['nombre_emisor'],
+                             inv['total_pagar'], inv['tipo_dte'], inv.get('emisor_nit'), inv.get('emisor_nrc'),
+                             inv.get('emisor_id'))
+                            for inv in nuevas
+                        ])
+                        if cursor.rowcount != len(nuevas):
+                            # Otro proceso insertó alguna entre el SELECT y el INSERT IGNORE:
+                            # se deshace y se repite para saber exactamente cuáles son nuevas
+                            conn.rollback()
+                            continue
+
+                        self._save_details(cursor, nuevas)
+
+                    self._apply_stats(cursor, nuevas)
+                    conn.commit()
+                    STAGE_SECONDS.labels('insert').observe(time.perf_counter() - insert_started)
+                    return [inv['codigo_generacion'] for inv in nuevas], duplicados
+                except mysql.connector.Error as err:
+                    conn.rollback()
+                    if _lock_retry(err, attempt):
+                        continue
+                    raise err
+                finally:
+                    cursor.close()
+
+        raise mysql.connector.Error("No se pudo guardar el lote por inserciones concurrentes")
+
+    def resolve_emisor_ids(self, invoices):
+        """Asigna `emisor_id` a cada factura, creando en `emisores` los que aún no existen.
+
+        Las facturas se identifican con emisor_key (NIT o nombre normalizado); las
+        claves ya vistas se resuelven desde la caché del proceso sin ir a la BD.
+        """
+        invoice_keys = [emisor_key(inv.get('emisor_nit'), inv.get('nombre_emisor')) for inv in invoices]
+        keys, found = {}, {}
+        for inv, key in zip(invoices, invoice_keys):
+            if key and key not in self._emisor_ids:
+                keys.setdefault(key, (inv.get('emisor_nit'), inv.get('nombre_emisor')))
+
+        if keys:
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    cursor.executemany(
+                        "INSERT IGNORE INTO emisores (clave, nit, nombre) VALUES (%s, %s, %s)",
+                        [_emisor_row(key, nit, nombre) for key, (nit, nombre) in sorted(keys.items())]
+                    )
+                    conn.commit()
+                    placeholders = ', '.join(['%s'] * len(keys))
+                    cursor.execute(f"SELECT clave, id FROM emisores WHERE clave IN ({placeholders})", tuple(keys))
+                    found = dict(cursor.fetchall())
+                except mysql.connector.Error as err:
+                    conn.rollback()
+                    raise err
+                finally:
+                    cursor.close()
+            if len(self._emisor_ids) + len(found) > EMISOR_CACHE_SIZE:
+                self._emisor_ids = {}
+            self._emisor_ids.update(found)
+
+        for inv, key in zip(invoices, invoice_keys):
+            inv['emisor_id'] = self._emisor_ids.get(key, found.get(key)) if key else None
+        return invoices
+
+    def _save_details(self, cursor, invoices, ids=None):
+        """Inserta en bloque items, resumen, tributos, receptor y JSON comprimido de las facturas"""
+        invoices = [inv for inv in invoices if inv.get('detalle') or inv.get('raw')]
+        if not invoices:
+            return
+
+        if ids is None:
+            codigos = [inv['codigo_generacion'] for inv in invoices]
+            placeholders = ', '.join(['%s'] * len(codigos))
+            cursor.execute(
+                f"SELECT codigo_generacion, id FROM facturas WHERE codigo_generacion IN ({placeholders})",
+                tuple(codigos)
+            )
+            ids = dict(cursor.fetchall())
+
+        items, resumenes, tributos, receptores, raws = [], [], [], [], []
+        for inv in invoices:
+            factura_id = ids[inv['codigo_generacion']]
+            detalle = inv.get('detalle') or {}
+            for item in detalle.get('items', []):
+                items.append((factura_id, item['num_item'], item['tipo_item'], item['codigo'], item['descripcion'],
+                              item['cantidad'], item['uni_medida'], item['precio_uni'], item['monto_descu'],
+                              item['venta_no_suj'], item['venta_exenta'], item['venta_gravada'], item['iva_item']))
+            resumen = detalle.get('resumen')
+            if resumen:
+                resumenes.append((factura_id,) + tuple(resumen[col] for col in _RESUMEN_COLUMNS))
+            for tributo in detalle.get('tributos', []):
+                tributos.append((factura_id, tributo['codigo'], tributo['descripcion'], tributo['valor']))
+            receptor = detalle.get('receptor')
+            if receptor:
+                receptores.append((factura_id,) + tuple(receptor[col] for col in _RECEPTOR_COLUMNS))
+            if inv.get('raw'):
+                raws.append((factura_id, zlib.compress(inv['raw'], 6)))
+
+        if items:
+            cursor.executemany("""
+                INSERT INTO factura_items
+                (factura_id, num_item, tipo_item, codigo, descripcion, cantidad, uni_medida, precio_uni,
+                 monto_descu, venta_no_suj, venta_exenta, venta_gravada, iva_item)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            """, items)
+        if resumenes:
+            cursor.executemany(
+                f"INSERT INTO factura_resumen (factura_id, {', '.join(_RESUMEN_COLUMNS)}) "
+                f"VALUES ({', '.join(['%s'] * (len(_RESUMEN_COLUMNS) + 1))})",
+                resumenes
+            )
+        if tributos:
+            cursor.executemany(
+                "INSERT INTO factura_tributos (factura_id, codigo, descripcion, valor) VALUES (%s, %s, %s, %s)",
+                tributos
+            )
+        if receptores:
+            cursor.executemany(
+                f"INSERT INTO factura_receptores (factura_id, {', '.join(_RECEPTOR_COLUMNS)}) "
+                f"VALUES ({', '.join(['%s'] * (len(_RECEPTOR_COLUMNS) + 1))})",
+                receptores
+            )
+        if raws:
+            cursor.executemany("INSERT INTO factura_json (factura_id, dte_json) VALUES (%s, %s)", raws)
+
+    def get_raw_dte(self, codigo_generacion):
+        """Devuelve los bytes originales del DTE guardado (o None)"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("""
+                    SELECT j.dte_json FROM factura_json j
+                    JOIN facturas f ON f.id = j.factura_id
+                    WHERE f.codigo_generacion = %s
+                """, (codigo_generacion,))
+                row = cursor.fetchone()
+                return zlib.decompress(row[0]) if row else None
+            finally:
+                cursor.close()
+
+    def _apply_stats(self, cursor, invoices):
+        """Suma las facturas recién insertadas a las tablas resumen (misma transacción)"""
+        if not invoices:
+            return
+
+        by_day = defaultdict(lambda: [0, Decimal(0)])
+        by_month = defaultdict(lambda: [0, Decimal(0)])
+        by_type = defaultdict(lambda: [0, Decimal(0)])
+        by_emisor = defaultdict(lambda: [0, Decimal(0)])
+
+        for inv in invoices:
+            total = Decimal(str(inv['total_pagar'] or 0))
+            tipo = inv['tipo_dte'] or ''
+            fecha = str(inv['fecha_emision']) if inv['fecha_emision'] else None
+
+            buckets = [by_type[tipo]]
+            if fecha:
+                buckets.append(by_day[(fecha[:10], tipo)])
+                buckets.append(by_month[(fecha[:7], tipo)])
+            if inv.get('emisor_id') is not None:
+                buckets.append(by_emisor[inv['emisor_id']])
+            for bucket in buckets:
+                bucket[0] += 1
+                bucket[1] += total
+
+        # Filas ordenadas por clave: las transacciones concurrentes bloquean en el mismo orden
+        upsert = "ON DUPLICATE KEY UPDATE count = count + VALUES(count), total_amount = total_amount + VALUES(total_amount)"
+        if by_day:
+            cursor.executemany(
+                f"INSERT INTO stats_diarias (fecha, tipo_dte, count, total_amount) VALUES (%s, %s, %s, %s) {upsert}",
+                [(fecha, tipo, c, t) for (fecha, tipo), (c, t) in sorted(by_day.items())]
+            )
+        if by_month:
+            cursor.executemany(
+                f"INSERT INTO stats_mensuales (mes, tipo_dte, count, total_amount) VALUES (%s, %s, %s, %s) {upsert}",
+                [(mes, tipo, c, t) for (mes, tipo), (c, t) in sorted(by_month.items())]
+            )
+        cursor.executemany(
+            f"INSERT INTO stats_tipos (tipo_dte, count, total_amount) VALUES (%s, %s, %s) {upsert}",
+            [(tipo, c, t) for tipo, (c, t) in sorted(by_type.items())]
+        )
+        if by_emisor:
+            cursor.executemany(
+                f"INSERT INTO stats_emisores (emisor_id, count, total_amount) VALUES (%s, %s, %s) {upsert}",
+                [(emisor_id, c, t) for emisor_id, (c, t) in sorted(by_emisor.items())]
+            )
+
+    def rebuild_stats(self):
+        """Recalcula las tablas resumen desde cero a partir de `facturas`"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                for table in ('stats_diarias', 'stats_mensuales', 'stats_tipos', 'stats_emisores'):
+                    cursor.execute(f"DELETE FROM {table}")
+                cursor.execute("""
+                    INSERT INTO stats_diarias (fecha, tipo_dte, count, total_amount)
+                    SELECT fecha_emision, COALESCE(tipo_dte, ''), COUNT(*), COALESCE(SUM(total_pagar), 0)
+                    FROM facturas WHERE fecha_emision IS NOT NULL
+                    GROUP BY fecha_emision, COALESCE(tipo_dte, '')
+                """)
+                cursor.execute("""
+                    INSERT INTO stats_mensuales (mes, tipo_dte, count, total_amount)
+                    SELECT DATE_FORMAT(fecha, '%Y-%m'), tipo_dte, SUM(count), SUM(total_amount)
+                    FROM stats_diarias GROUP BY DATE_FORMAT(fecha, '%Y-%m'), tipo_dte
+                """)
+                cursor.execute("""
+                    INSERT INTO stats_tipos (tipo_dte, count, total_amount)
+                    SELECT COALESCE(tipo_dte, ''), COUNT(*), COALESCE(SUM(total_pagar), 0)
+                    FROM facturas GROUP BY COALESCE(tipo_dte, '')
+                """)
+                cursor.execute("""
+                    INSERT INTO stats_emisores (emisor_id, count, total_amount)
+                    SELECT emisor_id, COUNT(*), COALESCE(SUM(total_pagar), 0)
+                    FROM facturas WHERE emisor_id IS NOT NULL GROUP BY emisor_id
+                """)
+                conn.commit()
+            except mysql.connector.Error as err:
+                conn.rollback()
+                raise err
+            finally:
+                cursor.close()
+
+    def get_sync_checkpoint(self, account):
+        """Devuelve el último historyId sincronizado de la cuenta (o None)"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("SELECT history_id FROM sync_checkpoints WHERE account = %s", (account,))
+                row = cursor.fetchone()
+                return row[0] if row else None
+            finally:
+                cursor.close()
+
+    def save_sync_checkpoint(self, account, history_id):
+        """Guarda (o actualiza) el historyId sincronizado de la cuenta"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("""
+                    INSERT INTO sync_checkpoints (account, history_id) VALUES (%s, %s)
+                    ON DUPLICATE KEY UPDATE history_id = VALUES(history_id)
+                """, (account, history_id))
+                conn.commit()
+            except mysql.connector.Error as err:
+                conn.rollback()
+                raise err
+            finally:
+                cursor.close()
+
+    def get_failed_messages(self, account, max_attempts):
+        """IDs de los correos de la cuenta que fallaron y aún no agotaron `max_attempts` intentos"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(
+                    "SELECT message_id FROM sync_failed_messages WHERE account = %s AND attempts < %s ORDER BY updated_at",
+                    (account, max_attempts)
+                )
+                return [row[0] for row in cursor.fetchall()]
+            finally:
+                cursor.close()
+
+    def record_failed_messages(self, account, failed):
+        """Registra los correos fallidos `{id: causa}` y devuelve `{id: intentos}`"""
+        if not failed:
+            return {}
+        message_ids = sorted(failed)
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.executemany("""
+                    INSERT INTO sync_failed_messages (account, message_id, error) VALUES (%s, %s, %s)
+                    ON DUPLICATE KEY UPDATE attempts = attempts + 1, error = VALUES(error)
+                """, [(account, message_id, str(failed[message_id])) for message_id in message_ids])
+                cursor.execute(
+                    f"SELECT message_id, attempts FROM sync_failed_messages "
+                    f"WHERE account = %s AND message_id IN ({', '.join(['%s'] * len(message_ids))})",
+                    (account, *message_ids)
+                )
+                attempts = dict(cursor.fetchall())
+                conn.commit()
+                return attempts
+            except mysql.connector.Error as err:
+                conn.rollback()
+                raise err
+            finally:
+                cursor.close()
+
+    def clear_failed_messages(self, account, message_ids):
+        """Olvida los correos que ya se procesaron bien"""
+        if not message_ids:
+            return
+        message_ids = sorted(message_ids)
+        self._execute_write(
+            f"DELETE FROM sync_failed_messages WHERE account = %s "
+            f"AND message_id IN ({', '.join(['%s'] * len(message_ids))})",
+            (account, *message_ids)
+        )
+
+    def _execute_write(self, sql, params=()):
+        """Ejecuta una escritura en su propia transacción y devuelve rowcount"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(sql, params)
+                conn.commit()
+                return cursor.rowcount
+            except mysql.connector.Error as err:
+                conn.rollback()
+                raise err
+            finally:
+                cursor.close()
+
+    def create_job(self, job_id, params, token, token_hash):
+        """Registra un trabajo de sincronización pendiente"""
+        self._execute_write(
+            "INSERT INTO sync_jobs (id, status, params, token, token_hash) VALUES (%s, 'pendiente', %s, %s, %s)",
+            (job_id, json.dumps(params), token, token_hash)
+        )
+
+    def claim_job(self, job_id, owner, stale_seconds):
+        """Marca el trabajo como en curso si está libre (pendiente o abandonado).
+
+        Devuelve True solo para el proceso que lo consigue, así varios workers
+        de gunicorn nunca ejecutan el mismo trabajo a la vez.
+        """
+        return self._execute_write("""
+            UPDATE sync_jobs SET status = 'en_curso', owner = %s, heartbeat = NOW()
+            WHERE id = %s AND (
+                status = 'pendiente'
+                OR (status = 'en_curso' AND heartbeat < NOW() - INTERVAL %s SECOND)
+            )
+        """, (owner, job_id, stale_seconds)) == 1
+
+    def update_job_progress(self, job_id, counts, cursor_data):
+        """Guarda contadores y punto de reanudación del trabajo (y renueva el heartbeat)"""
+        self._execute_write("""
+            UPDATE sync_jobs SET nuevas = %s, duplicadas = %s, errores = %s,
+                cursor_data = %s, heartbeat = NOW()
+            WHERE id = %s
+        """, (counts['nuevas'], counts['duplicadas'], counts['errores'],
+              json.dumps(cursor_data) if cursor_data else None, job_id))
+
+    def finish_job(self, job_id, status, counts=None, resultado=None, error=None):
+        """Cierra el trabajo como 'completado' o 'error'"""
+        counts = counts or {}
+        self._execute_write("""
+            UPDATE sync_jobs SET status = %s,
+                nuevas = COALESCE(%s, nuevas), duplicadas = COALESCE(%s, duplicadas),
+                errores = COALESCE(%s, errores), resultado = %s, error = %s, token = NULL
+            WHERE id = %s
+        """, (status, counts.get('nuevas'), counts.get('duplicadas'), counts.get('errores'),
+              json.dumps(resultado) if resultado is not None else None, error, job_id))
+
+    def get_job(self, job_id):
+        """Devuelve el trabajo como dict (o None)"""
+        with self.connection() as conn:
+            cursor = conn.cursor(dictionary=True)
+            try:
+                cursor.execute("SELECT * FROM sync_jobs WHERE id = %s", (job_id,))
+                job = cursor.fetchone()
+            finally:
+                cursor.close()
+        if job:
+            for field in ('params', 'cursor_data', 'resultado'):
+                job[field] = json.loads(job[field]) if job[field] else None
+        return job
+
+    def find_resumable_jobs(self, stale_seconds):
+        """IDs de trabajos pendientes o cuyo worker dejó de dar señales de vida"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("""
+                    SELECT id FROM sync_jobs
+                    WHERE status = 'pendiente'
+                       OR (status = 'en_curso' AND heartbeat < NOW() - INTERVAL %s SECOND)
+                    ORDER BY created_at
+                """, (stale_seconds,))
+                return [row[0] for row in cursor.fetchall()]
+            finally:
+                cursor.close()
+
+    def save_sync_account(self, account, refresh_token, first_sync_delay=0):
+        """Registra (o reactiva) una cuenta para la sincronización programada"""
+        self._execute_write("""
+            INSERT INTO sync_accounts (account, refresh_token, next_sync_at)
+            VALUES (%s, %s, NOW() + INTERVAL %s SECOND)
+            ON DUPLICATE KEY UPDATE refresh_token = VALUES(refresh_token), enabled = 1
+        """, (account, refresh_token, int(first_sync_delay)))
+
+    def claim_due_accounts(self, owner, limit, lease_seconds):
+        """Reserva hasta `limit` cuentas con sincronización vencida y las devuelve.
+
+        Se eligen las que llevan más tiempo esperando (justicia entre cuentas) y
+        quedan bloqueadas por `lease_seconds`, así ningún otro planificador sincroniza
+        la misma cuenta a la vez. Devuelve [(account, refresh_token)].
+        """
+        claimed = self._execute_write("""
+            UPDATE sync_accounts SET owner = %s, lease_until = NOW() + INTERVAL %s SECOND
+            WHERE enabled = 1 AND next_sync_at <= NOW()
+              AND (lease_until IS NULL OR lease_until < NOW())
+            ORDER BY next_sync_at
+            LIMIT %s
+        """, (owner, lease_seconds, limit))
+        if not claimed:
+            return []
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(
+                    "SELECT account, refresh_token FROM sync_accounts WHERE owner = %s ORDER BY next_sync_at",
+                    (owner,)
+                )
+                return cursor.fetchall()
+            finally:
+                cursor.close()
+
+    def renew_account_lease(self, account, owner, lease_seconds):
+        """Extiende la reserva de una cuenta mientras su sincronización sigue avanzando"""
+        self._execute_write(
+            "UPDATE sync_accounts SET lease_until = NOW() + INTERVAL %s SECOND WHERE account = %s AND owner = %s",
+            (lease_seconds, account, owner)
+        )
+
+    def finish_account_sync(self, account, status, next_sync_in, nuevas=0, error=None, enabled=True):
+        """Libera la cuenta y programa su próxima sincronización dentro de `next_sync_in` segundos"""
+        self._execute_write("""
+            UPDATE sync_accounts SET last_sync_at = NOW(), last_status = %s, last_error = %s,
+                nuevas = %s, enabled = %s, next_sync_at = NOW() + INTERVAL %s SECOND,
+                owner = NULL, lease_until = NULL
+            WHERE account = %s
+        """, (status, error, nuevas, int(enabled), int(next_sync_in), account))
+
+    def iter_invoices(self, filters=None, after=None, limit=None, chunk_size=1000):
+        """Genera las facturas filtradas en lotes (listas de dicts), de la más reciente a la más antigua.
+
+        El orden es (fecha_emision, id) descendente, con las facturas sin fecha al final.
+        `after` es la clave (fecha_emision, id) de la última fila ya entregada: la
+        consulta continúa justo después en idx_facturas_fecha_id, así que la página N
+        cuesta lo mismo que la primera (sin OFFSET).
+        """
+        where, params = _invoice_filters(filters or {})
+        if after is not None:
+            fecha, last_id = after
+            if fecha is None:
+                where.append("(fecha_emision IS NULL AND id < %s)")
+                params.append(last_id)
+            else:
+                where.append("(fecha_emision < %s OR (fecha_emision = %s AND id < %s) OR fecha_emision IS NULL)")
+                params.extend([fecha, fecha, last_id])
+
+        sql = f"SELECT {', '.join(INVOICE_COLUMNS)} FROM facturas"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY fecha_emision DESC, id DESC"
+        if limit is not None:
+            sql += " LIMIT %s"
+            params.append(int(limit))
+        return self._stream_query(sql, params, chunk_size)
+
+    def _stream_query(self, sql, params=(), chunk_size=1000):
+        """Ejecuta la consulta con un cursor sin buffer y genera sus filas en lotes de `chunk_size`.
+
+        Las filas se leen del servidor según se consumen, así que la memoria no
+        depende del total. La conexión queda prestada mientras dura el generador;
+        si se abandona a medias (p. ej. el cliente corta la descarga) se descarta
+        en lugar de leer las filas pendientes.
+        """
+        conn = self.pool.acquire()
+        finished = False
+        try:
+            cursor = conn.cursor(dictionary=True, buffered=False)
+            cursor.execute(sql, tuple(params))
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+            cursor.close()
+            finished = True
+        finally:
+            if finished:
+                self.pool.release(conn)
+            else:
+                self.pool._discard(conn)
+
     def get_dashboard_stats(self):
         """Obtiene estadísticas para el dashboard"""
-        cursor = self.connection.cursor(dictionary=True)
+        try:
+            with self.connection() as conn:
+                return self._get_dashboard_stats(conn)
+        except mysql.connector.Error as e:
+            print(f"Error obteniendo stats: {e}")
+            return None
+
+    def _get_dashboard_stats(self, conn):
+        cursor = conn.cursor(dictionary=True)
         stats = {}
         
         try:
-            # 1. Totales Generales
-            cursor.execute("""
-                SELECT 
-                    COUNT(*) as total_count,
-                    COALESCE(SUM(total_pagar), 0) as total_amount
-                FROM facturas
-            """)
-            totals = cursor.fetchone()
-            stats['total_docs'] = totals['total_count']
-            stats['total_amount'] = float(totals['total_amount'])
-
-            # 2. Distribución por Tipo de DTE
-            cursor.execute("""
-                SELECT tipo_dte, COUNT(*) as count 
-                FROM facturas 
-                GROUP BY tipo_dte
-            """)
-            stats['by_type'] = cursor.fetchall()
+            # Casi todo se lee de las tablas resumen (stats_*), cuyo tamaño no depende de `facturas`
+
+            # 1. Totales Generales y 2. Distribución por Tipo de DTE
+            cursor.execute(STATS_QUERIES['by_type'])
+            tipos = cursor.fetchall()
+            stats['total_docs'] = int(sum(t['count'] for t in tipos))
+            stats['total_amount'] = float(sum(t['total_amount'] for t in tipos))
+            stats['by_type'] = [
+                {'tipo_dte': t['tipo_dte'] or None, 'count': t['count']} for t in tipos
+            ]
 
             # 2.5. Gastos por día de la semana
-            cursor.execute("""
-                SELECT 
-                    DAYOFWEEK(fecha_emision) as day_num,
-                    DAYNAME(fecha_emision) as day_name,
-                    COUNT(*) as count,
-                    COALESCE(SUM(total_pagar), 0) as total_amount
-                FROM facturas
-                WHERE fecha_emision IS NOT NULL
-                GROUP BY day_num, day_name
-                ORDER BY day_num
-            """)
+            cursor.execute(STATS_QUERIES['by_weekday'])
             stats['by_weekday'] = cursor.fetchall()
 
             # 2.6. Top 5 Emisores
-            cursor.execute("""
-                SELECT 
-                    nombre_emisor,
-                    COUNT(*) as count,
-                    COALESCE(SUM(total_pagar), 0) as total_amount
-                FROM facturas
-                WHERE nombre_emisor IS NOT NULL
-                GROUP BY nombre_emisor
-                ORDER BY total_amount DESC
-                LIMIT 5
-            """)
+            cursor.execute(STATS_QUERIES['top_emisores'])
             stats['top_emisores'] = cursor.fetchall()
 
             # 2.7. Gastos del Mes Actual
-            cursor.execute("""
-                SELECT COALESCE(SUM(total_pagar), 0) as current_month_amount
-                FROM facturas
-                WHERE MONTH(fecha_emision) = MONTH(NOW())
-                AND YEAR(fecha_emision) = YEAR(NOW())
-            """)
+            cursor.execute(STATS_QUERIES['current_month'])
             current_month = cursor.fetchone()
             stats['current_month_amount'] = float(current_month['current_month_amount'])
 
             # 2.8. Cargos Recurrentes (Emisores con más de 2 compras)
-            cursor.execute("""
-                SELECT COUNT(*) as recurring_count
-                FROM (
-                    SELECT nombre_emisor
-                    FROM facturas
-                    WHERE nombre_emisor IS NOT NULL
-                    GROUP BY nombre_emisor
-                    HAVING COUNT(*) > 2
-                ) as recurrentes
-            """)
+            cursor.execute(STATS_QUERIES['recurring'])
             recurring = cursor.fetchone()
             stats['recurring_count'] = recurring['recurring_count']
 
             # 3. Tendencia Mensual (Últimos 6 meses)
-            cursor.execute("""
-                SELECT 
-                    DATE_FORMAT(fecha_emision, '%Y-%m') as month,
-                    tipo_dte,
-                    COUNT(*) as count
-                FROM facturas
-                WHERE fecha_emision >= DATE_SUB(NOW(), INTERVAL 6 MONTH)
-                GROUP BY month, tipo_dte
-                ORDER BY month ASC
-            """)
-            stats['trends'] = cursor.fetchall()
+            cursor.execute(STATS_QUERIES['trends'])
+            stats['trends'] = [dict(t, count=int(t['count'])) for t in cursor.fetchall()]
 
             # 4. Actividad Reciente (Últimas 10)
-            cursor.execute("""
-                SELECT codigo_generacion, fecha_emision, nombre_emisor, total_pagar, tipo_dte
-                FROM facturas
-                ORDER BY fecha_emision DESC
-                LIMIT 10
-            """)
+            cursor.execute(STATS_QUERIES['recent_activity'])
             # Convertir fechas a string para JSON
             recent = cursor.fetchall()
             for r in recent:
@@ -192,8 +1381,24 @@ class DatabaseService:
 
             return stats
 
-        except mysql.connector.Error as e:
-            print(f"Error obteniendo stats: {e}")
-            return None
         finally:
-            cursor.close()
\ No newline at end of file
+            cursor.close()
+
+    def check_stats_query_plans(self):
+        """Ejecuta EXPLAIN sobre las consultas del dashboard.
+
+        Devuelve la lista de consultas que recorren `facturas` completa
+        (type=ALL); vacía si todas usan índices o tablas resumen.
+        """
+        full_scans = []
+        with self.connection() as conn:
+            cursor = conn.cursor(dictionary=True)
+            try:
+                for name, sql in STATS_QUERIES.items():
+                    cursor.execute("EXPLAIN " + sql)
+                    for row in cursor.fetchall():
+                        if row['table'] == 'facturas' and row['type'] == 'ALL':
+                            full_scans.append(name)
+            finally:
+                cursor.close()
+        return full_scans
@@ -0,0 +1,219 @@
+import codecs
+import json
+
+try:
+    import orjson
+except ImportError:  # orjson es opcional: sin él se usa el módulo json estándar
+    orjson = None
+
+
+class DteValidationError(ValueError):
+    """El JSON no tiene la estructura mínima de un DTE"""
+
+
+# Estructura mínima que se lee de cada DTE: sección -> campo -> (tipos, obligatorio)
+DTE_SCHEMA = {
+    'identificacion': {
+        'codigoGeneracion': (str, True),
+        'fecEmi': (str, False),
+        'tipoDte': (str, False),
+    },
+    'emisor': {
+        'nombre': (str, False),
+    },
+    'resumen': {
+        'totalPagar': ((int, float), False),
+    },
+}
+
+
+def _compile_schema(schema):
+    """Convierte el esquema en una lista plana de comprobaciones (se hace una sola vez)"""
+    checks = []
+    for section, fields in schema.items():
+        for field, (types, required) in fields.items():
+            checks.append((section, field, types, required))
+    sections = tuple(schema)
+
+    def validate(data):
+        if not isinstance(data, dict):
+            raise DteValidationError("el DTE no es un objeto JSON")
+        for section in sections:
+            if not isinstance(data.get(section, {}), dict):
+                raise DteValidationError(f"'{section}' no es un objeto")
+        for section, field, types, required in checks:
+            value = data.get(section, {}).get(field)
+            if value is None:
+                if required:
+                    raise DteValidationError(f"falta {section}.{field}")
+                continue
+            # bool es subclase de int, pero nunca es un valor válido en un DTE
+            if not isinstance(value, types) or isinstance(value, bool):
+                raise DteValidationError(f"{section}.{field} tiene un tipo inválido")
+
+    return validate
+
+
+validate_dte = _compile_schema(DTE_SCHEMA)
+
+
+def decode_json(raw):
+    """Decodifica los bytes de un adjunto JSON.
+
+    El BOM y la codificación se detectan una vez sobre los bytes; en el caso
+    normal (UTF-8 sin BOM) los bytes van directos al parser, sin decodificar a str.
+    """
+    if not isinstance(raw, bytes):
+        raw = bytes(raw)  # mmap/memoryview de la caché de adjuntos
+    if raw.startswith(codecs.BOM_UTF8):
+        raw = raw[len(codecs.BOM_UTF8):]
+    elif raw.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        raw = raw.decode('utf-16').encode('utf-8')
+
+    if orjson is not None:
+        try:
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            # Puede ser JSON en latin-1 (UTF-8 inválido); si no, el error se repite abajo
+            return orjson.loads(raw.decode('latin-1').encode('utf-8'))
+
+    try:
+        text = raw.decode('utf-8')
+    except UnicodeDecodeError:
+        text = raw.decode('latin-1')
+    return json.loads(text)
+
+
+def _items(data):
+    """Filas de `cuerpoDocumento` normalizadas"""
+    items = []
+    for item in data.get('cuerpoDocumento') or []:
+        if not isinstance(item, dict):
+            continue
+        items.append({
+            'num_item': item.get('numItem'),
+            'tipo_item': item.get('tipoItem'),
+            'codigo': item.get('codigo'),
+            'descripcion': item.get('descripcion'),
+            'cantidad': item.get('cantidad'),
+            'uni_medida': item.get('uniMedida'),
+            'precio_uni': item.get('precioUni'),
+            'monto_descu': item.get('montoDescu'),
+            'venta_no_suj': item.get('ventaNoSuj'),
+            'venta_exenta': item.get('ventaExenta'),
+            # Los DTE de sujeto excluido (14) usan `compra` en lugar de `ventaGravada`
+            'venta_gravada': item.get('ventaGravada', item.get('compra')),
+            'iva_item': item.get('ivaItem'),
+        })
+    return items
+
+
+def _resumen(data):
+    """Campos de impuestos y totales de `resumen`"""
+    resumen = data.get('resumen') or {}
+    return {
+        'total_no_suj': resumen.get('totalNoSuj'),
+        'total_exenta': resumen.get('totalExenta'),
+        'total_gravada': resumen.get('totalGravada', resumen.get('totalCompra')),
+        'sub_total_ventas': resumen.get('subTotalVentas'),
+        'total_descu': resumen.get('totalDescu'),
+        'sub_total': resumen.get('subTotal'),
+        'iva_rete1': resumen.get('ivaRete1'),
+        'rete_renta': resumen.get('reteRenta'),
+        'monto_total_operacion': resumen.get('montoTotalOperacion'),
+        'total_no_gravado': resumen.get('totalNoGravado'),
+        'total_iva': resumen.get('totalIva'),
+        'condicion_operacion': resumen.get('condicionOperacion'),
+    }
+
+
+def _tributos(data):
+    """Desglose de tributos de `resumen.tributos`"""
+    tributos = []
+    for tributo in (data.get('resumen') or {}).get('tributos') or []:
+        if isinstance(tributo, dict):
+            tributos.append({
+                'codigo': tributo.get('codigo'),
+                'descripcion': tributo.get('descripcion'),
+                'valor': tributo.get('valor'),
+            })
+    return tributos
+
+
+def _receptor(data):
+    """Receptor (o sujeto excluido en los DTE tipo 14)"""
+    receptor = data.get('receptor') or data.get('sujetoExcluido')
+    if not isinstance(receptor, dict):
+        return None
+    return {
+        'tipo_documento': receptor.get('tipoDocumento', '36' if receptor.get('nit') else None),
+        # Los CCF (03) identifican al receptor por NIT
+        'num_documento': receptor.get('numDocumento') or receptor.get('nit'),
+        'nrc': receptor.get('nrc'),
+        'nombre': receptor.get('nombre'),
+        'cod_actividad': receptor.get('codActividad'),
+        'correo': receptor.get('correo'),
+        'telefono': receptor.get('telefono'),
+    }
+
+
+class DteRecord:
+    """Datos de un DTE que se guardan en `facturas`.
+
+    codigo_generacion, fecha_emision, nombre_emisor, tipo_dte, emisor_nit y
+    emisor_nrc son str (o None); total_pagar es int/float (o None).
+    `detalle` guarda las filas normalizadas para las tablas hijas (items,
+    resumen, tributos, receptor) y `raw` los bytes originales del adjunto.
+    """
+
+    __slots__ = (
+        'codigo_generacion', 'fecha_emision', 'nombre_emisor', 'total_pagar', 'tipo_dte',
+        'emisor_nit', 'emisor_nrc', 'detalle', 'raw'
+    )
+
+    def __init__(self, codigo_generacion, fecha_emision, nombre_emisor, total_pagar, tipo_dte,
+                 emisor_nit=None, emisor_nrc=None, detalle=None, raw=None):
+        self.codigo_generacion = codigo_generacion
+        self.fecha_emision = fecha_emision
+        self.nombre_emisor = nombre_emisor
+        self.total_pagar = total_pagar
+        self.tipo_dte = tipo_dte
+        self.emisor_nit = emisor_nit
+        self.emisor_nrc = emisor_nrc
+        self.detalle = detalle
+        self.raw = raw
+
+    @classmethod
+    def from_dte(cls, data, raw=None):
+        """Construye el registro desde un DTE ya validado"""
+        ident = data.get('identificacion', {})
+        emisor = data.get('emisor', {})
+        return cls(
+            ident.get('codigoGeneracion'),
+            ident.get('fecEmi'),
+            emisor.get('nombre'),
+            data.get('resumen', {}).get('totalPagar'),
+            ident.get('tipoDte'),
+            emisor_nit=emisor.get('nit'),
+            emisor_nrc=emisor.get('nrc'),
+            detalle={
+                'items': _items(data),
+                'resumen': _resumen(data),
+                'tributos': _tributos(data),
+                'receptor': _receptor(data),
+            },
+            raw=raw,
+        )
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f"DteRecord({self.codigo_generacion!r}, {self.nombre_emisor!r}, {self.total_pagar!r})"
+
+
+def parse_dte(raw):
+    """Bytes del adjunto -> DteRecord validado. Lanza ValueError si no es un DTE válido"""
+    data = decode_json(raw)
+    validate_dte(data)
+    return DteRecord.from_dte(data, raw)
@@ -1,21 +1,196 @@
 import base64
 import json
+import logging
+import random
+import threading
 import time
-from googleapiclient.discovery import build
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.errors import HttpError
+from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import Flow
+from .DteParser import decode_json
+from .Instrumentation import GMAIL_CALLS, GMAIL_RETRIES
+
+logger = logging.getLogger(__name__)
+
+# Documento de descubrimiento de Gmail incluido en googleapiclient: se parsea una
+# sola vez al importar, sin pedirlo a la red en cada build()
+GMAIL_DISCOVERY = json.loads(get_static_doc('gmail', 'v1'))
+
+
+def gmail_discovery(root_url=None):
+    """Documento de descubrimiento apuntando a `root_url` (p. ej. un servidor falso de pruebas)"""
+    if not root_url:
+        return GMAIL_DISCOVERY
+    root_url = root_url.rstrip('/') + '/'
+    return dict(GMAIL_DISCOVERY, rootUrl=root_url, baseUrl=root_url + GMAIL_DISCOVERY['servicePath'])
+
+# Reintentos con backoff de googleapiclient (cuota y 5xx) en las llamadas sueltas
+API_RETRIES = 5
+
+def _parts_fields(depth):
+    """Máscara `fields` para el árbol de partes sin el contenido (body.data)"""
+    part = 'partId,mimeType,filename,body/attachmentId,body/size'
+    mask = part
+    for _ in range(depth):
+        mask = f'{part},parts({mask})'
+    return mask
+
+
+# Cabeceras y estructura de partes para resolver adjuntos, sin descargar cuerpos HTML
+STRUCTURE_FIELDS = f'id,threadId,snippet,payload(headers,{_parts_fields(6)})'
+
+
+def _is_rate_limit(exception):
+    """True si Gmail rechazó la petición por cuota (429 o 403 rateLimitExceeded)"""
+    if not isinstance(exception, HttpError):
+        return False
+    if exception.resp.status == 429:
+        return True
+    return exception.resp.status == 403 and b'ratelimitexceeded' in (exception.content or b'').lower()
+
+
+def _retry_reason(exception):
+    """Etiqueta de la métrica de reintentos: 'rate_limit' o 'transient'"""
+    return 'rate_limit' if _is_rate_limit(exception) else 'transient'
+
+
+def _is_retryable(exception):
+    """Errores transitorios: cuota, 5xx o fallos de red"""
+    if not isinstance(exception, HttpError):
+        return True
+    return _is_rate_limit(exception) or exception.resp.status >= 500
+
+
+class _AdaptiveBatchController:
+    """Ajusta tamaño de lote y pausa según las respuestas de cuota de Gmail.
+
+    Cada lote limpio agranda el siguiente y reduce la pausa; cada 429/403 por
+    cuota reduce el lote a la mitad y duplica la pausa (backoff exponencial).
+    """
+
+    def __init__(self, chunk_size=10, min_size=1, max_size=50, base_delay=0.5, max_delay=32):
+        self.chunk_size = chunk_size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.delay = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        delay = self.delay
+        if delay:
+            # Jitter para que los hilos no reintenten todos a la vez
+            time.sleep(delay * random.uniform(0.5, 1.0))
+
+    def on_success(self):
+        with self._lock:
+            self.chunk_size = min(self.max_size, self.chunk_size + 2)
+            self.delay = self.delay / 2 if self.delay > self.base_delay else 0
+
+    def on_rate_limit(self):
+        with self._lock:
+            self.chunk_size = max(self.min_size, self.chunk_size // 2)
+            self.delay = min(self.max_delay, self.delay * 2 if self.delay else self.base_delay)
+
+
+class GmailClientCache:
+    """Clientes de la API de Gmail ya construidos, por token (LRU con caducidad).
+
+    Construir el cliente cuesta decenas de ms; los tokens de acceso de Google
+    duran una hora, así que `ttl` no debería superar ese tiempo.
+    Los clientes no guardan estado de la petición: cada llamada recibe su
+    propio Http, así que se comparten entre hilos sin problema.
+    """
+
+    def __init__(self, max_entries=256, ttl=3300, root_url=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.discovery = gmail_discovery(root_url)
+        self._clients = OrderedDict()  # token -> (expira_en, credenciales, cliente)
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        """(credenciales, cliente) para el token, construyéndolos si no están"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._clients.get(token)
+            if entry and entry[0] > now:
+                self._clients.move_to_end(token)
+                return entry[1], entry[2]
+
+        credentials = Credentials(token=token)
+        client = build_from_document(self.discovery, credentials=credentials)
+        with self._lock:
+            self._clients[token] = (now + self.ttl, credentials, client)
+            self._clients.move_to_end(token)
+            while len(self._clients) > self.max_entries:
+                self._clients.popitem(last=False)
+        return credentials, client
+
+
+_thread_http = threading.local()
+
+
+def _shared_http():
+    """httplib2.Http propio de cada hilo, reutilizado entre peticiones (keep-alive)"""
+    http = getattr(_thread_http, 'http', None)
+    if http is None:
+        http = _thread_http.http = httplib2.Http()
+    return http
+
 
 class GmailService:
-    def __init__(self, client_id, client_secret, redirect_uri):
+    """Cliente de Gmail de una sola cuenta.
+
+    Tras build_service la instancia queda ligada a ese token: se crea una por
+    petición o trabajo (container.gmail_for_token). Una instancia sin token
+    (container.gmail_service) solo sirve para OAuth y utilidades que no llaman a Gmail.
+    """
+
+    def __init__(self, client_id, client_secret, redirect_uri, cache=None, clients=None, root_url=None):
         self.client_id = client_id
         self.client_secret = client_secret
         self.redirect_uri = redirect_uri
+        # AttachmentCache opcional compartido entre instancias
+        self.cache = cache
+        # GmailClientCache opcional compartida entre instancias
+        self.clients = clients
+        # Raíz de la API sin caché de clientes (por defecto la de Google)
+        self.root_url = root_url
         self.service = None
+        self.credentials = None
+        self._local = threading.local()
     
     def build_service(self, token):
-        """Construye el servicio de Gmail con el token"""
-        self.service = build('gmail', 'v1', credentials=Credentials(token=token))
+        """Construye el servicio de Gmail con el token.
+
+        Lanza RuntimeError si la instancia ya tiene otro token: así una instancia
+        compartida nunca mezcla credenciales de dos usuarios.
+        """
+        if self.credentials is not None and self.credentials.token != token:
+            raise RuntimeError("GmailService ya está ligado a otro token: crear una instancia por token")
+        if self.clients is not None:
+            self.credentials, self.service = self.clients.get(token)
+        else:
+            self.credentials = Credentials(token=token)
+            self.service = build_from_document(gmail_discovery(self.root_url), credentials=self.credentials)
         return self.service
+
+    def _http(self):
+        """Http autorizado propio de cada hilo (httplib2 no es thread-safe)"""
+        local = self._local
+        if getattr(local, 'credentials', None) is not self.credentials:
+            local.credentials = self.credentials
+            local.http = AuthorizedHttp(self.credentials, http=_shared_http())
+        return local.http
     
     def get_auth_url(self):
         """Genera URL de autenticación"""
@@ -34,6 +209,10 @@ class GmailService:
     
     def get_token(self, code):
         """Obtiene token con el código de autorización"""
+        return self.get_tokens(code)[0]
+
+    def get_tokens(self, code):
+        """(token de acceso, refresh token) con el código de autorización"""
         flow = Flow.from_client_config(
             {"web": {
                 "client_id": self.client_id, 
@@ -45,28 +224,180 @@ class GmailService:
         )
         flow.redirect_uri = self.redirect_uri
         flow.fetch_token(code=code)
-        return flow.credentials.token
+        return flow.credentials.token, flow.credentials.refresh_token
+
+    def refresh_access_token(self, refresh_token):
+        """Obtiene un token de acceso nuevo a partir de un refresh token guardado.
+
+        Lanza google.auth.exceptions.RefreshError si el usuario revocó el acceso.
+        """
+        credentials = Credentials(
+            None, refresh_token=refresh_token, client_id=self.client_id, client_secret=self.client_secret,
+            token_uri="https://oauth2.googleapis.com/token"
+        )
+        credentials.refresh(Request())
+        return credentials.token
     
     def search_emails(self, query, max_results=20):
         """Busca emails con query específica"""
+        GMAIL_CALLS.labels('messages.list').inc()
         results = self.service.users().messages().list(
             userId='me', q=query, maxResults=max_results
-        ).execute()
+        ).execute(http=self._http(), num_retries=API_RETRIES)
         return results.get('messages', [])
+
+    def iter_message_ids(self, query, page_size=500, max_results=None, page_token=None):
+        """Genera páginas `(ids, next_page_token)` siguiendo nextPageToken hasta recorrer todo el buzón.
+
+        `page_token` permite retomar un recorrido a partir de una página concreta.
+        """
+        total = 0
+        while True:
+            if max_results is not None:
+                page_size = min(page_size, max_results - total)
+                if page_size <= 0:
+                    return
+
+            GMAIL_CALLS.labels('messages.list').inc()
+            results = self.service.users().messages().list(
+                userId='me', q=query, maxResults=page_size, pageToken=page_token
+            ).execute(http=self._http(), num_retries=API_RETRIES)
+
+            ids = [msg['id'] for msg in results.get('messages', [])]
+            page_token = results.get('nextPageToken')
+            if ids:
+                total += len(ids)
+                yield ids, page_token
+
+            if not page_token:
+                return
     
-    def get_message_details(self, message_id):
-        """Obtiene detalles completos de un mensaje"""
+    def get_profile(self):
+        """Obtiene el perfil de la cuenta (emailAddress, historyId actual)"""
+        GMAIL_CALLS.labels('getProfile').inc()
+        return self.service.users().getProfile(userId='me').execute(http=self._http(), num_retries=API_RETRIES)
+
+    def iter_history_message_ids(self, start_history_id, page_size=500, max_results=None, page_token=None):
+        """Genera páginas `(ids, next_page_token)` de mensajes añadidos desde `start_history_id`.
+
+        Lanza HttpError 404 si el historyId ya expiró en Gmail.
+        """
+        seen = set()
+        total = 0
+        while True:
+            GMAIL_CALLS.labels('history.list').inc()
+            results = self.service.users().history().list(
+                userId='me', startHistoryId=start_history_id, historyTypes=['messageAdded'],
+                maxResults=page_size, pageToken=page_token
+            ).execute(http=self._http(), num_retries=API_RETRIES)
+
+            ids = []
+            for record in results.get('history', []):
+                for added in record.get('messagesAdded', []):
+                    msg = added.get('message', {})
+                    # Los borradores y enviados no son facturas recibidas
+                    if set(msg.get('labelIds', [])) & {'DRAFT', 'SENT'}:
+                        continue
+                    if msg.get('id') and msg['id'] not in seen:
+                        seen.add(msg['id'])
+                        ids.append(msg['id'])
+
+            if max_results is not None:
+                ids = ids[:max_results - total]
+            page_token = results.get('nextPageToken')
+            if ids:
+                total += len(ids)
+                yield ids, page_token
+            if max_results is not None and total >= max_results:
+                return
+
+            if not page_token:
+                return
+
+    def _message_request(self, message_id):
+        """Petición messages.get con cabeceras y estructura de partes (sin cuerpos)"""
         return self.service.users().messages().get(
-            userId='me', id=message_id, format='full'
-        ).execute()
+            userId='me', id=message_id, format='full', fields=STRUCTURE_FIELDS
+        )
+
+    def get_message_details(self, message_id):
+        """Obtiene cabeceras y estructura de partes de un mensaje"""
+        GMAIL_CALLS.labels('messages.get').inc()
+        return self._message_request(message_id).execute(http=self._http(), num_retries=API_RETRIES)
     
-    def get_attachment(self, message_id, attachment_id):
-        """Descarga un archivo adjunto"""
+    def get_attachment(self, message_id, attachment_id, part_id=None):
+        """Descarga un archivo adjunto (o lo lee de la caché local).
+
+        Gmail cambia el attachmentId en cada consulta del mensaje, pero un
+        mensaje nunca cambia: si se conoce `part_id`, la clave de caché es
+        mensaje + parte y sobrevive entre sincronizaciones. Devuelve bytes
+        (o un mmap de solo lectura para adjuntos grandes en caché).
+        """
+        key = f"{message_id}/{part_id if part_id is not None else attachment_id}"
+        if self.cache:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+
+        GMAIL_CALLS.labels('attachments.get').inc()
         data = self.service.users().messages().attachments().get(
             userId='me', messageId=message_id, id=attachment_id
-        ).execute()
-        return base64.urlsafe_b64decode(data['data'].encode('UTF-8'))
+        ).execute(http=self._http())
+        content = base64.urlsafe_b64decode(data['data'].encode('UTF-8'))
+
+        if self.cache:
+            try:
+                self.cache.put(key, content)
+            except OSError as e:
+                logger.warning("No se pudo guardar el adjunto en caché: %s", e)
+        return content
     
+    def _get_attachment_with_retry(self, message_id, attachment_id, part_id=None, max_retries=3):
+        """get_attachment con backoff exponencial ante errores transitorios"""
+        delay = 0.5
+        for attempt in range(max_retries + 1):
+            try:
+                return self.get_attachment(message_id, attachment_id, part_id)
+            except Exception as e:
+                if attempt == max_retries or not _is_retryable(e):
+                    raise
+                GMAIL_RETRIES.labels(_retry_reason(e)).inc()
+                time.sleep(delay * random.uniform(0.5, 1.0))
+                delay *= 2
+
+    def download_attachments(self, attachments, max_workers=8):
+        """Descarga adjuntos en paralelo con un pool acotado de hilos.
+
+        Recibe tuplas `(message_id, attachment_id[, part_id])` y genera
+        `(message_id, attachment_id, datos, error)` según va terminando cada descarga.
+        Nunca hay más de `max_workers` descargas en curso o sin consumir, así un
+        consumidor lento no acumula todos los adjuntos en memoria.
+        """
+        attachments = iter(attachments)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            in_flight = {}
+
+            def submit_next():
+                for item in attachments:
+                    message_id, attachment_id = item[0], item[1]
+                    part_id = item[2] if len(item) > 2 else None
+                    future = pool.submit(self._get_attachment_with_retry, message_id, attachment_id, part_id)
+                    in_flight[future] = (message_id, attachment_id)
+                    return
+
+            for _ in range(max_workers):
+                submit_next()
+
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    message_id, attachment_id = in_flight.pop(future)
+                    submit_next()
+                    try:
+                        yield message_id, attachment_id, future.result(), None
+                    except Exception as e:
+                        yield message_id, attachment_id, None, e
+
     def find_attachments_recursive(self, message_id, parts):
         """Busca adjuntos recursivamente"""
         attachments = []
@@ -79,43 +410,131 @@ class GmailService:
                     attachments.append({
                         'filename': filename,
                         'mimeType': part.get('mimeType'),
-                        'attachmentId': part['body']['attachmentId']
+                        'attachmentId': part['body']['attachmentId'],
+                        'partId': part.get('partId')
                     })
             if 'parts' in part:
                 attachments.extend(self.find_attachments_recursive(message_id, part['parts']))
         return attachments
 
-    def get_messages_batch(self, message_ids, batch_size=10):
-        """Obtiene detalles de múltiples mensajes en lotes pequeños para evitar Rate Limit"""
+    def get_messages_batch(self, message_ids, batch_size=10, max_workers=4, max_retries=5, failed=None):
+        """Obtiene detalles de múltiples mensajes con varios lotes en paralelo.
+
+        El tamaño de lote y la pausa se adaptan a los errores de cuota, y los
+        IDs que fallan por errores transitorios se reintentan hasta `max_retries`.
+        Cada mensaje trae cabeceras y el árbol de partes (sin cuerpos) para
+        localizar adjuntos.
+
+        Los IDs que no se pudieron obtener no aparecen en el resultado; si se pasa
+        el dict `failed`, se añaden a él como `{id: causa}`. Los mensajes borrados
+        (404) no cuentan como fallidos.
+        """
         messages_data = {}
-        
-        # Dividir en chunks (grupos pequeños)
-        chunks = [message_ids[i:i + batch_size] for i in range(0, len(message_ids), batch_size)]
-        
-        for i, chunk in enumerate(chunks):
-            def callback(request_id, response, exception):
-                if exception:
-                    print(f"Error en batch para {request_id}: {exception}")
+        if not message_ids:
+            return messages_data
+
+        controller = _AdaptiveBatchController(chunk_size=batch_size)
+        pending = deque(message_ids)
+        attempts = {}
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    chunk = [pending.popleft() for _ in range(min(controller.chunk_size, len(pending)))]
+
+                controller.wait()
+                fetched, retry, rate_limited, errors = self._execute_messages_batch(chunk)
+
+                if rate_limited:
+                    controller.on_rate_limit()
                 else:
-                    messages_data[request_id] = response
+                    controller.on_success()
 
-            batch = self.service.new_batch_http_request(callback=callback)
-            
-            for msg_id in chunk:
-                batch.add(self.service.users().messages().get(
-                    userId='me', id=msg_id, format='full'
-                ), request_id=msg_id)
-            
-            try:
-                batch.execute()
-                # Pequeña pausa entre lotes para no saturar la API
-                if i < len(chunks) - 1:
-                    time.sleep(1)
-            except Exception as e:
-                print(f"Error ejecutando lote: {e}")
+                with lock:
+                    messages_data.update(fetched)
+                    for msg_id, error in retry.items():
+                        attempts[msg_id] = attempts.get(msg_id, 0) + 1
+                        if attempts[msg_id] <= max_retries:
+                            GMAIL_RETRIES.labels('rate_limit' if rate_limited else 'transient').inc()
+                            pending.append(msg_id)
+                        else:
+                            errors[msg_id] = f"reintentos agotados ({error})"
+                    for msg_id, error in errors.items():
+                        logger.error("Error en batch para %s: %s", msg_id, error)
+                        if failed is not None:
+                            failed[msg_id] = error
+
+        workers = min(max_workers, max(1, len(message_ids) // batch_size))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for future in [pool.submit(worker) for _ in range(workers)]:
+                future.result()
                 
         return messages_data
 
+    def _execute_messages_batch(self, chunk):
+        """Ejecuta un lote y clasifica el resultado.
+
+        Devuelve (obtenidos, {id: error} a reintentar, hubo cuota, {id: error} definitivos).
+        """
+        fetched = {}
+        retry = {}
+        errors = {}
+        state = {'rate_limited': False}
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                fetched[request_id] = response
+            elif _is_retryable(exception):
+                retry[request_id] = exception
+                if _is_rate_limit(exception):
+                    state['rate_limited'] = True
+            elif isinstance(exception, HttpError) and exception.resp.status == 404:
+                # Borrado entre el listado y la descarga: no hay nada que reintentar
+                logger.info("Mensaje %s ya no existe", request_id)
+            else:
+                errors[request_id] = str(exception)
+
+        batch = self.service.new_batch_http_request(callback=callback)
+        for msg_id in chunk:
+            batch.add(self._message_request(msg_id), request_id=msg_id)
+
+        GMAIL_CALLS.labels('messages.get').inc(len(chunk))
+        try:
+            batch.execute(http=self._http())
+        except Exception as e:
+            logger.warning("Error ejecutando lote: %s", e)
+            retry = {msg_id: e for msg_id in chunk if msg_id not in fetched and msg_id not in errors}
+            state['rate_limited'] = state['rate_limited'] or _is_rate_limit(e)
+
+        return fetched, retry, state['rate_limited'], errors
+
+    def find_json_part(self, message):
+        """Devuelve la parte del primer adjunto .json del mensaje (o None)"""
+        # Función interna recursiva para buscar JSON
+        def find_json_in_parts(parts_list):
+            for part in parts_list:
+                # Caso 1: Es un archivo JSON
+                filename = part.get('filename', '').lower()
+                if filename.endswith('.json') and part.get('body', {}).get('attachmentId'):
+                    return part
+                
+                # Caso 2: Es un contenedor (multipart) -> Recursividad
+                if 'parts' in part:
+                    found = find_json_in_parts(part['parts'])
+                    if found:
+                        return found
+            return None
+
+        return find_json_in_parts(message.get('payload', {}).get('parts', []))
+
+    def find_json_attachment_id(self, message):
+        """Devuelve el attachmentId del primer adjunto .json del mensaje (o None)"""
+        part = self.find_json_part(message)
+        return part['body']['attachmentId'] if part else None
+
     def get_json_from_message(self, message_input):
         """Versión optimizada y recursiva para extraer JSON. Acepta ID o objeto mensaje completo"""
         try:
@@ -128,36 +547,17 @@ class GmailService:
                 message = message_input
                 message_id = message.get('id')
 
-            parts = message.get('payload', {}).get('parts', [])
+            part = self.find_json_part(message)
             
-            # Función interna recursiva para buscar JSON
-            def find_json_in_parts(parts_list):
-                for part in parts_list:
-                    # Caso 1: Es un archivo JSON
-                    filename = part.get('filename', '').lower()
-                    if filename.endswith('.json') and part.get('body', {}).get('attachmentId'):
-                        return part['body']['attachmentId']
-                    
-                    # Caso 2: Es un contenedor (multipart) -> Recursividad
-                    if 'parts' in part:
-                        found_id = find_json_in_parts(part['parts'])
-                        if found_id:
-                            return found_id
-                return None
-
-            attachment_id = find_json_in_parts(parts)
-            
-            if attachment_id:
-                json_data = self.get_attachment(message_id, attachment_id)
-                try:
-                    return json.loads(json_data.decode('utf-8'))
-                except UnicodeDecodeError:
-                    try:
-                        return json.loads(json_data.decode('utf-8-sig'))
-                    except:
-                        return json.loads(json_data.decode('latin-1'))
+            if part:
+                content = self.get_attachment(message_id, part['body']['attachmentId'], part.get('partId'))
+                return self.parse_json_attachment(content)
             
         except Exception as e:
-            print(f"Error leyendo JSON del mensaje: {e}")
+            logger.warning("Error leyendo JSON del mensaje: %s", e)
         
-        return None
\ No newline at end of file
+        return None
+
+    def parse_json_attachment(self, json_data):
+        """Decodifica el contenido de un adjunto JSON"""
+        return decode_json(json_data)
\ No newline at end of file
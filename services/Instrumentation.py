@@ -0,0 +1,98 @@
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+# Con gunicorn cada worker tiene sus propios contadores: si PROMETHEUS_MULTIPROC_DIR
+# está definida, prometheus_client los guarda en archivos y /metrics los suma todos
+MULTIPROCESS = bool(os.getenv('PROMETHEUS_MULTIPROC_DIR'))
+if MULTIPROCESS:
+    # Solo gunicorn (on_starting) lo crea; el planificador y los scripts de la misma
+    # imagen también escriben métricas ahí y fallarían si no existe
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+)
+from werkzeug.middleware.profiler import ProfilerMiddleware
+
+STAGE_SECONDS = Histogram(
+    'facturaflow_sync_stage_seconds',
+    'Duración de cada etapa de la sincronización, por página de correos',
+    ['stage'],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+)
+GMAIL_CALLS = Counter(
+    'facturaflow_gmail_calls_total',
+    'Llamadas a métodos de la API de Gmail (cada mensaje de un batch cuenta como una)',
+    ['method']
+)
+GMAIL_RETRIES = Counter(
+    'facturaflow_gmail_retries_total',
+    'Reintentos de llamadas a Gmail por motivo',
+    ['reason']
+)
+INVOICES = Counter(
+    'facturaflow_invoices_total',
+    'Facturas procesadas por resultado',
+    ['result']
+)
+SYNC_RUNS = Counter(
+    'facturaflow_sync_runs_total',
+    'Sincronizaciones terminadas por estado',
+    ['status']
+)
+
+
+class StageTimer:
+    """Acumula el tiempo de una etapa en varios tramos y lo registra una vez"""
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.seconds = 0.0
+
+    @contextmanager
+    def measure(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds += time.perf_counter() - start
+
+    def observe(self):
+        STAGE_SECONDS.labels(self.stage).observe(self.seconds)
+
+
+def metrics_payload():
+    """(cuerpo, content-type) con las métricas en formato de texto de Prometheus"""
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+def configure_logging():
+    """Configura el logging de la app según LOG_LEVEL (INFO por defecto)"""
+    logging.basicConfig(
+        level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+        format='%(asctime)s %(levelname)s %(name)s %(message)s'
+    )
+
+
+class OptInProfilerMiddleware:
+    """Perfila con cProfile solo las peticiones con la cabecera `X-Profile: 1`.
+
+    Los perfiles (.prof) se guardan en `profile_dir`; el resto de peticiones
+    pasa sin ningún coste añadido. Solo se activa si se define PROFILE_DIR.
+    """
+
+    def __init__(self, app, profile_dir):
+        os.makedirs(profile_dir, exist_ok=True)
+        self.app = app
+        self.profiled = ProfilerMiddleware(app, stream=None, profile_dir=profile_dir)
+
+    def __call__(self, environ, start_response):
+        if environ.get('HTTP_X_PROFILE') == '1':
+            return self.profiled(environ, start_response)
+        return self.app(environ, start_response)
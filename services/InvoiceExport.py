@@ -0,0 +1,158 @@
+import csv
+import io
+import tempfile
+
+try:
+    import xlsxwriter
+except ImportError:  # opcional: sin él no se ofrece XLSX
+    xlsxwriter = None
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # opcional: sin él no se ofrece Parquet
+    pyarrow = None
+
+# Columnas exportadas, en orden (el id interno no se exporta)
+EXPORT_COLUMNS = ('codigo_generacion', 'fecha_emision', 'nombre_emisor', 'emisor_nit', 'tipo_dte', 'total_pagar')
+
+# Formato -> (mimetype, extensión)
+EXPORT_FORMATS = {
+    'csv': ('text/csv; charset=utf-8', 'csv'),
+    'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'xlsx'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+
+# Filas por lote leído de la BD (y por row group en Parquet)
+EXPORT_CHUNK_SIZE = 10000
+
+# Límite de filas de una hoja de Excel (sin contar la cabecera)
+XLSX_MAX_ROWS = 1048575
+
+FILE_CHUNK_SIZE = 64 * 1024
+
+# Caracteres con los que Excel/LibreOffice interpretan una celda como fórmula
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+class _ByteSink(io.RawIOBase):
+    """Destino no buscable: acumula lo escrito hasta que se vacía con pop()"""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _csv_safe(value):
+    """Texto del DTE que no se abre como fórmula en una hoja de cálculo (CSV injection)"""
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def available_formats():
+    """Formatos que se pueden generar con las dependencias instaladas"""
+    return [fmt for fmt in EXPORT_FORMATS
+            if (fmt != 'xlsx' or xlsxwriter) and (fmt != 'parquet' or pyarrow)]
+
+
+def export_invoices(chunks, fmt):
+    """Codifica los lotes de facturas (de DatabaseService.iter_invoices) en `fmt`.
+
+    Genera bytes según se codifica cada lote, sin acumular el resultado: la
+    memoria depende del tamaño del lote, no del número de filas.
+    """
+    if fmt not in available_formats():
+        raise ValueError(f"Formato no disponible: {fmt}")
+    return {'csv': _export_csv, 'xlsx': _export_xlsx, 'parquet': _export_parquet}[fmt](chunks)
+
+
+def _export_csv(chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # BOM para que Excel reconozca el UTF-8 (tildes y eñes en los nombres)
+    buffer.write('\ufeff')
+    writer.writerow(EXPORT_COLUMNS)
+    for rows in chunks:
+        writer.writerows([_csv_safe(row[col]) for col in EXPORT_COLUMNS] for row in rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+
+def _export_xlsx(chunks):
+    """XLSX en modo de memoria constante; el ZIP final se arma en un archivo temporal.
+
+    El formato exige el índice al final del archivo, así que los bytes se envían
+    cuando se han escrito todas las filas (una hoja nueva cada XLSX_MAX_ROWS).
+    """
+    with tempfile.TemporaryFile() as output:
+        # Los textos vienen del DTE: nunca se convierten en fórmulas
+        workbook = xlsxwriter.Workbook(output, {'constant_memory': True, 'strings_to_formulas': False})
+        header = workbook.add_format({'bold': True})
+        date_format = workbook.add_format({'num_format': 'yyyy-mm-dd'})
+        money_format = workbook.add_format({'num_format': '#,##0.00'})
+        sheet, row_num = None, XLSX_MAX_ROWS
+
+        for rows in chunks:
+            for row in rows:
+                if row_num >= XLSX_MAX_ROWS:
+                    sheet = workbook.add_worksheet()
+                    sheet.write_row(0, 0, EXPORT_COLUMNS, header)
+                    row_num = 0
+                row_num += 1
+                sheet.write_string(row_num, 0, row['codigo_generacion'])
+                if row['fecha_emision']:
+                    sheet.write_datetime(row_num, 1, row['fecha_emision'], date_format)
+                for col, field in ((2, 'nombre_emisor'), (3, 'emisor_nit'), (4, 'tipo_dte')):
+                    if row[field] is not None:
+                        sheet.write_string(row_num, col, row[field])
+                if row['total_pagar'] is not None:
+                    sheet.write_number(row_num, 5, float(row['total_pagar']), money_format)
+        if sheet is None:
+            sheet = workbook.add_worksheet()
+            sheet.write_row(0, 0, EXPORT_COLUMNS, header)
+        workbook.close()
+
+        output.seek(0)
+        while True:
+            data = output.read(FILE_CHUNK_SIZE)
+            if not data:
+                break
+            yield data
+
+
+def _export_parquet(chunks):
+    """Parquet columnar: cada lote es un row group que se envía en cuanto se escribe"""
+    schema = pyarrow.schema([
+        ('codigo_generacion', pyarrow.string()),
+        ('fecha_emision', pyarrow.date32()),
+        ('nombre_emisor', pyarrow.string()),
+        ('emisor_nit', pyarrow.string()),
+        ('tipo_dte', pyarrow.string()),
+        ('total_pagar', pyarrow.decimal128(14, 2)),
+    ])
+    sink = _ByteSink()
+    with pyarrow.parquet.ParquetWriter(sink, schema, compression='zstd') as writer:
+        for rows in chunks:
+            writer.write_table(pyarrow.Table.from_pydict(
+                {col: [row[col] for row in rows] for col in EXPORT_COLUMNS}, schema=schema
+            ))
+            yield sink.pop()
+    yield sink.pop()
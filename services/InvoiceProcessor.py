@@ -1,121 +1,568 @@
+import asyncio
+import logging
+import queue
+import threading
 import mysql.connector
+from googleapiclient.errors import HttpError
+from .DteParser import DteRecord, DteValidationError, parse_dte
+from .Instrumentation import INVOICES, STAGE_SECONDS, SYNC_RUNS, StageTimer
+
+logger = logging.getLogger(__name__)
+
+# Marca de fin de flujo entre etapas del pipeline
+_DONE = object()
+
+# Intentos de un correo fallido antes de darlo por perdido y dejar avanzar el checkpoint
+MAX_MESSAGE_ATTEMPTS = 5
+
+# Detalles que se guardan por lista (los últimos); el resto solo se cuentan.
+# El resultado acaba en sync_jobs.resultado y no debe crecer con el buzón
+MAX_DETAILS = 200
 
 class InvoiceProcessor:
-    def __init__(self, gmail_service, database_service):
+    def __init__(self, gmail_service, database_service, batch_size=200, attachment_workers=8):
         self.gmail_service = gmail_service
         self.database_service = database_service
+        # Número máximo de facturas por transacción al guardar en lote
+        self.batch_size = batch_size
+        # Descargas de adjuntos simultáneas por página de correos
+        self.attachment_workers = attachment_workers
     
-    def process_invoices(self, query="is:unread has:attachment filename:.json", max_results=100):
-        """Procesa facturas desde Gmail y las guarda en la base de datos"""
-        print("--- Iniciando Procesamiento de Facturas (OPTIMIZADO) ---")
-        
-        # 1. Buscar IDs de mensajes
-        messages = self.gmail_service.search_emails(query, max_results)
-        print(f"📧 Correos encontrados: {len(messages)}")
+    def process_invoices(self, query="is:unread has:attachment filename:.json", max_results=None, batch_size=None, page_size=500, incremental=True, resume=None, on_progress=None):
+        """Procesa facturas desde Gmail y las guarda en la base de datos.
+
+        Recorre todo el buzón página a página (nextPageToken). El listado, la
+        descarga de detalles y el guardado corren solapados en hilos unidos por
+        colas acotadas, así la memoria no depende del número de correos.
+        `max_results` limita opcionalmente el total de correos procesados.
+
+        Con `incremental=True`, si la cuenta ya tiene un checkpoint (historyId)
+        solo se procesan los mensajes añadidos desde entonces; si el checkpoint
+        expiró se hace un escaneo completo. Los correos que fallaron en
+        ejecuciones anteriores se reintentan primero, y el checkpoint solo avanza
+        si no queda ninguno pendiente (hasta MAX_MESSAGE_ATTEMPTS intentos).
+
+        Tras guardar cada página se llama a `on_progress(results, cursor)`; pasar
+        ese `cursor` como `resume` retoma el recorrido en la página siguiente.
+        Los correos fallidos de la página se guardan antes, así un trabajo
+        retomado tras caerse el worker los reintenta en lugar de olvidarlos.
+        """
+        logger.info("Iniciando procesamiento de facturas")
+        batch_size = batch_size or self.batch_size
+
+        # historyId actual: se guarda como checkpoint si la sincronización termina bien.
+        # Al retomar se conserva el de la ejecución original para no saltar correos.
+        profile = self.gmail_service.get_profile()
+        account, start_history_id, checkpoint, retry_ids = self._sync_start(profile, incremental, resume)
+        # En modo incremental los correos sin JSON no son facturas: se ignoran en silencio
+        run_state = {'mode': 'history' if checkpoint is not None else 'full'}
+        # Correos a reintentar y fallidos ya guardados en la BD ({id: intentos})
+        tracking = {'retry': set(retry_ids), 'recorded': {}}
+
+        def listed_pages():
+            page_token = resume['page_token'] if resume else None
+            if checkpoint is not None:
+                try:
+                    logger.info("Sincronización incremental desde historyId %s", checkpoint)
+                    yield from self.gmail_service.iter_history_message_ids(checkpoint, page_size, max_results, page_token)
+                    return
+                except HttpError as e:
+                    if e.resp.status != 404:
+                        raise
+                    logger.warning("Checkpoint expirado, se hace un escaneo completo")
+                    run_state['mode'] = 'full'
+                    page_token = None
+            yield from self.gmail_service.iter_message_ids(query, page_size, max_results, page_token)
+
+        def message_pages():
+            # Primero los correos que fallaron antes; el cursor sigue apuntando al inicio del listado
+            if retry_ids:
+                yield retry_ids, resume['page_token'] if resume else None
+            for page, next_page_token in listed_pages():
+                page = [message_id for message_id in page if message_id not in tracking['retry']]
+                if page:
+                    yield page, next_page_token
         
-        results = {
+        results = self._new_results()
+
+        # Como mucho dos páginas en espera por etapa
+        ids_queue = queue.Queue(maxsize=2)
+        details_queue = queue.Queue(maxsize=2)
+        stop = threading.Event()
+        stage_errors = []
+        # Mensajes que no se pudieron procesar: {id: causa}
+        failed = {}
+
+        def put(q, item):
+            # put con espera cancelable para que un fallo aguas abajo no bloquee el hilo
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def get(q):
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+            return _DONE
+
+        def list_stage():
+            # 1. Buscar IDs de mensajes, página a página
+            try:
+                pages = message_pages()
+                while True:
+                    with STAGE_SECONDS.labels('list').time():
+                        item = next(pages, None)
+                    if item is None:
+                        break
+                    page, next_page_token = item
+                    logger.debug("Página con %d correos", len(page))
+                    cursor = {'mode': run_state['mode'], 'page_token': next_page_token, 'history_id': start_history_id}
+                    if not put(ids_queue, (page, cursor)):
+                        return
+            except Exception as e:
+                stage_errors.append(f"ERROR LISTANDO: {e}")
+            finally:
+                put(ids_queue, _DONE)
+
+        def fetch_stage():
+            # 2. Descargar detalles en lote (Batch Request) de cada página
+            try:
+                while True:
+                    item = get(ids_queue)
+                    if item is _DONE:
+                        break
+                    page, cursor = item
+                    logger.debug("Descargando detalles de %d correos", len(page))
+                    page_failed = {}
+                    with STAGE_SECONDS.labels('batch_fetch').time():
+                        details = self.gmail_service.get_messages_batch(page, failed=page_failed)
+                    if not put(details_queue, (details, page_failed, page, cursor)):
+                        return
+            except Exception as e:
+                stage_errors.append(f"ERROR DESCARGANDO: {e}")
+            finally:
+                put(details_queue, _DONE)
+
+        workers = [
+            threading.Thread(target=list_stage, name='invoice-list', daemon=True),
+            threading.Thread(target=fetch_stage, name='invoice-fetch', daemon=True),
+        ]
+        for worker in workers:
+            worker.start()
+
+        try:
+            while True:
+                item = details_queue.get()
+                if item is _DONE:
+                    break
+                messages_details, page_failed, page, cursor = item
+                self._add_failures(results, failed, page_failed)
+                # 3. Extraer facturas en memoria
+                pending = self._extract_pending(
+                    messages_details.values(), results, failed, skip_without_json=cursor['mode'] == 'history'
+                )
+                # 4. Deduplicar y guardar en lotes (una consulta + un INSERT por lote)
+                for i in range(0, len(pending), batch_size):
+                    self._persist_batch(pending[i:i + batch_size], results, failed)
+                # Los fallos quedan en la BD antes de que el cursor avance
+                self._save_page_failures(account, page, failed, tracking)
+                if on_progress:
+                    on_progress(results, cursor)
+        finally:
+            stop.set()
+            for worker in workers:
+                worker.join()
+
+        self._finish_run(results, stage_errors, failed, tracking, account, start_history_id, max_results)
+        return results
+
+    async def process_invoices_async(self, query="is:unread has:attachment filename:.json", max_results=None, batch_size=None, page_size=500, incremental=True, resume=None, on_progress=None):
+        """Versión asyncio de process_invoices para un AsyncGmailService.
+
+        Mismos resultados, cursor y checkpoint. El listado y la descarga son
+        corrutinas unidas por colas acotadas, así muchas cuentas pueden
+        sincronizarse a la vez en un solo loop sin ocupar un hilo cada una;
+        la base de datos (bloqueante) se usa desde hilos con asyncio.to_thread.
+        """
+        logger.info("Iniciando procesamiento de facturas (async)")
+        batch_size = batch_size or self.batch_size
+
+        profile = await self.gmail_service.get_profile()
+        account, start_history_id, checkpoint, retry_ids = await asyncio.to_thread(
+            self._sync_start, profile, incremental, resume
+        )
+        run_state = {'mode': 'history' if checkpoint is not None else 'full'}
+        # Correos a reintentar y fallidos ya guardados en la BD ({id: intentos})
+        tracking = {'retry': set(retry_ids), 'recorded': {}}
+
+        async def listed_pages():
+            page_token = resume['page_token'] if resume else None
+            if checkpoint is not None:
+                try:
+                    logger.info("Sincronización incremental desde historyId %s", checkpoint)
+                    async for page in self.gmail_service.iter_history_message_ids(checkpoint, page_size, max_results, page_token):
+                        yield page
+                    return
+                except HttpError as e:
+                    if e.resp.status != 404:
+                        raise
+                    logger.warning("Checkpoint expirado, se hace un escaneo completo")
+                    run_state['mode'] = 'full'
+                    page_token = None
+            async for page in self.gmail_service.iter_message_ids(query, page_size, max_results, page_token):
+                yield page
+
+        async def message_pages():
+            if retry_ids:
+                yield retry_ids, resume['page_token'] if resume else None
+            async for page, next_page_token in listed_pages():
+                page = [message_id for message_id in page if message_id not in tracking['retry']]
+                if page:
+                    yield page, next_page_token
+
+        results = self._new_results()
+        ids_queue = asyncio.Queue(maxsize=2)
+        details_queue = asyncio.Queue(maxsize=2)
+        stage_errors = []
+        failed = {}
+
+        async def list_stage():
+            try:
+                pages = message_pages()
+                while True:
+                    with STAGE_SECONDS.labels('list').time():
+                        item = await anext(pages, None)
+                    if item is None:
+                        break
+                    page, next_page_token = item
+                    logger.debug("Página con %d correos", len(page))
+                    cursor = {'mode': run_state['mode'], 'page_token': next_page_token, 'history_id': start_history_id}
+                    await ids_queue.put((page, cursor))
+            except Exception as e:
+                stage_errors.append(f"ERROR LISTANDO: {e}")
+            # Fuera de finally: si la tarea se cancela no hay que esperar en la cola
+            await ids_queue.put(_DONE)
+
+        async def fetch_stage():
+            try:
+                while True:
+                    item = await ids_queue.get()
+                    if item is _DONE:
+                        break
+                    page, cursor = item
+                    logger.debug("Descargando detalles de %d correos", len(page))
+                    page_failed = {}
+                    with STAGE_SECONDS.labels('batch_fetch').time():
+                        details = await self.gmail_service.get_messages_batch(page, failed=page_failed)
+                    await details_queue.put((details, page_failed, page, cursor))
+            except Exception as e:
+                stage_errors.append(f"ERROR DESCARGANDO: {e}")
+            await details_queue.put(_DONE)
+
+        tasks = [asyncio.ensure_future(list_stage()), asyncio.ensure_future(fetch_stage())]
+        try:
+            while True:
+                item = await details_queue.get()
+                if item is _DONE:
+                    break
+                messages_details, page_failed, page, cursor = item
+                self._add_failures(results, failed, page_failed)
+                pending = await self._extract_pending_async(
+                    messages_details.values(), results, failed, skip_without_json=cursor['mode'] == 'history'
+                )
+                for i in range(0, len(pending), batch_size):
+                    await asyncio.to_thread(self._persist_batch, pending[i:i + batch_size], results, failed)
+                await asyncio.to_thread(self._save_page_failures, account, page, failed, tracking)
+                if on_progress:
+                    await asyncio.to_thread(on_progress, results, cursor)
+        finally:
+            # Si el consumidor falla, las etapas pueden estar esperando en una cola llena
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        await asyncio.to_thread(
+            self._finish_run, results, stage_errors, failed, tracking, account, start_history_id, max_results
+        )
+        return results
+
+    def _new_results(self):
+        return {
             'nuevas': 0,
             'duplicadas': 0,
             'errores': 0,
             'detalles': {
                 'procesadas': [],
-                'omitidas': []
+                'omitidas': [],
+                'total_procesadas': 0,
+                'total_omitidas': 0
             }
         }
-        
-        if not messages:
-            self._print_summary(results)
-            return results
-
-        # 2. Descargar detalles en lote (Batch Request)
-        message_ids = [msg['id'] for msg in messages]
-        print(f"📥 Descargando detalles de {len(message_ids)} correos en una sola petición...")
-        messages_details = self.gmail_service.get_messages_batch(message_ids)
-        
-        # 3. Procesar mensajes en memoria
-        for msg_id, message_data in messages_details.items():
+
+    def _add_detail(self, results, kind, text):
+        """Añade un detalle ('procesadas' u 'omitidas') conservando solo los MAX_DETAILS últimos"""
+        details = results['detalles']
+        details[f'total_{kind}'] += 1
+        details[kind].append(text)
+        if len(details[kind]) > MAX_DETAILS:
+            del details[kind][0]
+
+    def _sync_start(self, profile, incremental, resume):
+        """(cuenta, historyId de inicio, checkpoint a usar o None, correos a reintentar) de una sincronización"""
+        # historyId actual: se guarda como checkpoint si la sincronización termina bien.
+        # Al retomar se conserva el de la ejecución original para no saltar correos.
+        account = profile.get('emailAddress')
+        start_history_id = resume['history_id'] if resume else profile.get('historyId')
+        checkpoint = self.database_service.get_sync_checkpoint(account) if incremental else None
+        if resume and resume['mode'] == 'full':
+            checkpoint = None
+        retry_ids = self.database_service.get_failed_messages(account, MAX_MESSAGE_ATTEMPTS)
+        if retry_ids:
+            logger.info("Reintentando %d correos que fallaron antes", len(retry_ids))
+        return account, start_history_id, checkpoint, retry_ids
+
+    def _save_page_failures(self, account, page, failed, tracking):
+        """Guarda los fallos nuevos y olvida los reintentos de `page` que ya salieron bien"""
+        new = {message_id: error for message_id, error in failed.items() if message_id not in tracking['recorded']}
+        if new:
+            tracking['recorded'].update(self.database_service.record_failed_messages(account, new))
+        done = [message_id for message_id in page if message_id in tracking['retry'] and message_id not in failed]
+        if done:
+            self.database_service.clear_failed_messages(account, done)
+
+    def _finish_run(self, results, stage_errors, failed, tracking, account, start_history_id, max_results):
+        for error in stage_errors:
+            results['errores'] += 1
+            self._add_detail(results, 'omitidas', error)
+
+        abandoned = sorted(m for m, n in tracking['recorded'].items() if n >= MAX_MESSAGE_ATTEMPTS)
+        if abandoned:
+            logger.error(
+                "%d correos siguen fallando tras %d intentos y no se reintentarán: %s",
+                len(abandoned), MAX_MESSAGE_ATTEMPTS, ', '.join(abandoned)
+            )
+
+        # Solo avanzar el checkpoint si se recorrió todo y no queda ningún correo por
+        # reintentar en la BD (también los de un tramo anterior de un trabajo retomado)
+        if not stage_errors and max_results is None and start_history_id:
+            if not self.database_service.get_failed_messages(account, MAX_MESSAGE_ATTEMPTS):
+                self.database_service.save_sync_checkpoint(account, start_history_id)
+        clean = not stage_errors and not failed
+
+        for result in ('nuevas', 'duplicadas', 'errores'):
+            INVOICES.labels(result).inc(results[result])
+        SYNC_RUNS.labels('completado' if clean else 'con_errores').inc()
+        self._log_summary(results)
+
+    def _add_failures(self, results, failed, page_failed):
+        """Cuenta como errores los correos que Gmail no devolvió y los marca como fallidos"""
+        for message_id, error in page_failed.items():
+            results['errores'] += 1
+            self._add_detail(results, 'omitidas', f"ERROR OBTENIENDO CORREO {message_id}: {error}")
+        failed.update(page_failed)
+
+    def _extract_pending(self, messages, results, failed, skip_without_json=False):
+        """Extrae los datos de factura de cada mensaje, sin tocar la base de datos.
+
+        Primero localiza el adjunto JSON de todos los mensajes y luego los
+        descarga en paralelo, procesando cada uno en cuanto termina.
+        """
+        pending = []
+        seen = set()
+        targets, subjects = self._json_targets(messages, results, skip_without_json)
+        fetch_timer, parse_timer = StageTimer('attachment_fetch'), StageTimer('parse')
+        downloads = self.gmail_service.download_attachments(targets, max_workers=self.attachment_workers)
+        while True:
+            # Solo se cuenta la espera de cada descarga, no el procesado intercalado
+            with fetch_timer.measure():
+                item = next(downloads, None)
+            if item is None:
+                break
+            message_id, attachment_id, json_data, error = item
+            self._add_download(
+                pending, seen, results, failed, message_id, subjects[(message_id, attachment_id)],
+                json_data, error, parse_timer
+            )
+        fetch_timer.observe()
+        parse_timer.observe()
+        return pending
+
+    async def _extract_pending_async(self, messages, results, failed, skip_without_json=False):
+        """_extract_pending con las descargas de un AsyncGmailService"""
+        pending = []
+        seen = set()
+        targets, subjects = self._json_targets(messages, results, skip_without_json)
+        fetch_timer, parse_timer = StageTimer('attachment_fetch'), StageTimer('parse')
+        downloads = self.gmail_service.download_attachments(targets, max_workers=self.attachment_workers)
+        while True:
+            with fetch_timer.measure():
+                item = await anext(downloads, None)
+            if item is None:
+                break
+            message_id, attachment_id, json_data, error = item
+            self._add_download(
+                pending, seen, results, failed, message_id, subjects[(message_id, attachment_id)],
+                json_data, error, parse_timer
+            )
+        fetch_timer.observe()
+        parse_timer.observe()
+        return pending
+
+    def _json_targets(self, messages, results, skip_without_json):
+        """Adjuntos JSON a descargar `(mensaje, adjunto, parte)` y el asunto de cada uno"""
+        subjects = {}
+        targets = []
+        for message_data in messages:
             try:
                 if not message_data:
                     continue
-                    
+
                 subject = self._get_header(message_data.get('payload', {}).get('headers', []), 'Subject')
-                
-                # Extraer JSON de la factura (pasando el objeto ya descargado)
-                invoice_data = self.gmail_service.get_json_from_message(message_data)
-                if not invoice_data:
-                    results['detalles']['omitidas'].append(f"{subject} - SIN JSON VÁLIDO")
+                part = self.gmail_service.find_json_part(message_data)
+                if not part:
+                    # En modo incremental los correos sin JSON no son facturas
+                    if not skip_without_json:
+                        self._add_detail(results, 'omitidas', f"{subject} - SIN JSON VÁLIDO")
                     continue
-                
-                # Extraer datos importantes
-                invoice_info = self._extract_invoice_data(invoice_data)
-                if not invoice_info or not invoice_info['codigo_generacion']:
-                    results['detalles']['omitidas'].append(f"{subject} - SIN CÓDIGO VÁLIDO")
-                    continue
-                
-                # Verificar si ya existe
-                if self.database_service.invoice_exists(invoice_info['codigo_generacion']):
-                    results['duplicadas'] += 1
-                    results['detalles']['omitidas'].append(
-                        f"{invoice_info['codigo_generacion']} - {invoice_info['nombre_emisor']} - DUPLICADA"
-                    )
-                else:
-                    # Guardar nueva factura
-                    self.database_service.save_invoice(
-                        invoice_info['codigo_generacion'],
-                        invoice_info['fecha_emision'],
-                        invoice_info['nombre_emisor'],
-                        invoice_info['total_pagar'],
-                        invoice_info['tipo_dte']
-                    )
-                    results['nuevas'] += 1
-                    results['detalles']['procesadas'].append(
-                        f"{invoice_info['codigo_generacion']} - {invoice_info['nombre_emisor']} - ${invoice_info['total_pagar']}"
-                    )
-                    
-            except mysql.connector.Error as err:
-                if err.errno == 1062:  # Duplicado
-                    results['duplicadas'] += 1
-                    results['detalles']['omitidas'].append(f"{invoice_info['codigo_generacion']} - DUPLICADA (SQL)")
-                else:
-                    results['errores'] += 1
-                    results['detalles']['omitidas'].append(f"ERROR BD: {err}")
+                subjects[(message_data.get('id'), part['body']['attachmentId'])] = subject
+                targets.append((message_data.get('id'), part['body']['attachmentId'], part.get('partId')))
+
             except Exception as e:
                 results['errores'] += 1
-                results['detalles']['omitidas'].append(f"ERROR: {e}")
-        
-        self._print_summary(results)
-        return results
+                self._add_detail(results, 'omitidas', f"ERROR: {e}")
+        return targets, subjects
+
+    def _add_download(self, pending, seen, results, failed, message_id, subject, json_data, error, parse_timer):
+        """Parsea un adjunto descargado y lo añade a `pending` si es una factura nueva.
+
+        Si la descarga falló (cuota agotada, red...) el correo cuenta como error
+        y queda en `failed`, así el checkpoint no lo deja atrás.
+        """
+        if error:
+            logger.warning("Error descargando el adjunto de %s: %s", message_id, error)
+            results['errores'] += 1
+            self._add_detail(results, 'omitidas', f"{subject} - ERROR DESCARGANDO ADJUNTO ({error})")
+            failed[message_id] = f"descarga del adjunto: {error}"
+            return
+        try:
+            # Decodificar, validar y extraer la factura en un solo paso
+            with parse_timer.measure():
+                record = parse_dte(json_data)
+        except DteValidationError as e:
+            self._add_detail(results, 'omitidas', f"{subject} - DTE NO VÁLIDO ({e})")
+            return
+        except ValueError as e:
+            logger.warning("Error leyendo JSON del mensaje: %s", e)
+            self._add_detail(results, 'omitidas', f"{subject} - SIN JSON VÁLIDO")
+            return
+        except Exception as e:
+            logger.warning("Error procesando el JSON de %s: %s", message_id, e)
+            results['errores'] += 1
+            self._add_detail(results, 'omitidas', f"{subject} - ERROR ({e})")
+            return
+
+        try:
+            invoice_info = record.as_dict()
+
+            # La misma factura puede llegar en varios correos
+            if invoice_info['codigo_generacion'] in seen:
+                results['duplicadas'] += 1
+                self._add_detail(
+                    results, 'omitidas',
+                    f"{invoice_info['codigo_generacion']} - {invoice_info['nombre_emisor']} - DUPLICADA"
+                )
+                return
+            seen.add(invoice_info['codigo_generacion'])
+            # Para reintentar el correo si la factura no se puede guardar
+            invoice_info['message_id'] = message_id
+            pending.append(invoice_info)
+
+        except Exception as e:
+            results['errores'] += 1
+            self._add_detail(results, 'omitidas', f"ERROR: {e}")
+
+    def _persist_batch(self, batch, results, failed):
+        """Guarda un lote de facturas y registra el resultado de cada una.
+
+        Si el lote falla por una factura concreta (p. ej. un campo demasiado
+        largo), se reintenta factura a factura para guardar las demás e
+        informar de cada fallo. Los correos que no se guardan quedan en
+        `failed` para reintentarlos.
+        """
+        if not batch:
+            return
+        try:
+            self._save_batch(batch, results)
+            return
+        except (mysql.connector.InterfaceError, mysql.connector.OperationalError) as err:
+            # Conexión o servidor caídos: guardar de una en una fallaría igual
+            results['errores'] += len(batch)
+            self._add_detail(results, 'omitidas', f"ERROR BD: {err} ({len(batch)} facturas)")
+            for inv in batch:
+                if inv.get('message_id'):
+                    failed[inv['message_id']] = f"BD: {err}"
+            return
+        except mysql.connector.Error as err:
+            if len(batch) == 1:
+                self._add_save_error(batch[0], err, results, failed)
+                return
+            logger.warning("Error guardando %d facturas, se guardan de una en una: %s", len(batch), err)
+
+        for inv in batch:
+            try:
+                self._save_batch([inv], results)
+            except mysql.connector.Error as err:
+                self._add_save_error(inv, err, results, failed)
+
+    def _save_batch(self, batch, results):
+        # Emisor de cada factura (dimensión `emisores`), casi siempre desde la caché en proceso
+        self.database_service.resolve_emisor_ids(batch)
+        insertados, duplicados = self.database_service.save_invoices_batch(batch)
+
+        by_code = {inv['codigo_generacion']: inv for inv in batch}
+        for codigo in duplicados:
+            results['duplicadas'] += 1
+            self._add_detail(results, 'omitidas', f"{codigo} - {by_code[codigo]['nombre_emisor']} - DUPLICADA")
+        for codigo in insertados:
+            invoice_info = by_code[codigo]
+            results['nuevas'] += 1
+            self._add_detail(
+                results, 'procesadas',
+                f"{codigo} - {invoice_info['nombre_emisor']} - ${invoice_info['total_pagar']}"
+            )
+
+    def _add_save_error(self, inv, err, results, failed):
+        logger.error("Error guardando la factura %s: %s", inv['codigo_generacion'], err)
+        results['errores'] += 1
+        self._add_detail(
+            results, 'omitidas', f"{inv['codigo_generacion']} - {inv['nombre_emisor']} - ERROR BD ({err})"
+        )
+        if inv.get('message_id'):
+            failed[inv['message_id']] = f"BD: {err}"
     
     def _extract_invoice_data(self, invoice_data):
         """Extrae los datos importantes del JSON de factura"""
-        ident = invoice_data.get('identificacion', {})
-        emisor = invoice_data.get('emisor', {})
-        resumen = invoice_data.get('resumen', {})
-        
-        return {
-            'codigo_generacion': ident.get('codigoGeneracion'),
-            'fecha_emision': ident.get('fecEmi'),
-            'nombre_emisor': emisor.get('nombre'),
-            'total_pagar': resumen.get('totalPagar'),
-            'tipo_dte': ident.get('tipoDte')
-        }
+        return DteRecord.from_dte(invoice_data).as_dict()
     
     def _get_header(self, headers, name):
         """Obtiene un header específico del mensaje"""
         return next((h['value'] for h in headers if h['name'] == name), 'Desconocido')
     
-    def _print_summary(self, results):
-        """Imprime resumen del procesamiento"""
-        print("\n" + "="*50)
-        print("📊 RESUMEN DE PROCESAMIENTO")
-        print("="*50)
-        print(f"✅ NUEVAS: {results['nuevas']}")
-        print(f"🔄 DUPLICADAS: {results['duplicadas']}")
-        print(f"❌ ERRORES: {results['errores']}")
-        print("\n📋 FACTURAS PROCESADAS:")
-        for factura in results['detalles']['procesadas']:
-            print(f"   ✅ {factura}")
-        print("\n📋 FACTURAS OMITIDAS:")
-        for factura in results['detalles']['omitidas']:
-            print(f"   ❌ {factura}")
-        print("="*50)
\ No newline at end of file
+    def _log_summary(self, results):
+        """Registra el resumen; el detalle por factura solo con LOG_LEVEL=DEBUG"""
+        logger.info(
+            "Resumen de procesamiento nuevas=%d duplicadas=%d errores=%d omitidas=%d",
+            results['nuevas'], results['duplicadas'], results['errores'], results['detalles']['total_omitidas']
+        )
+        # En sincronizaciones grandes no se recorren las listas si no se van a mostrar
+        if logger.isEnabledFor(logging.DEBUG):
+            for factura in results['detalles']['procesadas']:
+                logger.debug("Procesada %s", factura)
+            for factura in results['detalles']['omitidas']:
+                logger.debug("Omitida %s", factura)
\ No newline at end of file
@@ -0,0 +1,111 @@
+import hashlib
+import hmac
+import os
+import socket
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _token_hash(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+class JobQueue:
+    """Cola de trabajos de sincronización en segundo plano.
+
+    Los trabajos se guardan en la tabla `sync_jobs` y se ejecutan en un pool
+    de hilos del propio proceso. Cada trabajo renueva un heartbeat al guardar
+    progreso; si el worker muere, otro proceso lo reclama al barrer trabajos
+    abandonados y lo retoma desde su último cursor.
+    """
+
+    def __init__(self, database_service, processor_factory, max_workers=2, stale_seconds=300, sweep_interval=60, runner=None):
+        self.database_service = database_service
+        # processor_factory(token) -> InvoiceProcessor con su propio cliente de Gmail
+        self.processor_factory = processor_factory
+        # AsyncLoopRunner opcional: los trabajos usan process_invoices_async en su loop
+        self.runner = runner
+        self.max_workers = max_workers
+        self.stale_seconds = stale_seconds
+        self.sweep_interval = sweep_interval
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def start(self):
+        """Arranca el pool y el barrido periódico de trabajos abandonados"""
+        self._ensure_started()
+
+    def _ensure_started(self):
+        # Se comprueba el PID porque gunicorn puede hacer fork después de importar la app
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._owner = f"{socket.gethostname()}:{self._pid}"
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='sync-job')
+            threading.Thread(target=self._sweep_loop, name='sync-job-sweeper', daemon=True).start()
+
+    def submit(self, token, params=None):
+        """Registra un trabajo nuevo y lo encola. Devuelve su ID"""
+        self._ensure_started()
+        job_id = uuid.uuid4().hex
+        self.database_service.create_job(job_id, params or {}, token, _token_hash(token))
+        self._executor.submit(self._run, job_id)
+        return job_id
+
+    def get(self, job_id, token):
+        """Estado y contadores de un trabajo (sin el token), solo si lo creó `token`"""
+        job = self.database_service.get_job(job_id)
+        if not job or not hmac.compare_digest(job.get('token_hash') or '', _token_hash(token)):
+            return None
+        job.pop('token', None)
+        job.pop('token_hash', None)
+        return job
+
+    def resume_pending(self):
+        """Reclama y encola los trabajos pendientes o abandonados"""
+        self._ensure_started()
+        for job_id in self.database_service.find_resumable_jobs(self.stale_seconds):
+            self._executor.submit(self._run, job_id)
+
+    def _sweep_loop(self):
+        # Primera pasada inmediata: retoma lo que dejó un worker reiniciado
+        while True:
+            try:
+                self.resume_pending()
+            except Exception as e:
+                print(f"Error revisando trabajos pendientes: {e}")
+            if self._stop.wait(self.sweep_interval):
+                return
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self, job_id):
+        if not self.database_service.claim_job(job_id, self._owner, self.stale_seconds):
+            return  # Otro worker ya lo tiene
+
+        job = self.database_service.get_job(job_id)
+        # Contadores acumulados antes de un posible reinicio
+        base = {key: job[key] for key in ('nuevas', 'duplicadas', 'errores')}
+
+        def totals(results):
+            return {key: base[key] + results[key] for key in base}
+
+        def on_progress(results, cursor):
+            self.database_service.update_job_progress(job_id, totals(results), cursor)
+
+        try:
+            processor = self.processor_factory(job['token'])
+            kwargs = dict(resume=job['cursor_data'], on_progress=on_progress, **(job['params'] or {}))
+            if self.runner is not None:
+                results = self.runner.run(processor.process_invoices_async(**kwargs))
+            else:
+                results = processor.process_invoices(**kwargs)
+            self.database_service.finish_job(job_id, 'completado', totals(results), results['detalles'])
+        except Exception as e:
+            print(f"Error en trabajo {job_id}: {e}")
+            self.database_service.finish_job(job_id, 'error', error=str(e))
@@ -0,0 +1,101 @@
+import os
+import random
+import socket
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from google.auth.exceptions import RefreshError
+
+
+class SyncScheduler:
+    """Sincroniza periódicamente todas las cuentas de `sync_accounts`.
+
+    Cada cuenta se sincroniza cada `interval` segundos (± `jitter`) con un
+    token de acceso renovado desde su refresh token. Como mucho `max_workers`
+    sincronizaciones a la vez; se atienden primero las cuentas que llevan más
+    tiempo esperando, y cada cuenta queda reservada en la BD mientras se
+    sincroniza, así varios planificadores pueden convivir sin repetir trabajo.
+    """
+
+    def __init__(self, database_service, processor_factory, refresh_access_token, interval=900,
+                 max_workers=4, jitter=0.2, poll_interval=30, lease_seconds=600, runner=None):
+        self.database_service = database_service
+        # processor_factory(token) -> InvoiceProcessor con su propio cliente de Gmail
+        self.processor_factory = processor_factory
+        # refresh_access_token(refresh_token) -> token de acceso nuevo
+        self.refresh_access_token = refresh_access_token
+        self.interval = interval
+        self.max_workers = max_workers
+        self.jitter = jitter
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        # AsyncLoopRunner opcional: las sincronizaciones usan process_invoices_async
+        self.runner = runner
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+
+    def _next_delay(self):
+        """Intervalo con jitter para que las cuentas no coincidan siempre en el tiempo"""
+        return self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def run_forever(self):
+        """Bucle principal: reserva cuentas vencidas mientras haya hueco en el pool"""
+        print(f"⏰ Planificador iniciado ({self.max_workers} sincronizaciones simultáneas, cada {self.interval}s)")
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='sync-account') as pool:
+            running = set()
+            while not self._stop.is_set():
+                self._wake.clear()
+                running = {future for future in running if not future.done()}
+                free = self.max_workers - len(running)
+                if free > 0:
+                    try:
+                        # Propietario único por reserva para leer solo las cuentas de esta ronda
+                        claim = f"{self.owner}:{uuid.uuid4().hex[:8]}"
+                        for account, refresh_token in self.database_service.claim_due_accounts(
+                            claim, free, self.lease_seconds
+                        ):
+                            future = pool.submit(self._sync_account, account, refresh_token, claim)
+                            future.add_done_callback(lambda _: self._wake.set())
+                            running.add(future)
+                    except Exception as e:
+                        print(f"Error buscando cuentas por sincronizar: {e}")
+                # Se despierta antes si termina una sincronización
+                self._wake.wait(self.poll_interval * random.uniform(0.5, 1.0))
+        print("⏰ Planificador detenido")
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def _sync_account(self, account, refresh_token, claim):
+        try:
+            token = self.refresh_access_token(refresh_token)
+        except RefreshError as e:
+            # Acceso revocado o refresh token caducado: hace falta volver a iniciar sesión
+            print(f"⚠️ {account}: no se pudo renovar el token, cuenta desactivada ({e})")
+            self.database_service.finish_account_sync(
+                account, 'revocada', self._next_delay(), error=str(e), enabled=False
+            )
+            return
+        except Exception as e:
+            print(f"Error renovando token de {account}: {e}")
+            self.database_service.finish_account_sync(account, 'error', self._next_delay(), error=str(e))
+            return
+
+        def on_progress(results, cursor):
+            self.database_service.renew_account_lease(account, claim, self.lease_seconds)
+
+        try:
+            print(f"🔄 Sincronizando {account}")
+            processor = self.processor_factory(token)
+            if self.runner is not None:
+                results = self.runner.run(processor.process_invoices_async(on_progress=on_progress))
+            else:
+                results = processor.process_invoices(on_progress=on_progress)
+            self.database_service.finish_account_sync(
+                account, 'completado', self._next_delay(), nuevas=results['nuevas']
+            )
+        except Exception as e:
+            print(f"Error sincronizando {account}: {e}")
+            self.database_service.finish_account_sync(account, 'error', self._next_delay(), error=str(e))
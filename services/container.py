@@ -1,8 +1,12 @@
 import os
 from dotenv import load_dotenv
-from .GmailService import GmailService
+from .GmailService import GmailService, GmailClientCache
+from .AsyncGmailService import GMAIL_ROOT_URL, AsyncGmailService, AsyncGmailTransport, AsyncLoopRunner, BlockingGmail
 from .DatabaseService import DatabaseService
 from .InvoiceProcessor import InvoiceProcessor
+from .JobQueue import JobQueue
+from .AttachmentCache import AttachmentCache
+from .CacheBackend import create_cache_backend
 
 # Cargar configuración
 load_dotenv('config.env')
@@ -12,16 +16,93 @@ CLIENT_ID = os.getenv('CLIENT_ID')
 CLIENT_SECRET = os.getenv('CLIENT_SECRET')
 REDIRECT_URI = 'http://localhost:5000/auth/callback' 
 
+# Estado compartido entre workers de gunicorn (rate limiting y cachés):
+# sqlite:///ruta (una máquina), redis://host:6379/0 (varias) o memory:// (por proceso)
+SHARED_STATE_URI = os.getenv('SHARED_STATE_URI', 'sqlite:///cache/shared_state.sqlite')
+
+# Caché en disco de adjuntos (vacío en ATTACHMENT_CACHE_DIR = desactivada)
+ATTACHMENT_CACHE_DIR = os.getenv('ATTACHMENT_CACHE_DIR', 'cache/attachments')
+attachment_cache = AttachmentCache(
+    ATTACHMENT_CACHE_DIR,
+    max_bytes=int(os.getenv('ATTACHMENT_CACHE_MAX_MB', '1024')) * 1024 * 1024
+) if ATTACHMENT_CACHE_DIR else None
+
+# Raíz de la API de Gmail; se cambia para apuntar a un servidor falso (benchmarks)
+GMAIL_API_ROOT = os.getenv('GMAIL_ROOT_URL') or GMAIL_ROOT_URL
+
+# Clientes de Gmail ya construidos, por token (los tokens de acceso duran 1 hora)
+gmail_clients = GmailClientCache(
+    max_entries=int(os.getenv('GMAIL_CLIENT_CACHE_SIZE', '256')),
+    ttl=int(os.getenv('GMAIL_CLIENT_CACHE_TTL', '3300')),
+    root_url=GMAIL_API_ROOT
+)
+
 # Inicializar instancias (Singleton)
 # Al importar estas variables desde otros archivos, siempre usaremos las mismas instancias
-gmail_service = GmailService(CLIENT_ID, CLIENT_SECRET, REDIRECT_URI)
+# (gmail_service solo se usa para OAuth y utilidades sin token; las peticiones usan gmail_for_token)
+gmail_service = GmailService(CLIENT_ID, CLIENT_SECRET, REDIRECT_URI, cache=attachment_cache, clients=gmail_clients)
 
 db_service = DatabaseService(
     host=os.getenv('DB_HOST', 'localhost'),
     port=os.getenv('DB_PORT', '3306'),
     user=os.getenv('DB_USER', 'root'),
     password=os.getenv('DB_PASSWORD'),
-    database=os.getenv('DB_NAME')
+    database=os.getenv('DB_NAME'),
+    pool_size=int(os.getenv('DB_POOL_SIZE', '10')),
+    pool_max_lifetime=int(os.getenv('DB_POOL_MAX_LIFETIME', '1800'))
+)
+
+def make_invoice_processor(gmail):
+    return InvoiceProcessor(
+        gmail,
+        db_service,
+        batch_size=int(os.getenv('INVOICE_BATCH_SIZE', '200')),
+        attachment_workers=int(os.getenv('ATTACHMENT_WORKERS', '8'))
+    )
+
+def gmail_for_token(token):
+    """GmailService propio para un token (no comparte estado con otras peticiones).
+
+    El cliente de la API sale de gmail_clients, así que crearlo es barato.
+    """
+    gmail = GmailService(CLIENT_ID, CLIENT_SECRET, REDIRECT_URI, cache=attachment_cache, clients=gmail_clients)
+    gmail.build_service(token)
+    return gmail
+
+# Vía asyncio (GMAIL_ASYNC=1): un loop por proceso con un transporte HTTP compartido
+# por todas las cuentas (conexiones reutilizadas y concurrencia acotada)
+GMAIL_ASYNC = os.getenv('GMAIL_ASYNC', '0') == '1'
+gmail_runner = AsyncLoopRunner()
+gmail_transport = AsyncGmailTransport(
+    root_url=GMAIL_API_ROOT,
+    max_concurrency=int(os.getenv('GMAIL_ASYNC_CONCURRENCY', '32'))
+)
+
+def async_gmail_for_token(token):
+    """AsyncGmailService para un token (sus corrutinas deben correr en gmail_runner)"""
+    return AsyncGmailService(gmail_transport, token, cache=attachment_cache)
+
+def request_gmail_for_token(token):
+    """Cliente con la interfaz síncrona de GmailService para las rutas de Flask"""
+    if GMAIL_ASYNC:
+        return BlockingGmail(async_gmail_for_token(token), gmail_runner)
+    return gmail_for_token(token)
+
+def processor_for_token(token):
+    """InvoiceProcessor con su propio GmailService (para trabajos en segundo plano)"""
+    if GMAIL_ASYNC:
+        return make_invoice_processor(async_gmail_for_token(token))
+    return make_invoice_processor(gmail_for_token(token))
+
+job_queue = JobQueue(
+    db_service,
+    processor_for_token,
+    max_workers=int(os.getenv('SYNC_JOB_WORKERS', '2')),
+    runner=gmail_runner if GMAIL_ASYNC else None
 )
 
-invoice_processor = InvoiceProcessor(gmail_service, db_service)
+# Caché de /api/search: resultados por usuario y consulta (TTL corto) y
+# correos ya formateados por ID, que se reutilizan entre búsquedas
+SEARCH_CACHE_TTL = int(os.getenv('SEARCH_CACHE_TTL', '60'))
+MESSAGE_CACHE_TTL = int(os.getenv('MESSAGE_CACHE_TTL', '600'))
+search_cache = create_cache_backend(SHARED_STATE_URI, max_entries=int(os.getenv('SEARCH_CACHE_MAX_ENTRIES', '10000')))
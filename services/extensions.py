@@ -0,0 +1,13 @@
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
+
+from .container import SHARED_STATE_URI
+
+# Rate limiting (seguridad anti-DDoS básica). Se crea aquí, sin app, para que las
+# rutas puedan declarar límites propios con @limiter.limit; app.py hace init_app.
+# Los contadores se comparten entre todos los workers de gunicorn
+limiter = Limiter(
+    get_remote_address,
+    default_limits=["200 per day", "50 per hour"],
+    storage_uri=SHARED_STATE_URI
+)
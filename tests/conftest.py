@@ -0,0 +1,8 @@
+import os
+import sys
+
+# Estado compartido en memoria y sin caché de adjuntos: los tests no escriben en cache/
+os.environ.setdefault('SHARED_STATE_URI', 'memory://')
+os.environ.setdefault('ATTACHMENT_CACHE_DIR', '')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
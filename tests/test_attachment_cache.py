@@ -0,0 +1,42 @@
+import os
+
+from services.AttachmentCache import AttachmentCache
+
+
+def _stored_bytes(cache):
+    return cache._db().execute("SELECT bytes FROM usage").fetchone()[0]
+
+
+def _blob_bytes(directory):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, files in os.walk(os.path.join(directory, 'blobs')) for name in files)
+
+
+def test_running_total_tracks_blobs(tmp_path):
+    cache = AttachmentCache(str(tmp_path), max_bytes=1000)
+    cache.put('a', b'x' * 100)
+    cache.put('b', b'x' * 100)  # mismo contenido: un solo blob
+    cache.put('c', b'y' * 200)
+    assert _stored_bytes(cache) == _blob_bytes(tmp_path) == 300
+    cache.put('c', b'z' * 50)  # la clave cambia de contenido: el blob anterior sobra
+    assert _stored_bytes(cache) == _blob_bytes(tmp_path) == 150
+
+
+def test_evicts_least_recently_used_over_cap(tmp_path):
+    cache = AttachmentCache(str(tmp_path), max_bytes=250)
+    cache.put('a', b'a' * 100)
+    cache.put('b', b'b' * 100)
+    cache.get('a')
+    cache.put('c', b'c' * 100)
+    assert cache.get('b') is None
+    assert cache.get('a') == b'a' * 100 and cache.get('c') == b'c' * 100
+    assert _stored_bytes(cache) == _blob_bytes(tmp_path) == 200
+
+
+def test_total_initialized_from_existing_index(tmp_path):
+    cache = AttachmentCache(str(tmp_path))
+    cache.put('a', b'a' * 10)
+    # Índice de una versión sin contador: se calcula una vez al abrirlo
+    with cache._db() as db:
+        db.execute("DROP TABLE usage")
+    assert _stored_bytes(AttachmentCache(str(tmp_path))) == 10
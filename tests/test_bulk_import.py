@@ -0,0 +1,72 @@
+import json
+import random
+
+import mysql.connector
+
+from benchmarks.dte_corpus import make_dte
+from benchmarks.suite import MemoryDatabase
+from services.BulkImport import BulkImporter
+
+
+class PacketLimitedDatabase(MemoryDatabase):
+    """Rechaza, como MariaDB, los lotes cuyo JSON supera `max_packet` bytes"""
+
+    def __init__(self, max_packet):
+        super().__init__()
+        self.max_packet = max_packet
+        self.batches = []
+
+    def save_invoices_batch(self, invoices):
+        size = sum(len(inv['raw']) for inv in invoices)
+        if size > self.max_packet:
+            raise mysql.connector.OperationalError(
+                msg="Got a packet bigger than 'max_allowed_packet' bytes", errno=1153
+            )
+        self.batches.append(size)
+        return super().save_invoices_batch(invoices)
+
+
+def _write_dtes(directory, count):
+    rng = random.Random(25)
+    sizes = []
+    for n in range(count):
+        raw = json.dumps(make_dte(rng, items=10)).encode()
+        (directory / f"dte_{n:03d}.json").write_bytes(raw)
+        sizes.append(len(raw))
+    return sizes
+
+
+def test_batches_are_sized_by_bytes(tmp_path):
+    sizes = _write_dtes(tmp_path, 40)
+    db = PacketLimitedDatabase(max_packet=10 * max(sizes))
+    results = BulkImporter(db, workers=1, batch_size=2000, batch_bytes=5 * max(sizes)).run([str(tmp_path)])
+
+    assert results['nuevas'] == 40
+    assert results['errores'] == 0
+    assert len(db.batches) > 1
+    assert max(db.batches) < 6 * max(sizes)
+
+
+def test_oversized_batch_is_split(tmp_path):
+    sizes = _write_dtes(tmp_path, 40)
+    # El límite de bytes no basta para el servidor: el lote se divide hasta que cabe
+    db = PacketLimitedDatabase(max_packet=3 * max(sizes))
+    results = BulkImporter(db, workers=1, batch_size=2000).run([str(tmp_path)])
+
+    assert results['nuevas'] == 40
+    assert results['errores'] == 0
+    assert len(db.codes) == 40
+    assert max(db.batches) <= 3 * max(sizes)
+
+
+def test_duplicates_across_batches_are_counted_once(tmp_path):
+    sizes = _write_dtes(tmp_path, 10)
+    (tmp_path / "copia").mkdir()
+    for path in sorted(tmp_path.glob("dte_*.json")):
+        (tmp_path / "copia" / path.name).write_bytes(path.read_bytes())
+    db = PacketLimitedDatabase(max_packet=sum(sizes) * 2)
+    results = BulkImporter(db, workers=1, batch_size=4).run([str(tmp_path)])
+
+    assert results['nuevas'] == 10
+    assert results['duplicadas'] == 10
+    assert results['errores'] == 0
@@ -0,0 +1,30 @@
+import pytest
+
+from services.DatabaseService import display_emisor_name, emisor_key
+
+
+@pytest.mark.parametrize('nombre', ['CAFE NANDU SA', 'CAFE NANDU S.A.', 'CAFE NANDU S A', 'Café Ñandú, s. a.'])
+def test_legal_form_variants_share_key(nombre):
+    assert emisor_key(None, nombre) == 'N:CAFE NANDU S A'
+    assert display_emisor_name(nombre) in ('CAFE NANDU S.A.', 'CAFE ÑANDU S.A.')
+
+
+@pytest.mark.parametrize('nombre, esperado', [
+    ('Distribuidora  Zablah, s.a de c.v', 'DISTRIBUIDORA ZABLAH S.A. DE C.V.'),
+    ('DISTRIBUIDORA ZABLAH S A DE C V', 'DISTRIBUIDORA ZABLAH S.A. DE C.V.'),
+    ('Peñate y Cía, S. de R.L. de C.V.', 'PEÑATE Y CIA S. DE R.L. DE C.V.'),
+    ('Grupo ACME S.A.S. de C.V.', 'GRUPO ACME S.A.S. DE C.V.'),
+    ('Lopez,Hnos', 'LOPEZ, HNOS'),
+])
+def test_display_name(nombre, esperado):
+    assert display_emisor_name(nombre) == esperado
+
+
+@pytest.mark.parametrize('nombre', ['A.S.A', 'CASA', 'EMPRESA', 'S.A.'])
+def test_legal_form_only_as_separate_trailing_words(nombre):
+    # Sin palabra propia al final (o sin nombre delante) no hay forma societaria
+    assert display_emisor_name(nombre) == nombre
+
+
+def test_nit_key_ignores_name():
+    assert emisor_key('0614-010190-101-1', 'Cafe SA') == emisor_key('06140101901011', 'CAFE S.A.') == '06140101901011'
@@ -0,0 +1,29 @@
+import io
+import zipfile
+from datetime import date
+from decimal import Decimal
+
+import pytest
+
+from services.InvoiceExport import available_formats, export_invoices
+
+ROW = {
+    'codigo_generacion': 'ABC', 'fecha_emision': date(2024, 1, 31), 'nombre_emisor': '=HYPERLINK("http://x")',
+    'emisor_nit': '+50312345678', 'tipo_dte': '@01', 'total_pagar': Decimal('-5.00'),
+}
+
+
+def test_csv_escapes_formulas():
+    data = b''.join(export_invoices(iter([[ROW]]), 'csv')).decode('utf-8-sig')
+    line = data.splitlines()[1]
+    assert '\'=HYPERLINK' in line and "'+50312345678" in line and "'@01" in line
+    # Los números no son texto del DTE: se exportan tal cual
+    assert line.endswith(',-5.00')
+
+
+@pytest.mark.skipif('xlsx' not in available_formats(), reason='XlsxWriter no instalado')
+def test_xlsx_writes_text_not_formulas():
+    data = b''.join(export_invoices(iter([[ROW]]), 'xlsx'))
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        sheet = archive.read('xl/worksheets/sheet1.xml').decode('utf-8')
+    assert '<f>' not in sheet
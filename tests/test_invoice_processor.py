@@ -0,0 +1,81 @@
+import mysql.connector
+import pytest
+
+from benchmarks.fake_gmail import FakeGmailServer
+from benchmarks.suite import MemoryDatabase
+from services import InvoiceProcessor as invoice_processor
+from services.GmailService import GmailService
+from services.InvoiceProcessor import InvoiceProcessor
+
+
+class WorkerDied(Exception):
+    pass
+
+
+class FlakyDatabase(MemoryDatabase):
+    """No puede guardar la primera factura que recibe mientras `broken`"""
+
+    def __init__(self):
+        super().__init__()
+        self.broken = True
+        self.bad = None
+
+    def save_invoices_batch(self, invoices):
+        self.bad = self.bad or invoices[0]['codigo_generacion']
+        if self.broken and any(inv['codigo_generacion'] == self.bad for inv in invoices):
+            raise mysql.connector.DatabaseError("fallo simulado")
+        return super().save_invoices_batch(invoices)
+
+
+@pytest.fixture(scope='module')
+def root_url():
+    server = FakeGmailServer(30)
+    yield server.start()
+    server.stop()
+
+
+def _processor(root_url, db):
+    gmail = GmailService(None, None, None, root_url=root_url)
+    gmail.build_service('test')
+    return InvoiceProcessor(gmail, db)
+
+
+def test_resumed_job_retries_failures_of_the_dead_worker(root_url):
+    db = FlakyDatabase()
+    cursors = []
+
+    def on_progress(results, cursor):
+        cursors.append(cursor)
+        if len(cursors) == 2:
+            raise WorkerDied()
+
+    # El worker muere tras la 2ª página; la 1ª no se pudo guardar
+    with pytest.raises(WorkerDied):
+        _processor(root_url, db).process_invoices(query='has:attachment', page_size=10, on_progress=on_progress)
+    assert len(db.codes) == 19
+    assert len(db.failed_messages) == 1
+    assert not db.checkpoints
+    db.broken = False
+
+    # El trabajo retomado parte del último cursor guardado (el de la 1ª página)
+    results = _processor(root_url, db).process_invoices(query='has:attachment', page_size=10, resume=cursors[0])
+    assert results['errores'] == 0
+    assert len(db.codes) == 30
+    assert db.checkpoints and not db.failed_messages
+
+
+def test_details_keep_counts_and_only_the_latest(root_url, monkeypatch):
+    monkeypatch.setattr(invoice_processor, 'MAX_DETAILS', 4)
+    db = MemoryDatabase()
+    first = _processor(root_url, db).process_invoices(query='has:attachment', incremental=False)
+    assert first['detalles']['total_procesadas'] == 30
+    assert len(first['detalles']['procesadas']) == 4
+
+    # Segunda pasada: todas duplicadas
+    results = _processor(root_url, db).process_invoices(query='has:attachment', incremental=False)
+
+    detalles = results['detalles']
+    assert results['duplicadas'] == 30
+    assert detalles['total_omitidas'] == 30
+    assert len(detalles['omitidas']) == 4
+    assert all(detail.endswith('DUPLICADA') for detail in detalles['omitidas'])
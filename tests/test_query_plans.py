@@ -0,0 +1,49 @@
+"""Las consultas del dashboard no deben recorrer `facturas` completa.
+
+Necesita MariaDB: usa DB_HOST/DB_PORT/DB_USER/DB_PASSWORD y la base TEST_DB_NAME
+(por defecto facturaflow_test, se crea si no existe). Sin servidor, se omite.
+"""
+import os
+
+import mysql.connector
+import pytest
+
+from benchmarks.seed import seed_facturas
+from services.DatabaseService import DatabaseService
+
+SEED_ROWS = 20000
+
+
+@pytest.fixture(scope='module')
+def db():
+    config = {
+        'host': os.getenv('DB_HOST', 'localhost'),
+        'port': os.getenv('DB_PORT', '3306'),
+        'user': os.getenv('DB_USER', 'root'),
+        'password': os.getenv('DB_PASSWORD'),
+    }
+    database = os.getenv('TEST_DB_NAME', 'facturaflow_test')
+    try:
+        conn = mysql.connector.connect(connection_timeout=3, **config)
+    except mysql.connector.Error as e:
+        pytest.skip(f"MariaDB no disponible: {e}")
+    cursor = conn.cursor()
+    cursor.execute(f"CREATE DATABASE IF NOT EXISTS `{database}`")
+    cursor.close()
+    conn.close()
+
+    service = DatabaseService(database=database, **config)
+    assert service.create_tables()
+    # Misma semilla: repetir el test no duplica filas (INSERT IGNORE)
+    seed_facturas(service, SEED_ROWS)
+    with service.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("ANALYZE TABLE facturas")
+        cursor.fetchall()
+        cursor.close()
+    return service
+
+
+def test_dashboard_queries_use_indexes(db):
+    assert db.create_tables()
+    assert db.check_stats_query_plans() == []
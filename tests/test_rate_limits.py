@@ -0,0 +1,40 @@
+from unittest import mock
+
+import pytest
+
+from app import app
+from routes import api
+from services.extensions import limiter
+
+JOB = {
+    'id': 'job', 'status': 'en_curso', 'nuevas': 0, 'duplicadas': 0, 'errores': 0,
+    'resultado': None, 'error': None,
+}
+
+
+@pytest.fixture
+def client():
+    limiter.reset()
+    client = app.test_client()
+    client.set_cookie('gmail_token', 'token')
+    yield client
+    limiter.reset()
+
+
+def test_job_status_has_its_own_limit(client):
+    with mock.patch.object(api.job_queue, 'get', return_value=JOB):
+        codes = [client.get('/api/jobs/job').status_code for _ in range(121)]
+    # Más que el cupo general (50 por hora), pero no ilimitado
+    assert codes[:120] == [200] * 120
+    assert codes[120] == 429
+
+
+def test_process_invoices_keeps_default_limit(client):
+    with mock.patch.object(api.job_queue, 'get', return_value=JOB):
+        for _ in range(120):
+            client.get('/api/jobs/job')
+    with mock.patch.object(api.job_queue, 'submit', return_value='job'):
+        codes = [client.post('/api/process-invoices').status_code for _ in range(51)]
+    # Los sondeos de progreso no consumen el cupo de /api/process-invoices
+    assert codes[:50] == [202] * 50
+    assert codes[50] == 429